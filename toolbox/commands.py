@@ -54,10 +54,19 @@ def stop_recording(context):
 def drop_recording(context):
     import frappe
 
-    from toolbox.sql_recorder import TOOLBOX_RECORDER_DATA
+    from toolbox.sql_recorder import (
+        TOOLBOX_RECORDER_DATA,
+        TOOLBOX_RECORDER_DROPPED,
+        TOOLBOX_RECORDER_PROCESSING,
+        TOOLBOX_RECORDER_STATS,
+    )
 
     with frappe.init_site(get_site(context)):
-        frappe.cache.delete_value(TOOLBOX_RECORDER_DATA)
+        # data is sharded into TOOLBOX_RECORDER_DATA:<shard> hashes
+        frappe.cache.delete_keys(TOOLBOX_RECORDER_DATA)
+        frappe.cache.delete_keys(TOOLBOX_RECORDER_PROCESSING)
+        frappe.cache.delete_keys(TOOLBOX_RECORDER_STATS)
+        frappe.cache.delete_value(TOOLBOX_RECORDER_DROPPED)
 
 
 @click.command("process")
@@ -81,29 +90,15 @@ def process_metadata(context):
 @click.command("cleanup")
 @pass_context
 def cleanup_metadata(context):
-    from collections import Counter
-
     import frappe
 
+    from toolbox.utils import dedupe_recorded_queries
+
     with frappe.init_site(get_site(context)):
         frappe.connect()
-        mdb_qry = frappe.qb.DocType("MariaDB Query")
-        candidates = frappe.get_all("MariaDB Query", pluck="query")
-        c = Counter()
-        c.update(candidates)
-
-        candidates = [q for q, count in c.most_common(10_000) if count > 1]
-
-        for query in candidates:
-            all_occurrences = frappe.get_all("MariaDB Query", {"query": query}, pluck="name")
-            pick = all_occurrences[0]
-            frappe.qb.from_(mdb_qry).where(mdb_qry.query == query).where(
-                mdb_qry.name != pick
-            ).delete().run()
-            doc = frappe.get_doc("MariaDB Query", pick)
-            doc.occurrence = len(all_occurrences)
-            doc.save()
-            frappe.db.commit()
+        removed = dedupe_recorded_queries()
+        frappe.db.commit()
+        click.secho(f"Removed {removed:,} duplicate MariaDB Query records", fg="green")
 
 
 @click.command("show-toolbox-indexes")
@@ -176,6 +171,7 @@ def drop_toolbox_indexes(context, dry_run: bool = False):
 @click.option("--sql-occurrence", help="Minimum occurrence as qualifier for optimization", type=int)
 @click.option("--skip-backtest", is_flag=True, help="Skip backtesting the query")
 @click.option("--verbose", is_flag=True, help="Increase verbosity of output")
+@click.option("--processes", help="Worker processes used to generate index candidates", type=int)
 @pass_context
 def optimize_indexes(
     context,
@@ -183,6 +179,7 @@ def optimize_indexes(
     table_name: str = None,
     skip_backtest: bool = False,
     verbose: bool = False,
+    processes: int | None = None,
 ):
     import frappe
 
@@ -195,10 +192,33 @@ def optimize_indexes(
             sql_occurrence=sql_occurrence,
             skip_backtest=skip_backtest,
             verbose=verbose,
+            processes=processes,
         )
         frappe.db.commit()
 
 
+@click.command("benchmark-parser")
+@click.option("--limit", help="Number of recorded queries to benchmark", type=int, default=1000)
+@pass_context
+def benchmark_parser(context, limit: int = 1000):
+    import frappe
+
+    from toolbox.index_manager import benchmark_where_scanner
+
+    with frappe.init_site(get_site(context)):
+        frappe.connect()
+        result = benchmark_where_scanner(limit=limit)
+
+    queries, scanned = result["queries"], result["scanned"]
+    click.echo(f"Queries: {queries:,}, scanned without sqlparse: {scanned:,}")
+    click.echo(f"sqlparse: {result['sqlparse_time']:.3f}s")
+    click.echo(f"scanner (with sqlparse fallback): {result['scanner_time']:.3f}s")
+    if result["scanner_time"]:
+        click.echo(f"Speed-up: {result['sqlparse_time'] / result['scanner_time']:.1f}x")
+    if result["mismatched"]:
+        click.secho(f"{result['mismatched']:,} scanned queries differ from sqlparse", fg="red")
+
+
 @click.command("trace")
 @click.argument("status", type=click.Choice(["on", "off", "status", "purge", "draw"]))
 @click.option("--doctypes", "-d", "doctype_names", help="Add DocTypes to trace list")
@@ -234,6 +254,7 @@ sql_recorder_cli.add_command(drop_recording)
 index_manager_cli.add_command(show_toolbox_indexes)
 index_manager_cli.add_command(drop_toolbox_indexes)
 index_manager_cli.add_command(optimize_indexes)
+index_manager_cli.add_command(benchmark_parser)
 
 sql_manager_cli.add_command(process_metadata)
 sql_manager_cli.add_command(cleanup_metadata)
@@ -13,7 +13,7 @@ before_request = ["toolbox.sql_recorder.before_hook"]
 after_request = ["toolbox.sql_recorder.after_hook", "toolbox.doctype_flow.dump"]
 
 before_job = ["toolbox.sql_recorder.before_hook"]
-after_job = ["toolbox.sql_recorder.after_hook", "toolbox.doctype_flow.dump"]
+after_job = ["toolbox.sql_recorder.after_job_hook", "toolbox.doctype_flow.dump"]
 
 after_migrate = ["toolbox.overrides.after_migrate"]
 
@@ -1,10 +1,30 @@
 from collections import defaultdict
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from itertools import groupby
+from multiprocessing import get_context
+from time import perf_counter
 
 import frappe
+from frappe.utils import cint, flt
+from sqlparse.sql import Where
 
+import toolbox
 from toolbox.doctypes import MariaDBIndex
-from toolbox.utils import Query, QueryBenchmark, Table, get_table_id
+from toolbox.utils import (
+    BENCHMARK_MIN_IMPROVEMENT,
+    BENCHMARK_RUNS,
+    IndexCandidate,
+    IndexCandidateType,
+    Query,
+    QueryBenchmark,
+    Table,
+    WhatIfAnalysis,
+    get_table_id,
+    iter_where_clause_items,
+    save_parse_caches,
+    scan_where_clause,
+)
 
 
 def process_index_manager(
@@ -12,6 +32,7 @@ def process_index_manager(
     sql_occurrence: int = 0,
     skip_backtest: bool = False,
     verbose: bool = False,
+    processes: int | None = None,
 ):
     # optimization algorithm v1:
     # 1. Check if the tables involved are scanning entire tables (type: ALL[Worst case] and similar)
@@ -23,9 +44,6 @@ def process_index_manager(
     # parameterized queries and occurrences
     ok_types = ["ALL", "index", "range", "ref", "eq_ref", "fulltext", "ref_or_null"]
     table_grouper = lambda q: q.table  # noqa: E731
-    sql_qualifier = (
-        (lambda q: q.occurrence > sql_occurrence) if sql_occurrence else None
-    )  # noqa: E731
     filter_map = [
         ["MariaDB Query Explain", "type", "in", ok_types],
         ["MariaDB Query Explain", "parenttype", "=", "MariaDB Query"],
@@ -36,11 +54,26 @@ def process_index_manager(
     recorded_queries = frappe.get_all(
         "MariaDB Query",
         filters=filter_map,
-        fields=["query", "parameterized_query", "query_explain.table", "occurrence"],
+        fields=[
+            "name",
+            "query",
+            "parameterized_query",
+            "parse_cache",
+            "parameter_samples",
+            "query_explain.table",
+            "query_explain.rows",
+            "query_explain.filtered",
+            "occurrence",
+            "total_time",
+        ],
         order_by=None,
         distinct=True,
     )
     recorded_queries = sorted(recorded_queries, key=table_grouper)  # required for groupby to work
+    # a query is analyzed for every table it reads, share its parse cache across them
+    parse_caches = {}
+
+    tables = []
 
     for table_id, _queries in groupby(recorded_queries, key=table_grouper):
         table = Table(id=table_id)
@@ -53,17 +86,51 @@ def process_index_manager(
         # combine occurrences from parameterized query candidates
         _qrys = list(_queries)
         _query_candidates = defaultdict(lambda: defaultdict(int))
+        # a record has a row per EXPLAIN row of the table, count its occurrences once
+        counted = set()
 
         for q in _qrys:
             reduced_key = q.parameterized_query or q.query
             _query_candidates[reduced_key]["sql"] = q.query
-            _query_candidates[reduced_key]["occurrence"] += q.occurrence
+            _query_candidates[reduced_key]["name"] = q.name
+            _query_candidates[reduced_key]["parse_cache"] = parse_caches.setdefault(
+                q.name, frappe.parse_json(q.parse_cache or "{}")
+            )
+            # the recorded query is a sample with placeholders filled with 1, benchmarks re-render
+            # the parameterized query with recorded values
+            _query_candidates[reduced_key]["parameterized_sql"] = q.parameterized_query
+            _query_candidates[reduced_key]["parameter_samples"] = q.parameter_samples
+            _query_candidates[reduced_key]["rows_examined"] += q.rows or 0
+            _query_candidates[reduced_key]["rows_filtered"] += (
+                (q.rows or 0) * (q.filtered or 0) / 100
+            )
+
+            if q.name not in counted:
+                counted.add(q.name)
+                _query_candidates[reduced_key]["occurrence"] += q.occurrence
+                _query_candidates[reduced_key]["total_time"] += q.total_time or 0
 
-        query_candidates = [Query(**q, table=table) for q in _query_candidates.values()]
+        # most frequent first - the query kept for candidates shared by several queries
+        query_candidates = sorted(
+            (Query(**q, table=table) for q in _query_candidates.values()),
+            key=lambda q: q.occurrence,
+            reverse=True,
+        )
+        tables.append((table, query_candidates))
         del _query_candidates
 
-        # generate index candidates from the query candidates, qualify them
-        index_candidates = table.find_index_candidates(query_candidates, qualifier=sql_qualifier)
+    # generate index candidates from the query candidates, qualify them
+    # parsing is CPU bound & spread over worker processes, DDL & benchmarks run on this connection
+    processes = processes or cint(toolbox.get_settings("index_manager_processes")) or 1
+    what_if_min_rows = cint(toolbox.get_settings("what_if_min_rows"))
+    index_write_cost = flt(toolbox.get_settings("index_write_cost"))
+
+    ranked_index_candidates = []
+
+    for table, query_candidates, index_candidates in iter_index_candidates(
+        tables, sql_occurrence, processes
+    ):
+        save_parse_caches(query_candidates)
         qualified_index_candidates = table.qualify_index_candidates(index_candidates)
 
         if not qualified_index_candidates:
@@ -71,6 +138,57 @@ def process_index_manager(
                 frappe.logger("toolbox").debug(f"No qualified index candidates for {table.name}")
             continue
 
+        # building & backtesting indexes on big tables is expensive, predict their gains on a
+        # sampled copy first & only keep the candidates the optimizer would use to read less
+        if what_if_min_rows and table.get_row_count() >= what_if_min_rows:
+            with WhatIfAnalysis(table, qualified_index_candidates, verbose=verbose) as what_if:
+                qualified_index_candidates = what_if.get_helpful_index_candidates()
+
+            if not qualified_index_candidates:
+                if verbose:
+                    frappe.logger("toolbox").debug(f"No helpful index candidates for {table.name}")
+                continue
+
+        table.score_index_candidates(qualified_index_candidates)
+
+        # indexes are maintained on every write, drop candidates on write heavy tables that don't
+        # save more rows than their upkeep costs
+        if index_write_cost:
+            qualified_index_candidates = table.weigh_write_cost(
+                qualified_index_candidates, index_write_cost
+            )
+
+            if not qualified_index_candidates:
+                if verbose:
+                    frappe.logger("toolbox").debug(
+                        f"No index candidates outweigh the write overhead of {table.name}"
+                    )
+                continue
+
+        ranked_index_candidates.extend((table, ic) for ic in qualified_index_candidates)
+
+    # spend the index budget on the candidates expected to save the most rows, across tables
+    ranked_index_candidates.sort(
+        key=lambda x: (x[1].score or 0, x[1].query.total_time), reverse=True
+    )
+    if max_index_size := cint(toolbox.get_settings("max_index_size_per_table")):
+        ranked_index_candidates = apply_index_size_budget(
+            ranked_index_candidates, max_index_size * 1024 * 1024, verbose=verbose
+        )
+    if max_indexes := cint(toolbox.get_settings("max_indexes_per_run")):
+        ranked_index_candidates = ranked_index_candidates[:max_indexes]
+
+    benchmark_runs = cint(toolbox.get_settings("benchmark_runs")) or BENCHMARK_RUNS
+    benchmark_min_improvement = (
+        flt(toolbox.get_settings("benchmark_min_improvement") or BENCHMARK_MIN_IMPROVEMENT * 100)
+        / 100
+    )
+
+    selected_index_candidates = defaultdict(list)
+    for table, ic in ranked_index_candidates:
+        selected_index_candidates[table].append(ic)
+
+    for table, qualified_index_candidates in selected_index_candidates.items():
         # Generate indexes from qualified index candidates, test gains
         if skip_backtest:
             failed_ics = MariaDBIndex.create(
@@ -78,9 +196,18 @@ def process_index_manager(
             )
             continue
 
-        with QueryBenchmark(index_candidates=qualified_index_candidates, verbose=verbose) as qbm:
+        # benchmarks on a busy server are noise, leave the table for the next run
+        if not MariaDBIndex.wait_for_ddl_window(table.name):
+            continue
+
+        with QueryBenchmark(
+            index_candidates=qualified_index_candidates,
+            verbose=verbose,
+            runs=benchmark_runs,
+            min_improvement=benchmark_min_improvement,
+        ) as qbm:
             failed_ics = MariaDBIndex.create(
-                table.name, qualified_index_candidates, verbose=verbose
+                table.name, qualified_index_candidates, verbose=verbose, throttle=False
             )
 
         # Drop indexes that don't improve query metrics
@@ -90,6 +217,7 @@ def process_index_manager(
             if qualified_index_candidates[q_id] not in failed_ics
         ]
         MariaDBIndex.drop(table.name, redundant_indexes, verbose=verbose)
+        qbm.save_results(failed_ics)
 
         total_indexes_created = len(qualified_index_candidates) - len(failed_ics)
         total_indexes_dropped = len(redundant_indexes)
@@ -99,3 +227,155 @@ def process_index_manager(
             logger.info(f"Optimized {table.name}")
             logger.info(f"Indexes created: {total_indexes_created}")
             logger.info(f"Indexes dropped: {total_indexes_dropped}")
+
+
+def apply_index_size_budget(
+    ranked_index_candidates: list[tuple[Table, IndexCandidate]],
+    max_index_size: int,
+    verbose: bool = False,
+) -> list[tuple[Table, IndexCandidate]]:
+    """Drop candidates that would grow their table's indexes past `max_index_size` bytes, spending
+    each table's remaining budget on its best ranked candidates first.
+    """
+    budgets = {}
+    within_budget = []
+
+    for table, ic in ranked_index_candidates:
+        if table not in budgets:
+            budgets[table] = max_index_size - table.get_index_length()
+
+        index_size = table.estimate_index_size(ic)
+        if index_size > budgets[table]:
+            if verbose:
+                frappe.logger("toolbox").debug(
+                    f"Skipping {ic} on {table.name} - needs {index_size:,} bytes, "
+                    f"{max(budgets[table], 0):,} left in its index budget"
+                )
+            continue
+
+        budgets[table] -= index_size
+        within_budget.append((table, ic))
+
+    return within_budget
+
+
+def iter_index_candidates(
+    tables: list[tuple[Table, list[Query]]], sql_occurrence: int = 0, processes: int = 1
+) -> Iterator[tuple[Table, list[Query], list[IndexCandidate]]]:
+    """Yield the index candidates of each table's queries, in order. Index candidates of already
+    analyzed queries are read from their parse cache, the rest are generated in `processes` worker
+    processes - tables are handed out as they complete so the caller's DDL overlaps with parsing.
+    """
+    if processes <= 1 or len(tables) <= 1:
+        sql_qualifier = get_sql_qualifier(sql_occurrence)
+        for table, query_candidates in tables:
+            yield table, query_candidates, table.find_index_candidates(
+                query_candidates, qualifier=sql_qualifier
+            )
+        return
+
+    # spawned workers don't inherit the database connection or the recorder's threads
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn")) as executor:
+        results = executor.map(
+            generate_index_candidates,
+            [table.name for table, _ in tables],
+            [[get_query_payload(q) for q in query_candidates] for _, query_candidates in tables],
+            [sql_occurrence] * len(tables),
+        )
+
+        for (table, query_candidates), (candidates, cache_entries) in zip(tables, results):
+            for idx, entries in cache_entries.items():
+                query_candidates[idx].set_parse_cache_entries(table.name, entries)
+
+            index_candidates = []
+            for idx, type, columns, ctx in candidates:
+                index_candidate = IndexCandidate(
+                    query=query_candidates[idx], type=IndexCandidateType[type], ctx=ctx
+                )
+                index_candidate.extend(columns)
+                index_candidates.append(index_candidate)
+
+            yield table, query_candidates, index_candidates
+
+
+def generate_index_candidates(
+    table_name: str, queries: list[dict], sql_occurrence: int = 0
+) -> tuple[list[tuple], dict[int, list[dict]]]:
+    """Generate index candidates for `table_name` from query payloads, without database access.
+
+    Returns the candidates as (query index, type, columns, ctx) tuples & the parse cache entries
+    of the queries that had to be parsed, keyed by query index.
+    """
+    table = Table(id=None, name=table_name)
+    query_candidates = [Query(**q, table=table) for q in queries]
+    index_candidates = table.find_index_candidates(
+        query_candidates, qualifier=get_sql_qualifier(sql_occurrence)
+    )
+    query_index = {id(query): idx for idx, query in enumerate(query_candidates)}
+
+    return (
+        [(query_index[id(ic.query)], ic.type.name, list(ic), ic.ctx) for ic in index_candidates],
+        {
+            idx: query.parse_cache["tables"][table_name]
+            for idx, query in enumerate(query_candidates)
+            if query.parse_cache_updated
+        },
+    )
+
+
+def get_sql_qualifier(sql_occurrence: int = 0) -> Callable[[Query], bool] | None:
+    if sql_occurrence:
+        return lambda q: q.occurrence > sql_occurrence
+
+
+def get_query_payload(query: Query) -> dict:
+    return {
+        "sql": query.sql,
+        "occurrence": query.occurrence,
+        "name": query.name,
+        "parse_cache": query.parse_cache,
+    }
+
+
+def benchmark_where_scanner(limit: int | None = None) -> dict:
+    """Time extracting the WHERE clauses of recorded queries with sqlparse against
+    `scan_where_clause`, which falls back to sqlparse for the queries it can't scan.
+    """
+    queries = frappe.get_all(
+        "MariaDB Query", pluck="query", order_by="occurrence desc", limit=limit
+    )
+    result = {
+        "queries": len(queries),
+        "scanned": 0,
+        "mismatched": 0,
+        "sqlparse_time": 0.0,
+        "scanner_time": 0.0,
+    }
+
+    for sql in queries:
+        start = perf_counter()
+        query = Query(sql)
+        try:
+            expected = (
+                list(iter_where_clause_items(query.parsed))
+                if any(isinstance(token, Where) for token in query.parsed)
+                else None
+            )
+        except Exception:
+            expected = None
+        parse_time = perf_counter() - start
+
+        start = perf_counter()
+        scanned = scan_where_clause(query.sql)
+        scan_time = perf_counter() - start
+
+        result["sqlparse_time"] += parse_time
+        if scanned is None:
+            result["scanner_time"] += scan_time + parse_time
+            continue
+
+        result["scanner_time"] += scan_time
+        result["scanned"] += 1
+        result["mismatched"] += scanned != expected
+
+    return result
@@ -0,0 +1,6 @@
+from toolbox.utils import dedupe_recorded_queries
+
+
+def execute():
+    # query_hash is unique, duplicates recorded before it existed have to go first
+    dedupe_recorded_queries()
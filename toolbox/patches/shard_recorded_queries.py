@@ -0,0 +1,32 @@
+import frappe
+
+from toolbox.sql_recorder import (
+    TOOLBOX_RECORDER_CHUNK_SIZE,
+    TOOLBOX_RECORDER_DATA,
+    get_query_data_key,
+)
+
+
+def execute():
+    # occurrences recorded before they were sharded sit in a single hash that processing no longer
+    # reads - fold them into their shards, deleting each batch as it's moved so a rerun can't
+    # count it twice
+    c = frappe.cache
+    legacy_key = c.make_key(TOOLBOX_RECORDER_DATA)
+
+    if not c.execute_command("EXISTS", legacy_key):
+        return
+
+    cursor = 0
+    while True:
+        cursor, records = c.hscan(legacy_key, cursor, count=TOOLBOX_RECORDER_CHUNK_SIZE)
+        if records:
+            pipe = c.pipeline()
+            for query, occurrence in records.items():
+                pipe.hincrby(
+                    c.make_key(get_query_data_key(query.decode())), query, int(occurrence)
+                )
+            pipe.hdel(legacy_key, *records)
+            pipe.execute()
+        if not cursor:
+            break
@@ -1,29 +1,172 @@
+import atexit
 import inspect
+import json
+import os
+import pickle
 from collections import Counter
+from collections.abc import Iterable, Iterator
 from contextlib import suppress
-from re import compile
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from functools import lru_cache
+from hashlib import sha1
+from math import log, sqrt
+from queue import Empty, Full, Queue
+from random import random, randrange, sample
+from re import IGNORECASE, VERBOSE, compile
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep
 
 import frappe
 
 import toolbox
 
 TRACEBACK_PATH_PATTERN = compile(".*/apps/")
+FINGERPRINT_PATTERN = compile(
+    r"""
+    (?P<identifier>`(?:[^`]|``)*`)
+    |(?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<number>(?<![\w$.%])(?:0x[0-9a-fA-F]+|\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)(?![\w$]))
+    |(?P<comment>\s*(?:--(?=\s)[^\n]*|\#[^\n]*|/\*[\s\S]*?\*/)\s*)
+    |(?P<whitespace>\s+)
+    """,
+    VERBOSE,
+)
+IN_LIST_PATTERN = compile(r"\bIN\s*\(\s*%s(?:\s*,\s*%s)+\s*\)", IGNORECASE)
+VALUES_LIST_PATTERN = compile(r"\bVALUES\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))+", IGNORECASE)
 TOOLBOX_RECORDER_FLAG = "toolbox-sql_recorder-enabled"
 TOOLBOX_RECORDER_DATA = "toolbox-sql_recorder-records"
+TOOLBOX_RECORDER_STATS = "toolbox-sql_recorder-stats"
+TOOLBOX_RECORDER_DROPPED = "toolbox-sql_recorder-dropped"
+TOOLBOX_RECORDER_PROCESSING = "toolbox-sql_recorder-processing"
+TOOLBOX_RECORDER_CHUNKS = f"{TOOLBOX_RECORDER_PROCESSING}:chunks"
+
+# recorded occurrences are spread over this many hashes by query digest, so no single hash grows
+# huge & processing can move them out of the way one shard at a time
+TOOLBOX_RECORDER_SHARDS = 16
+# recorded queries processed & committed together, bounding memory while processing
+TOOLBOX_RECORDER_CHUNK_SIZE = 1000
+
+# latency histogram: bucket 0 holds everything under HISTOGRAM_MIN_TIME ms, bucket i holds
+# [HISTOGRAM_MIN_TIME * HISTOGRAM_GROWTH ** (i - 1), HISTOGRAM_MIN_TIME * HISTOGRAM_GROWTH ** i)
+# & the last bucket holds everything slower than ~6 minutes
+HISTOGRAM_MIN_TIME = 0.01
+HISTOGRAM_GROWTH = 1.25
+HISTOGRAM_BUCKETS = 80
+HISTOGRAM_FIELD_PREFIX = "h"
+
+# distinct query shapes a recorder holds before it flushes to Redis mid-request / mid-job, so a
+# long running job's memory stays flat however many queries it runs
+TOOLBOX_RECORDER_MAX_QUERIES = 1000
+
+# recorder dumps are handed to a background thread that writes them to Redis every
+# TOOLBOX_RECORDER_FLUSH_INTERVAL seconds; dumps that don't fit in the queue are dropped & counted
+TOOLBOX_RECORDER_FLUSH_INTERVAL = 1.0
+TOOLBOX_RECORDER_QUEUE_SIZE = 1000
+
+# parameter values of up to PARAMETER_SAMPLES executions are kept per query (reservoir sampled),
+# under the p0..pN fields of its stats hash; strings are cut at PARAMETER_MAX_LENGTH characters
+# (the length of Data fields) & lists at PARAMETER_MAX_ITEMS values. Only SELECTs are sampled, as
+# only their samples are ever run with recorded values
+PARAMETER_SAMPLES = 5
+PARAMETER_MAX_LENGTH = 140
+PARAMETER_MAX_ITEMS = 10
+PARAMETER_FIELD_PREFIX = "p"
+PARAMETERS_SEEN_FIELD = "params_seen"
+
+# seconds a worker trusts its own copy of TOOLBOX_RECORDER_FLAG before asking Redis again
+TOOLBOX_RECORDER_FLAG_TTL = 10
+
+_LOG_HISTOGRAM_GROWTH = log(HISTOGRAM_GROWTH)
+
+# site -> (expires at, enabled, sample rate, parameter samples); lives for the lifetime of the
+# gunicorn worker. RQ forks a work-horse per job from a parent that never records, so every job
+# starts with an empty cache & makes one Redis GET for TOOLBOX_RECORDER_FLAG - which carries the
+# recorder's settings once enabled, sparing jobs the settings lookup
+_recorder_flag_cache: dict[str, tuple[float, bool, float, str]] = {}
+
+_flusher: "RecorderFlusher | None" = None
 
 
 def sql(*args, **kwargs):
     # impl 1: store most context - gets slowerer to process & adds more overhead to each request
     # impl 2 note: using args[0] to capture only the parameterized query
 
-    # NOTE: this is not a complete solution, as it does not capture the values of the parameters
-    # TODO: evaluate a solution that captures the values so we can generate better Query.get_sample
+    # parameter values are handed over too, a few of them are sampled per SELECT for Query.get_sample
 
+    start = perf_counter()
     result = frappe.local.db_sql(*args, **kwargs)
-    frappe.local.toolbox_recorder.register(args[0])
+    duration = (perf_counter() - start) * 1000
+
+    rowcount = getattr(getattr(frappe.db, "_cursor", None), "rowcount", 0) or 0
+    values = args[1] if len(args) > 1 else kwargs.get("values")
+    frappe.local.toolbox_recorder.register(args[0], duration, max(rowcount, 0), values)
     return result
 
 
+def _fingerprint_token(match) -> str:
+    match match.lastgroup:
+        case "identifier":
+            return match.group()
+        case "comment" | "whitespace":
+            return " "
+        case _:
+            return "%s"
+
+
+@lru_cache(maxsize=4096)
+def fingerprint_query(query: str) -> str:
+    """Reduce a query to its shape, similar to pt-fingerprint.
+
+    String & number literals are replaced with %s placeholders, IN (...) & multi-row VALUES lists
+    are collapsed & whitespace is normalized, so queries built with inlined values are recorded
+    once per shape. Backtick-quoted identifiers are left untouched.
+    """
+    fingerprint = FINGERPRINT_PATTERN.sub(_fingerprint_token, query).strip()
+    fingerprint = IN_LIST_PATTERN.sub("IN (%s)", fingerprint)
+    return VALUES_LIST_PATTERN.sub(r"VALUES \1", fingerprint)
+
+
+def _get_sample_value(value, hash_values: bool = False):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_get_sample_value(v, hash_values) for v in value[:PARAMETER_MAX_ITEMS]]
+    if isinstance(value, (bytes, bytearray)):
+        raise TypeError("binary values aren't sampled")
+    if isinstance(value, (str, datetime, date, time, timedelta, Decimal)):
+        value = str(value)[:PARAMETER_MAX_LENGTH]
+        # hashes are kept apart from values, so samples never put them in a query
+        return {"sha1": sha1(value.encode()).hexdigest()[:16]} if hash_values else value
+    raise TypeError(f"{type(value)} values aren't sampled")
+
+
+def get_parameter_sample(query: str, fingerprint: str, values, hash_values: bool = False):
+    """JSON encoded parameter values of one execution of `query`, or None if they don't line up
+    with the placeholders of its fingerprint - like when literals were inlined in the query.
+
+    Values are capped in size & strings are hashed with `hash_values`, for privacy - hashed
+    strings are stored as {"sha1": hash}.
+    """
+    try:
+        if isinstance(values, dict):
+            params = {
+                key: _get_sample_value(value, hash_values)
+                for key, value in values.items()
+                if f"%({key})s" in fingerprint
+            }
+        elif isinstance(values, (list, tuple)):
+            if not (len(values) == query.count("%s") == fingerprint.count("%s")):
+                return None
+            params = [_get_sample_value(value, hash_values) for value in values]
+        else:
+            return None
+    except TypeError:
+        return None
+
+    return json.dumps(params, separators=(",", ":")) if params else None
+
+
 def _patch():
     frappe.local.db_sql = frappe.db.sql
     frappe.db.sql = sql
@@ -33,26 +176,100 @@ def _unpatch():
     frappe.db.sql = frappe.local.db_sql
 
 
+def _get_recorder_state() -> tuple[bool, float, str]:
+    """Get whether the SQL Recorder is enabled for the current site, its sample rate & whether
+    parameter values are sampled ("Off", "Values" or "Hashed Values").
+
+    The state is cached in the worker process for TOOLBOX_RECORDER_FLAG_TTL seconds, so requests
+    don't make a Redis round trip just to find out that recording is off. Toggling the flag
+    reaches every worker once its cached copy expires.
+
+    An enabled flag is replaced with [True, sample rate, parameter samples] the first time it's
+    read, so processes starting cold - like RQ work-horses - resolve the state with a single GET.
+    The flag is only replaced if it still holds the value that was read, so a toggle or `stop`
+    racing with the read isn't undone. Saving ToolBox Settings resets the flag, & with it the
+    settings it carries.
+    """
+    site = frappe.local.site
+    now = monotonic()
+
+    if (cached := _recorder_flag_cache.get(site)) and cached[0] > now:
+        return cached[1], cached[2], cached[3]
+
+    toolbox_recorder_enabled = flag = frappe.cache.get_value(TOOLBOX_RECORDER_FLAG)
+
+    if isinstance(toolbox_recorder_enabled, (list, tuple)):
+        toolbox_recorder_enabled, sample_rate, parameter_samples = toolbox_recorder_enabled
+    else:
+        if toolbox_recorder_enabled is None:
+            toolbox_recorder_enabled = flag = toolbox.get_settings("is_index_manager_enabled")
+            frappe.cache.set_value(TOOLBOX_RECORDER_FLAG, toolbox_recorder_enabled)
+
+        toolbox_recorder_enabled = bool(toolbox_recorder_enabled)
+        sample_rate = 100.0
+        parameter_samples = "Off"
+
+        if toolbox_recorder_enabled:
+            # unset rate means record everything, 0 records nothing
+            sample_rate = toolbox.get_settings("sql_recorder_sample_rate")
+            sample_rate = 100.0 if sample_rate is None else float(sample_rate)
+            sample_rate = min(max(sample_rate, 0.0), 100.0)
+            parameter_samples = toolbox.get_settings("sql_recorder_parameter_samples") or "Off"
+            c = frappe.cache
+            c.eval(
+                REPLACE_FLAG_SCRIPT,
+                1,
+                c.make_key(TOOLBOX_RECORDER_FLAG),
+                pickle.dumps(flag),
+                pickle.dumps([True, sample_rate, parameter_samples]),
+            )
+
+    _recorder_flag_cache[site] = (
+        now + TOOLBOX_RECORDER_FLAG_TTL,
+        toolbox_recorder_enabled,
+        sample_rate,
+        parameter_samples,
+    )
+    return toolbox_recorder_enabled, sample_rate, parameter_samples
+
+
+def is_recorder_enabled() -> bool:
+    return _get_recorder_state()[0]
+
+
+def clear_recorder_flag_cache():
+    _recorder_flag_cache.pop(frappe.local.site, None)
+
+
 def before_hook(*args, **kwargs):
-    toolbox_recorder_enabled = frappe.cache.get_value(TOOLBOX_RECORDER_FLAG)
+    enabled, sample_rate, parameter_samples = _get_recorder_state()
 
-    if toolbox_recorder_enabled is None:
-        toolbox_recorder_enabled = toolbox.get_settings("is_index_manager_enabled")
-        frappe.cache.set_value(TOOLBOX_RECORDER_FLAG, toolbox_recorder_enabled)
+    if not enabled:
+        return
 
-    if toolbox_recorder_enabled:
-        frappe.local.toolbox_recorder = SQLRecorder()
-        _patch()
+    # sample whole requests & jobs so that a request's queries are recorded together
+    if sample_rate < 100 and random() * 100 >= sample_rate:
+        return
+
+    frappe.local.toolbox_recorder = SQLRecorder(
+        sample_rate=sample_rate, parameter_samples=parameter_samples
+    )
+    _patch()
 
 
 def after_hook(*args, **kwargs):
-    if hasattr(frappe.local, "toolbox_recorder") and frappe.cache.get_value(
-        TOOLBOX_RECORDER_FLAG
-    ):
+    if hasattr(frappe.local, "toolbox_recorder") and is_recorder_enabled():
         frappe.local.toolbox_recorder.dump()
         _unpatch()
 
 
+def after_job_hook(*args, **kwargs):
+    after_hook(*args, **kwargs)
+    # RQ work-horses leave with os._exit, skipping atexit - nobody waits on a job's response, so
+    # write this job's queries before the process goes away
+    flush_recorder()
+
+
 def get_current_stack_frames():
     BLACKLIST_FILENAME = {
         "frappe/frappe/app.py",
@@ -73,24 +290,464 @@ def get_current_stack_frames():
                     }
 
 
-class SQLRecorder:
+def get_query_digest(query: str) -> str:
+    """First 16 bytes of the query's SHA-1, hex encoded - stored as MariaDB Query's query_hash."""
+    return sha1(query.encode()).hexdigest()[:32]
+
+
+def get_query_stats_key(query: str) -> str:
+    return f"{TOOLBOX_RECORDER_STATS}:{get_query_digest(query)}"
+
+
+def get_query_shard(query: str) -> int:
+    return int(get_query_digest(query)[:8], 16) % TOOLBOX_RECORDER_SHARDS
+
+
+def get_shard_data_key(shard: int) -> str:
+    return f"{TOOLBOX_RECORDER_DATA}:{shard}"
+
+
+def get_query_data_key(query: str) -> str:
+    return get_shard_data_key(get_query_shard(query))
+
+
+def get_chunk_key(chunk_id: str) -> str:
+    return f"{TOOLBOX_RECORDER_PROCESSING}:chunk:{chunk_id}"
+
+
+def get_chunk_stats_key(chunk_id: str, query: str) -> str:
+    return f"{get_chunk_key(chunk_id)}:{get_query_digest(query)}"
+
+
+def iter_recorded_chunks() -> Iterator[tuple[str, dict[str, int]]]:
+    """Yield recorded {query: occurrence} in chunks of up to TOOLBOX_RECORDER_CHUNK_SIZE queries.
+
+    Each shard is RENAMEd out of the way first (O(1)), so workers keep writing into a fresh hash
+    while the renamed one is read with HSCAN instead of a blocking HGETALL. Every chunk is claimed
+    atomically - its occurrences & stats move under a chunk id - & stays in Redis until the caller
+    releases it with release_recorded_chunk. Chunks left claimed by an interrupted run are yielded
+    first, with the id they were claimed under.
+    """
+    c = frappe.cache
+    chunks_key = c.make_key(TOOLBOX_RECORDER_CHUNKS)
+
+    for chunk_id in c.execute_command("SMEMBERS", chunks_key):
+        chunk_id = chunk_id.decode()
+        records = c.execute_command("HGETALL", c.make_key(get_chunk_key(chunk_id)))
+        yield chunk_id, {k.decode(): int(v) for k, v in records.items()}
+
+    for shard in range(TOOLBOX_RECORDER_SHARDS):
+        data_key = c.make_key(get_shard_data_key(shard))
+        processing_key = c.make_key(f"{TOOLBOX_RECORDER_PROCESSING}:{shard}")
+
+        # RENAMENX is a no-op while the previous run's processing key is still around
+        if c.execute_command("EXISTS", data_key):
+            c.execute_command("RENAMENX", data_key, processing_key)
+
+        cursor = 0
+        while True:
+            cursor, records = c.hscan(processing_key, cursor, count=TOOLBOX_RECORDER_CHUNK_SIZE)
+            fields = list(records)
+            for i in range(0, len(fields), TOOLBOX_RECORDER_CHUNK_SIZE):
+                if chunk := _claim_chunk(
+                    processing_key, fields[i : i + TOOLBOX_RECORDER_CHUNK_SIZE]
+                ):
+                    yield chunk
+            if not cursor:
+                break
+
+
+def _claim_chunk(processing_key: str, fields: list[bytes]) -> tuple[str, dict[str, int]] | None:
+    c = frappe.cache
+    chunk_id = frappe.generate_hash(length=16)
+    queries = [field.decode() for field in fields]
+    keys = [
+        processing_key,
+        c.make_key(get_chunk_key(chunk_id)),
+        c.make_key(TOOLBOX_RECORDER_CHUNKS),
+        *(c.make_key(get_query_stats_key(query)) for query in queries),
+        *(c.make_key(get_chunk_stats_key(chunk_id, query)) for query in queries),
+    ]
+    claimed = c.eval(CLAIM_CHUNK_SCRIPT, len(keys), *keys, chunk_id, *fields)
+
+    if not claimed:
+        return None
+    return chunk_id, {k.decode(): int(v) for k, v in zip(claimed[::2], claimed[1::2])}
+
+
+def release_recorded_chunk(chunk_id: str, queries: Iterable[str]):
+    """Drop a chunk's data from Redis once it has been committed to the database."""
+    c = frappe.cache
+    pipe = c.pipeline()
+    pipe.execute_command(
+        "DEL",
+        c.make_key(get_chunk_key(chunk_id)),
+        *(c.make_key(get_chunk_stats_key(chunk_id, query)) for query in queries),
+    )
+    pipe.execute_command("SREM", c.make_key(TOOLBOX_RECORDER_CHUNKS), chunk_id)
+    pipe.execute()
+
+
+def get_histogram_bucket(duration: float) -> int:
+    if duration < HISTOGRAM_MIN_TIME:
+        return 0
+    bucket = int(log(duration / HISTOGRAM_MIN_TIME) / _LOG_HISTOGRAM_GROWTH) + 1
+    return min(bucket, HISTOGRAM_BUCKETS - 1)
+
+
+def get_histogram_percentile(histogram: dict[int, int], percentile: float) -> float | None:
+    """Estimate a latency percentile (ms) from bucket counts.
+
+    Returns the geometric midpoint of the bucket holding the requested rank, so estimates are off
+    by at most half a bucket's width (~12%).
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+
+    rank = total * percentile / 100
+    seen = 0
+
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            break
+
+    if bucket == 0:
+        return HISTOGRAM_MIN_TIME / 2
+    lower = HISTOGRAM_MIN_TIME * HISTOGRAM_GROWTH ** (bucket - 1)
+    return lower * sqrt(HISTOGRAM_GROWTH)
+
+
+def get_chunk_stats(chunk_id: str, queries: Iterable[str]) -> dict[str, dict]:
+    """Fetch the recorded execution stats for a claimed chunk's queries.
+
+    Latency histogram buckets are returned as {bucket: count} under the "histogram" key & sampled
+    parameter values, if any, as a list under the "params" key.
+    """
+    c = frappe.cache
+    queries = list(queries)
+    pipe = c.pipeline()
+
+    for query in queries:
+        pipe.execute_command("HGETALL", c.make_key(get_chunk_stats_key(chunk_id, query)))
+
+    results = pipe.execute()
+
+    query_stats = {}
+
+    for query, stats in zip(queries, results):
+        if not stats:
+            continue
+
+        query_stats[query] = {"histogram": {}}
+        for field, value in stats.items():
+            field = field.decode()
+            if field.startswith(HISTOGRAM_FIELD_PREFIX):
+                query_stats[query]["histogram"][int(field[1:])] = int(value)
+            elif field.startswith(PARAMETER_FIELD_PREFIX) and field[1:].isdigit():
+                query_stats[query].setdefault("params", []).append(json.loads(value))
+            elif field != PARAMETERS_SEEN_FIELD:
+                query_stats[query][field] = float(value)
+
+    return query_stats
+
+
+# move a chunk of fields from a drained shard (KEYS[1]) into its own hash (KEYS[2]) along with each
+# query's stats hash, & remember the chunk id (ARGV[1]) in KEYS[3] until the chunk is released
+CLAIM_CHUNK_SCRIPT = """
+local n = #ARGV - 1
+local claimed = {}
+for i = 1, n do
+    local field = ARGV[i + 1]
+    local occurrence = redis.call("HGET", KEYS[1], field)
+    if occurrence then
+        redis.call("HSET", KEYS[2], field, occurrence)
+        redis.call("HDEL", KEYS[1], field)
+        if redis.call("EXISTS", KEYS[3 + i]) == 1 then
+            redis.call("RENAME", KEYS[3 + i], KEYS[3 + n + i])
+        end
+        table.insert(claimed, field)
+        table.insert(claimed, occurrence)
+    end
+end
+if #claimed > 0 then
+    redis.call("SADD", KEYS[3], ARGV[1])
+end
+return claimed
+"""
+
+# set KEYS[1] to ARGV[2] if it still holds ARGV[1] - values are pickled like frappe.cache.set_value
+REPLACE_FLAG_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("SET", KEYS[1], ARGV[2])
+end
+"""
+
+# keep the fastest & slowest execution per query - HINCRBY can't do this for us
+UPDATE_EXTREMES_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    local min_time = tonumber(ARGV[2 * i - 1])
+    local max_time = tonumber(ARGV[2 * i])
+    local current = tonumber(redis.call("HGET", key, "min_time"))
+    if not current or min_time < current then
+        redis.call("HSET", key, "min_time", ARGV[2 * i - 1])
+    end
+    current = tonumber(redis.call("HGET", key, "max_time"))
+    if not current or max_time > current then
+        redis.call("HSET", key, "max_time", ARGV[2 * i])
+    end
+end
+"""
+
+
+# reservoir sample the parameter values (ARGV[3], ARGV[5], ...) offered for a query into the
+# p0..p{ARGV[1] - 1} fields of its stats hash (KEYS[1]); ARGV[2], ARGV[4], ... are random floats in
+# [0, 1) as scripts are better off not generating their own
+SAMPLE_PARAMETERS_SCRIPT = """
+local size = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local seen = redis.call("HINCRBY", KEYS[1], "params_seen", 1)
+    local slot = seen - 1
+    if seen > size then
+        slot = math.floor(tonumber(ARGV[i]) * seen)
+    end
+    if slot < size then
+        redis.call("HSET", KEYS[1], "p" .. slot, ARGV[i + 1])
+    end
+end
+"""
+
+
+class QueryStats:
+    """Occurrences, execution time (ms) & rows returned / affected by a query within a request."""
+
+    __slots__ = (
+        "count",
+        "total_time",
+        "total_time_squared",
+        "min_time",
+        "max_time",
+        "total_rows",
+        "histogram",
+        "params",
+        "params_seen",
+    )
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.total_time_squared = 0.0
+        self.min_time = float("inf")
+        self.max_time = 0.0
+        self.total_rows = 0
+        self.histogram: dict[int, int] = {}
+        # reservoir of JSON encoded parameter values, out of params_seen offered
+        self.params: list[str] = []
+        self.params_seen = 0
+
+    def add(self, duration: float, rows: int):
+        self.count += 1
+        self.total_time += duration
+        self.total_time_squared += duration * duration
+        self.total_rows += rows
+        bucket = get_histogram_bucket(duration)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        if duration < self.min_time:
+            self.min_time = duration
+        if duration > self.max_time:
+            self.max_time = duration
+
+    def get_parameter_slot(self) -> int | None:
+        """Reservoir slot (algorithm R) for the parameters of the latest execution, if sampled"""
+        self.params_seen += 1
+        if self.params_seen <= PARAMETER_SAMPLES:
+            return len(self.params)
+        slot = randrange(self.params_seen)
+        return slot if slot < PARAMETER_SAMPLES else None
+
+    def merge(self, other: "QueryStats", scale: float = 1.0):
+        self.count += other.count * scale
+        self.total_time += other.total_time * scale
+        self.total_time_squared += other.total_time_squared * scale
+        self.total_rows += other.total_rows * scale
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count * scale
+        if other.min_time < self.min_time:
+            self.min_time = other.min_time
+        if other.max_time > self.max_time:
+            self.max_time = other.max_time
+        if other.params:
+            self.params.extend(other.params)
+            if len(self.params) > PARAMETER_SAMPLES:
+                self.params = sample(self.params, PARAMETER_SAMPLES)
+        self.params_seen += other.params_seen
+
+
+def write_query_stats(pipe, pending: dict[str, tuple[str, str, QueryStats]]):
+    """Queue the increments for {stats key: (data key, query, stats)} on a Redis pipeline.
+
+    Keys must already be made with frappe.cache.make_key, so this can run without a site context.
+    """
+    stats_keys, extremes = [], []
+
+    for stats_key, (data_key, query, stats) in pending.items():
+        # HINCRBY creates missing fields, so new & known queries are written the same way
+        pipe.hincrby(data_key, query, round(stats.count))
+        pipe.hincrbyfloat(stats_key, "time", stats.total_time)
+        pipe.hincrbyfloat(stats_key, "time_sq", stats.total_time_squared)
+        pipe.hincrby(stats_key, "rows", round(stats.total_rows))
+        # buckets are plain counters, so concurrent flushes from many workers just add up
+        for bucket, count in stats.histogram.items():
+            pipe.hincrby(stats_key, f"{HISTOGRAM_FIELD_PREFIX}{bucket}", round(count))
+        stats_keys.append(stats_key)
+        extremes.extend((stats.min_time, stats.max_time))
+        if stats.params:
+            offered = [x for params in stats.params for x in (random(), params)]
+            pipe.eval(SAMPLE_PARAMETERS_SCRIPT, 1, stats_key, PARAMETER_SAMPLES, *offered)
+
+    if stats_keys:
+        pipe.eval(UPDATE_EXTREMES_SCRIPT, len(stats_keys), *stats_keys, *extremes)
+
+
+class RecorderFlusher:
+    """Per-process buffer that writes recorder dumps to Redis off the request path.
+
+    Dumps from many requests & jobs are merged in memory & written with a single pipeline every
+    TOOLBOX_RECORDER_FLUSH_INTERVAL seconds. When the queue is full, dumps are dropped & counted
+    under TOOLBOX_RECORDER_DROPPED instead of blocking the request.
+    """
+
     def __init__(self):
-        self.queries = []
+        self.pid = os.getpid()
+        self.queue: Queue[tuple[float, dict[str, tuple[str, str, QueryStats]]]] = Queue(
+            maxsize=TOOLBOX_RECORDER_QUEUE_SIZE
+        )
+        self.dropped: Counter[str] = Counter()
+        self.dropped_lock = Lock()
+        self.lock = Lock()
+        self.thread = Thread(target=self.run, name="toolbox-sql-recorder", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(
+        self, scale: float, pending: dict[str, tuple[str, str, QueryStats]], dropped_key: str
+    ):
+        try:
+            self.queue.put_nowait((scale, pending))
+        except Full:
+            with self.dropped_lock:
+                self.dropped[dropped_key] += 1
+
+    def run(self):
+        while True:
+            sleep(TOOLBOX_RECORDER_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                frappe.logger("toolbox").exception("Failed to flush SQL Recorder data")
+
+    def flush(self):
+        with self.lock:
+            merged: dict[str, tuple[str, str, QueryStats]] = {}
+
+            while True:
+                try:
+                    scale, pending = self.queue.get_nowait()
+                except Empty:
+                    break
+
+                for stats_key, (data_key, query, stats) in pending.items():
+                    if (entry := merged.get(stats_key)) is None:
+                        entry = merged[stats_key] = (data_key, query, QueryStats())
+                    entry[2].merge(stats, scale)
+
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, Counter()
+
+            if not merged and not dropped:
+                return
 
-    def register(self, query: str):
-        self.queries.append(query)
+            pipe = frappe.cache.pipeline(transaction=False)
+            write_query_stats(pipe, merged)
+            for dropped_key, count in dropped.items():
+                pipe.incrby(dropped_key, count)
+            pipe.execute()
+
+
+def get_recorder_flusher() -> RecorderFlusher:
+    global _flusher
+
+    # threads don't survive a fork - gunicorn & RQ children start their own flusher
+    if _flusher is None or _flusher.pid != os.getpid():
+        _flusher = RecorderFlusher()
+        _flusher.start()
+
+    return _flusher
+
+
+def flush_recorder():
+    """Write everything the current process has buffered to Redis."""
+    if _flusher is not None and _flusher.pid == os.getpid():
+        _flusher.flush()
+
+
+@atexit.register
+def _flush_at_exit():
+    # gunicorn workers & the RQ worker process go through atexit on a graceful shutdown
+    with suppress(Exception):
+        flush_recorder()
+
+
+class SQLRecorder:
+    def __init__(self, sample_rate: float = 100, parameter_samples: str = "Off"):
+        self.stats: dict[str, QueryStats] = {}
+        # occurrences are scaled up by the inverse of the sample rate when dumped
+        self.sample_rate = sample_rate
+        self.capture_parameters = parameter_samples in ("Values", "Hashed Values")
+        self.hash_parameters = parameter_samples == "Hashed Values"
+
+    def register(self, query: str, duration: float = 0.0, rows: int = 0, values=None):
+        fingerprint = fingerprint_query(query)
+
+        if (stats := self.stats.get(fingerprint)) is None:
+            if len(self.stats) >= TOOLBOX_RECORDER_MAX_QUERIES:
+                self.dump()
+            stats = self.stats[fingerprint] = QueryStats()
+        stats.add(duration, rows)
+
+        # values are only encoded for the executions the reservoir picks - of SELECTs, as writes
+        # carry passwords & other sensitive values & their samples never use them
+        if (
+            values
+            and self.capture_parameters
+            and fingerprint[:6].lower() == "select"
+            and (slot := stats.get_parameter_slot()) is not None
+        ):
+            params = get_parameter_sample(query, fingerprint, values, self.hash_parameters)
+            if params is not None and slot < len(stats.params):
+                stats.params[slot] = params
+            elif params is not None:
+                stats.params.append(params)
 
     def dump(self):
-        if not self.queries:
+        if not self.stats:
             return
 
         c = frappe.cache
-        key = c.make_key(TOOLBOX_RECORDER_DATA)
-        pipe = c.pipeline(transaction=False)
-
-        for query, occurrence in Counter(self.queries).items():
-            if not c.hsetnx(key, query, occurrence):
-                pipe.hincrby(key, query, occurrence)
+        # keys are made here as the flusher thread has no site context
+        pending = {
+            c.make_key(get_query_stats_key(query)): (
+                c.make_key(get_query_data_key(query)),
+                query,
+                stats,
+            )
+            for query, stats in self.stats.items()
+        }
 
-        pipe.execute()
-        self.queries = []
+        # occurrences are scaled back up so that sampled counts estimate the real traffic
+        get_recorder_flusher().submit(
+            100 / self.sample_rate, pending, c.make_key(TOOLBOX_RECORDER_DROPPED)
+        )
+        self.stats = {}
@@ -4,16 +4,24 @@
 import re
 from itertools import groupby
 from textwrap import dedent
+from time import monotonic, sleep
 
 import frappe
 from frappe.model.document import Document
+from frappe.utils import cint
 
+import toolbox
 from toolbox.utils import IndexCandidate
 
 VALID_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_ ]*$")
 
 TOOLBOX_INDEX_PREFIX = "toolbox_index_"
 
+# index DDL must not copy the table or block writes - MariaDB errors out if it can't comply
+ONLINE_DDL_OPTIONS = "ALGORITHM=INPLACE, LOCK=NONE"
+LOW_LOAD_POLL_INTERVAL = 5
+LOW_LOAD_WAIT_TIMEOUT = 600
+
 FIELD_ALIAS = {
     "name": "name",
     "owner": "owner",
@@ -64,6 +72,80 @@ def _validate_identifier(value: str, label: str = "identifier"):
         frappe.throw(f"Invalid {label}: {value}")
 
 
+def get_threads_running() -> int:
+    return cint(frappe.db.sql("SHOW GLOBAL STATUS LIKE 'Threads_running'")[0][1])
+
+
+def wait_for_low_load(max_threads_running: int, timeout: int = LOW_LOAD_WAIT_TIMEOUT) -> bool:
+    """Wait until at most `max_threads_running` threads are executing queries on the server.
+    Returns False if the server stays busy for `timeout` seconds.
+    """
+    deadline = monotonic() + timeout
+    while get_threads_running() > max_threads_running:
+        if monotonic() >= deadline:
+            return False
+        sleep(LOW_LOAD_POLL_INTERVAL)
+    return True
+
+
+def _wait_for_ddl_window(table: str) -> bool:
+    """Wait for a low-load window to alter `table` in, if Max Threads Running for DDL is set.
+    Returns False if the server stays too busy.
+    """
+    if (
+        max_threads_running := cint(toolbox.get_settings("index_ddl_max_threads_running"))
+    ) and not wait_for_low_load(max_threads_running):
+        frappe.logger("toolbox").warning(f"Server too busy to alter {table}")
+        return False
+    return True
+
+
+def _run_index_ddl(table: str, changes: list[str], verbose=False):
+    """Apply index `changes` (ADD / DROP INDEX clauses) to `table` in a single online ALTER TABLE,
+    giving up on metadata locks after the configured lock wait timeout.
+    """
+    wait = ""
+    if lock_wait_timeout := cint(toolbox.get_settings("index_ddl_lock_wait_timeout")):
+        wait = f" WAIT {lock_wait_timeout}"
+
+    frappe.db.sql_ddl(
+        f"ALTER TABLE `{table}`{wait} {', '.join(changes)}, {ONLINE_DDL_OPTIONS}", debug=verbose
+    )
+
+
+def _run_batched_index_ddl(
+    table: str, changes: list[tuple], verbose=False, throttle=False
+) -> list:
+    """Apply all `changes` - (key, clause) pairs - in one ALTER TABLE, so InnoDB builds the added
+    indexes in a single pass over the table. With `throttle`, a low-load window is waited for
+    first & all keys are returned as failed if the server stays busy.
+
+    If the batch fails, the clauses are retried one at a time & the keys of the ones that fail
+    are returned. Lock wait timeouts aren't the clauses' fault & are raised instead of retried.
+    """
+    if throttle and not _wait_for_ddl_window(table):
+        return [key for key, _ in changes]
+
+    if len(changes) > 1:
+        try:
+            _run_index_ddl(table, [c for _, c in changes], verbose=verbose)
+            return []
+        except Exception as e:
+            if frappe.db.is_timedout(e):
+                raise
+            frappe.logger("toolbox").warning(f"Batched index changes on {table} failed: {e}")
+
+    failures = []
+    for key, change in changes:
+        try:
+            _run_index_ddl(table, [change], verbose=verbose)
+        except Exception as e:
+            if frappe.db.is_timedout(e):
+                raise
+            failures.append(key)
+    return failures
+
+
 class MariaDBIndexDocument(Document):
     _table_fieldnames = {}
 
@@ -153,50 +235,48 @@ class MariaDBIndex(MariaDBIndexDocument):
 
         return table_indexes
 
+    @staticmethod
+    def wait_for_ddl_window(table) -> bool:
+        return _wait_for_ddl_window(table)
+
     @staticmethod
     def create(
-        table, index_candidates: list[IndexCandidate], verbose=False
+        table, index_candidates: list[IndexCandidate], verbose=False, throttle=True
     ) -> list[IndexCandidate]:
         _validate_identifier(table, "table name")
-        failures = []
+        changes = []
         for ic in index_candidates:
             index_name = get_index_name(ic)
             _validate_identifier(index_name, "index name")
             for col in ic:
                 _validate_identifier(col, "column name")
-            try:
-                frappe.db.sql_ddl(
-                    f"CREATE INDEX `{index_name}` ON `{table}` ({', '.join(f'`{col}`' for col in ic)})",
-                    debug=verbose,
-                )
-            except Exception:
-                failures.append(ic)
-        return failures
+            changes.append(
+                (ic, f"ADD INDEX `{index_name}` ({', '.join(f'`{col}`' for col in ic)})")
+            )
+        return _run_batched_index_ddl(table, changes, verbose=verbose, throttle=throttle)
 
     @staticmethod
     def drop(table, index_candidates: list[IndexCandidate], verbose=False):
         _validate_identifier(table, "table name")
+        changes = []
         for ic in index_candidates:
             index_name = get_index_name(ic)
             _validate_identifier(index_name, "index name")
-            frappe.db.sql_ddl(
-                f"DROP INDEX `{index_name}` ON `{table}`",
-                debug=verbose,
-            )
+            changes.append((index_name, f"DROP INDEX `{index_name}`"))
+        if failures := _run_batched_index_ddl(table, changes, verbose=verbose):
+            frappe.throw(f"Failed to drop indexes {', '.join(failures)} on {table}")
 
     @staticmethod
     def drop_toolbox_indexes(table, verbose=False):
         _validate_identifier(table, "table name")
-        dropped_indexes = set()
+        changes = {}
         for index in MariaDBIndex.get_indexes(table):
             index_name = index["key_name"]
-            if index_name.startswith(TOOLBOX_INDEX_PREFIX) and index_name not in dropped_indexes:
+            if index_name.startswith(TOOLBOX_INDEX_PREFIX) and index_name not in changes:
                 _validate_identifier(index_name, "index name")
-                frappe.db.sql_ddl(
-                    f"DROP INDEX IF EXISTS `{index_name}` ON `{table}`",
-                    debug=verbose,
-                )
-                dropped_indexes.add(index_name)
+                changes[index_name] = f"DROP INDEX IF EXISTS `{index_name}`"
+        if failures := _run_batched_index_ddl(table, list(changes.items()), verbose=verbose):
+            frappe.throw(f"Failed to drop indexes {', '.join(failures)} on {table}")
 
 
 ALLOWED_OPERATORS = {"=", "!=", "<", ">", "<=", ">=", "like", "not like", "in", "not in"}
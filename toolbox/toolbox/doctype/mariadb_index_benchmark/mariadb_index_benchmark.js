@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Gavin D'souza and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("MariaDB Index Benchmark", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,31 @@
+# Copyright (c) 2026, Gavin D'souza and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+
+class MariaDBIndexBenchmark(Document):
+    # begin: auto-generated types
+    # This code is auto-generated. Do not modify anything in this block.
+
+    from typing import TYPE_CHECKING
+
+    if TYPE_CHECKING:
+        from frappe.types import DF
+
+        improvement: DF.Percent
+        index_name: DF.Data | None
+        name: DF.Int | None
+        p_value: DF.Float
+        query: DF.Link | None
+        raw_results: DF.JSON | None
+        rows_read_after: DF.Float
+        rows_read_before: DF.Float
+        runs: DF.Int
+        table: DF.Link | None
+        time_after: DF.Float
+        time_before: DF.Float
+        verdict: DF.Literal["Kept", "Dropped"]
+    # end: auto-generated types
+    pass
@@ -1,12 +1,38 @@
 # Copyright (c) 2023, Gavin D'souza and contributors
 # For license information, please see license.txt
 
+from random import sample
+
 import frappe
 from frappe.model.document import Document
-from frappe.utils import cint
+from frappe.utils import cint, flt
 
+from toolbox.sql_recorder import PARAMETER_SAMPLES, get_histogram_percentile
 from toolbox.utils import record_table
 
+PERCENTILE_FIELDS = {"p50_time": 50, "p95_time": 95, "p99_time": 99}
+
+
+def merge_time_histogram(recorded: str | None, histogram: dict[int, int]) -> dict[int, int]:
+    """Merge newly recorded histogram buckets into a stored (JSON) time histogram."""
+    merged = {int(bucket): count for bucket, count in frappe.parse_json(recorded or "{}").items()}
+    for bucket, count in histogram.items():
+        merged[bucket] = merged.get(bucket, 0) + count
+    return merged
+
+
+def merge_parameter_samples(recorded: str | None, params: list) -> list:
+    """Merge newly sampled parameter values into stored (JSON) ones, up to PARAMETER_SAMPLES."""
+    merged = frappe.parse_json(recorded or "[]") + params
+    return sample(merged, PARAMETER_SAMPLES) if len(merged) > PARAMETER_SAMPLES else merged
+
+
+def get_time_percentiles(histogram: dict[int, int]) -> dict[str, float]:
+    return {
+        fieldname: get_histogram_percentile(histogram, percentile) or 0.0
+        for fieldname, percentile in PERCENTILE_FIELDS.items()
+    }
+
 
 class MariaDBQuery(Document):
     # begin: auto-generated types
@@ -23,12 +49,24 @@ class MariaDBQuery(Document):
 
         call_stack: DF.LongText | None
         improved: DF.LongText | None
+        max_time: DF.Float
+        min_time: DF.Float
         name: DF.Int | None
         occurrence: DF.Int
+        p50_time: DF.Float
+        p95_time: DF.Float
+        p99_time: DF.Float
+        parameter_samples: DF.JSON | None
         parameterized_query: DF.LongText | None
+        parse_cache: DF.JSON | None
         query: DF.LongText
         query_explain: DF.Table[MariaDBQueryExplain]
+        query_hash: DF.Data | None
         tables: DF.Data | None
+        time_histogram: DF.JSON | None
+        total_rows: DF.Int
+        total_time: DF.Float
+        total_time_squared: DF.Float
     # end: auto-generated types
 
     def validate(self):
@@ -68,6 +106,30 @@ class MariaDBQuery(Document):
             explain_row | {"rows": cint(explain["rows"]), "filtered": explain.get("filtered")},
         )
 
+    def apply_stats(self, stats: dict[str, float] | None):
+        if not stats:
+            return
+
+        self.total_time = flt(self.total_time) + stats.get("time", 0)
+        self.total_time_squared = flt(self.total_time_squared) + stats.get("time_sq", 0)
+        self.total_rows = cint(self.total_rows) + cint(stats.get("rows"))
+
+        if (min_time := stats.get("min_time")) is not None:
+            if not self.min_time or min_time < self.min_time:
+                self.min_time = min_time
+
+        if (max_time := stats.get("max_time")) is not None:
+            self.max_time = max(flt(self.max_time), max_time)
+
+        if histogram := stats.get("histogram"):
+            merged = merge_time_histogram(self.time_histogram, histogram)
+            self.time_histogram = frappe.as_json(merged, indent=None)
+            self.update(get_time_percentiles(merged))
+
+        if params := stats.get("params"):
+            merged = merge_parameter_samples(self.parameter_samples, params)
+            self.parameter_samples = frappe.as_json(merged, indent=None)
+
     def optimize(self):
         # 1. Check if the tables involved are scanning entire tables (type: ALL) [Worst case]
         # 2. If so, check if there are any indexes that can be used
@@ -37,3 +37,34 @@ class TestMariaDBQuery(FrappeTestCase):
         for explain in explain_data:
             qry.apply_explain(explain)
         self.assertEqual(len(explain_data), len(qry.query_explain))
+
+    def test_apply_stats(self):
+        qry = record_query("SELECT 1")
+
+        qry.apply_stats(
+            {"time": 6.0, "time_sq": 20.0, "rows": 4, "min_time": 2.0, "max_time": 4.0}
+        )
+        qry.apply_stats({"time": 1.0, "time_sq": 1.0, "rows": 1, "min_time": 1.0, "max_time": 1.0})
+
+        self.assertEqual(qry.total_time, 7.0)
+        self.assertEqual(qry.total_time_squared, 21.0)
+        self.assertEqual(qry.total_rows, 5)
+        self.assertEqual(qry.min_time, 1.0)
+        self.assertEqual(qry.max_time, 4.0)
+
+        # missing stats leave the record untouched
+        qry.apply_stats(None)
+        self.assertEqual(qry.total_time, 7.0)
+
+    def test_apply_stats_merges_histogram(self):
+        from toolbox.sql_recorder import get_histogram_bucket
+
+        fast, slow = get_histogram_bucket(1.0), get_histogram_bucket(100.0)
+        qry = record_query("SELECT 1")
+
+        qry.apply_stats({"histogram": {fast: 90}})
+        qry.apply_stats({"histogram": {fast: 5, slow: 5}})
+
+        self.assertEqual(frappe.parse_json(qry.time_histogram), {str(fast): 95, str(slow): 5})
+        self.assertAlmostEqual(qry.p50_time, 1.0, delta=0.15)
+        self.assertAlmostEqual(qry.p99_time, 100.0, delta=15)
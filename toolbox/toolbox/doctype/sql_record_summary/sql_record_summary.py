@@ -14,6 +14,7 @@ class SQLRecordSummary(Document):
     if TYPE_CHECKING:
         from frappe.types import DF
 
+        chunk_id: DF.Data | None
         name: DF.Int | None
         total_sql_count: DF.Int
         unique_sql_count: DF.Int
@@ -6,7 +6,7 @@ from typing import TYPE_CHECKING
 import frappe
 from frappe.model.document import Document
 
-from toolbox.sql_recorder import TOOLBOX_RECORDER_FLAG
+from toolbox.sql_recorder import TOOLBOX_RECORDER_FLAG, clear_recorder_flag_cache
 from toolbox.utils import check_dbms_compatibility
 
 if TYPE_CHECKING:
@@ -33,6 +33,8 @@ SCHEDULED_JOBS = [
 
 def toggle_sql_recorder(enabled: bool):
     frappe.cache.set_value(TOOLBOX_RECORDER_FLAG, enabled)
+    # other workers pick up the change when their cached flag expires
+    clear_recorder_flag_cache()
 
 
 def clear_system_manager_cache():
@@ -51,10 +53,22 @@ class ToolBoxSettings(Document):
     if TYPE_CHECKING:
         from frappe.types import DF
 
+        benchmark_min_improvement: DF.Percent
+        benchmark_runs: DF.Int
+        explain_concurrency: DF.Int
+        index_ddl_lock_wait_timeout: DF.Int
+        index_ddl_max_threads_running: DF.Int
+        index_manager_processes: DF.Int
         index_manager_processing_interval: DF.Literal["Hourly", "Daily"]
+        index_write_cost: DF.Float
         is_index_manager_enabled: DF.Check
         is_sql_recorder_enabled: DF.Check
+        max_index_size_per_table: DF.Int
+        max_indexes_per_run: DF.Int
+        sql_recorder_parameter_samples: DF.Literal["Off", "Values", "Hashed Values"]
         sql_recorder_processing_interval: DF.Literal["Hourly", "Daily"]
+        sql_recorder_sample_rate: DF.Percent
+        what_if_min_rows: DF.Int
     # end: auto-generated types
 
     def validate(self):
@@ -112,23 +126,39 @@ def process_sql_recorder():
     import frappe
     from frappe.utils.synchronization import filelock
 
-    from toolbox.sql_recorder import TOOLBOX_RECORDER_DATA
+    from toolbox.sql_recorder import (
+        TOOLBOX_RECORDER_DROPPED,
+        get_chunk_stats,
+        iter_recorded_chunks,
+        release_recorded_chunk,
+    )
     from toolbox.utils import process_sql_metadata_chunk, record_database_state
 
     with filelock("process_sql_metadata", timeout=0.1):
         c = frappe.cache
-        DATA_KEY = c.make_key(TOOLBOX_RECORDER_DATA)
-        QRY_COUNT = c.hlen(DATA_KEY)
-        frappe.logger("toolbox").info(f"Processing {QRY_COUNT:,} queries")
+        DROPPED_KEY = c.make_key(TOOLBOX_RECORDER_DROPPED)
 
         pipe = c.pipeline()
-        pipe.execute_command("HGETALL", DATA_KEY)
-        pipe.execute_command("DEL", DATA_KEY)
-        queries: dict[str, int] = {
-            k.decode(): int(v.decode()) for k, v in pipe.execute()[0].items()
-        }
+        pipe.execute_command("GET", DROPPED_KEY)
+        pipe.execute_command("DEL", DROPPED_KEY)
+        dropped, _ = pipe.execute()
 
-        process_sql_metadata_chunk(queries)
+        if dropped := int(dropped or 0):
+            frappe.logger("toolbox").warning(
+                f"SQL Recorder dropped {dropped:,} request & job dumps as its flush queue was full"
+            )
+
+        QRY_COUNT = 0
+        for chunk_id, queries in iter_recorded_chunks():
+            # a summary means an interrupted run committed this chunk but didn't release it
+            if not frappe.db.exists("SQL Record Summary", {"chunk_id": chunk_id}):
+                process_sql_metadata_chunk(
+                    queries, get_chunk_stats(chunk_id, queries), chunk_id=chunk_id
+                )
+                frappe.db.commit()
+                QRY_COUNT += len(queries)
+                frappe.logger("toolbox").info(f"Processed {QRY_COUNT:,} queries")
+            release_recorded_chunk(chunk_id, queries)
         frappe.enqueue(
             # this ought to find broken links & generate records for them too
             record_database_state,
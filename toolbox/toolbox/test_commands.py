@@ -36,6 +36,7 @@ class TestCommandRegistration(unittest.TestCase):
         self.assertIn("show-toolbox-indexes", cmd_names)
         self.assertIn("drop-toolbox-indexes", cmd_names)
         self.assertIn("optimize", cmd_names)
+        self.assertIn("benchmark-parser", cmd_names)
 
     def test_sql_manager_commands_registered(self):
         cmd_names = {c.name for c in sql_manager_cli.commands.values()}
@@ -90,6 +91,7 @@ class TestOptimizeCommandOptions(unittest.TestCase):
         self.assertIn("sql_occurrence", param_names)
         self.assertIn("skip_backtest", param_names)
         self.assertIn("verbose", param_names)
+        self.assertIn("processes", param_names)
 
 
 if __name__ == "__main__":
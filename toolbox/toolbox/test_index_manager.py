@@ -1,10 +1,30 @@
 # Copyright (c) 2023, Gavin D'souza and Contributors
 # See license.txt
 
+import json
 import unittest
 from unittest.mock import MagicMock, patch
 
-from toolbox.utils import IndexCandidate, IndexCandidateType, Query, QueryBenchmark, Table
+from sqlparse import parse
+
+from toolbox.utils import (
+    BENCHMARK_MIN_IMPROVEMENT,
+    BENCHMARK_RUNS,
+    PARSER_VERSION,
+    IndexCandidate,
+    IndexCandidateType,
+    Query,
+    QueryBenchmark,
+    Table,
+    WHAT_IF_VERDICT_TTL,
+    WhatIfAnalysis,
+    get_analyzed_run,
+    get_column_width,
+    iter_where_clause_items,
+    permutation_test,
+    save_parse_caches,
+    scan_where_clause,
+)
 
 
 class TestIndexCandidateClass(unittest.TestCase):
@@ -86,6 +106,54 @@ class TestQueryClass(unittest.TestCase):
         sample = q.get_sample()
         self.assertIn("SELECT", sample)
 
+    @patch("toolbox.utils.frappe")
+    def test_get_sample_recorded_params(self, mock_frappe):
+        mock_frappe.db.escape.side_effect = lambda value, percent=True: f"'{value}'"
+        q = Query(
+            "SELECT * FROM `tabUser` WHERE name = %s AND age > %s AND owner IN %s",
+            parameter_samples='[["Guest", 21, ["A", "B"]]]',
+        )
+        sample = q.get_sample()
+        self.assertIn("name = 'Guest'", sample)
+        self.assertIn("age > 21", sample)
+        self.assertIn("IN ('A', 'B')", sample)
+
+    @patch("toolbox.utils.frappe")
+    def test_get_sample_recorded_named_params(self, mock_frappe):
+        mock_frappe.db.escape.side_effect = lambda value, percent=True: f"'{value}'"
+        q = Query(
+            "SELECT * FROM `tabUser` WHERE name = %(user)s AND age > %(age)s",
+            parameter_samples=[{"user": "Guest"}],
+        )
+        sample = q.get_sample()
+        self.assertIn("name = 'Guest'", sample)
+        self.assertIn("age > 1", sample)
+
+    def test_get_sample_hashed_params(self):
+        q = Query(
+            "SELECT * FROM `tabUser` WHERE name = %s AND age > %s",
+            parameter_samples=[[{"sha1": "2bb80d537b1da3e3"}, 21]],
+        )
+        sample = q.get_sample()
+        self.assertIn("name = 1", sample)
+        self.assertIn("age > 21", sample)
+
+    def test_get_sample_recorded_params_only_for_select(self):
+        q = Query("DELETE FROM `tabUser` WHERE name = %s", parameter_samples=[["Guest"]])
+        self.assertIn("name = 1", q.get_sample())
+
+    @patch("toolbox.utils.frappe")
+    def test_get_sample_uses_parameterized_sql(self, mock_frappe):
+        mock_frappe.db.escape.side_effect = lambda value, percent=True: f"'{value}'"
+        q = Query(
+            "SELECT * FROM `tabUser` WHERE name = %s AND enabled = %s",
+            parameterized_sql="SELECT * FROM `tabUser` WHERE name = %s AND enabled = 1",
+            parameter_samples=[["Guest"]],
+        )
+        sample = q.get_sample()
+        self.assertIn("name = 'Guest'", sample)
+        self.assertIn("enabled = 1", sample)
+
     def test_parsed_caches(self):
         q = Query("SELECT 1")
         p1 = q.parsed
@@ -98,6 +166,42 @@ class TestQueryClass(unittest.TestCase):
         d2 = q.d_parsed
         self.assertIs(d1, d2)
 
+    def test_get_sample_matches_format_sql(self):
+        from sqlparse import format as format_sql
+
+        sql = "select `name`,\n  `title` from `tabNote`  where ( `owner` = %s )\n order by modified desc limit %s"
+        expected = format_sql(sql.replace("%s", "1"), strip_whitespace=True, keyword_case="upper")
+        self.assertEqual(Query(sql).get_sample(), expected)
+
+    def test_get_sample_reuses_parsed(self):
+        q = Query("SELECT * FROM `tabUser` WHERE name = %s")
+        with patch("toolbox.utils.parse", wraps=parse) as mock_parse:
+            q.parsed
+            q.get_sample()
+            q.columns
+        mock_parse.assert_called_once()
+
+    def test_tables(self):
+        q = Query("SELECT n.name FROM `tabNote` n JOIN `tabUser` ON `tabUser`.name = n.owner")
+        self.assertEqual(q.tables, {"n": "tabNote", "tabUser": "tabUser"})
+
+    def test_columns(self):
+        q = Query(
+            "SELECT n.name, IFNULL(title, 'x') AS t, COUNT(*), type FROM `tabNote` n "
+            "ORDER BY t, n.modified DESC"
+        )
+        self.assertEqual(q.query_type, "SELECT")
+        self.assertEqual(
+            q.columns,
+            {
+                "select": ["tabNote.name", "title", "type"],
+                "order_by": ["title", "tabNote.modified"],
+            },
+        )
+
+    def test_columns_of_non_select_query(self):
+        self.assertEqual(Query("UPDATE `tabNote` SET title = 'x'").columns, {})
+
 
 class TestIndexCandidateGeneration(unittest.TestCase):
     """Tests for Table.find_index_candidates with various SQL patterns."""
@@ -134,7 +238,7 @@ class TestIndexCandidateGeneration(unittest.TestCase):
         has_order_by = any(ic.type == IndexCandidateType.ORDER_BY for ic in candidates)
         self.assertTrue(has_order_by, f"Expected ORDER_BY candidate, got: {candidates}")
 
-    def test_select_only_query_uses_d_parsed(self):
+    def test_select_only_query_uses_select_columns(self):
         """SELECT without WHERE should use find_index_candidates_from_select_query."""
         table = self._make_table("tabQuality Goal")
         queries = [Query(
@@ -170,6 +274,144 @@ class TestIndexCandidateGeneration(unittest.TestCase):
             seen.append(list(ic))
 
 
+class TestParseCache(unittest.TestCase):
+    """Tests for index candidates cached on MariaDB Query.parse_cache."""
+
+    def _make_table(self, name="tabNote"):
+        t = Table.__new__(Table)
+        t.id = "test-id"
+        t.name = name
+        return t
+
+    def test_generated_candidates_are_cached(self):
+        table = self._make_table()
+        query = Query("SELECT `name` FROM `tabNote` WHERE `modified` = 1 AND `owner` = 'x'")
+        candidates = table.find_index_candidates([query])
+
+        self.assertTrue(query.parse_cache_updated)
+        self.assertEqual(query.parse_cache["version"], PARSER_VERSION)
+        self.assertEqual(
+            query.parse_cache["tables"]["tabNote"],
+            [{"type": "WHERE", "columns": ["modified", "owner"], "ctx": ["`owner`", "=", "'x'"]}],
+        )
+        self.assertEqual(candidates, [["modified", "owner"]])
+
+    def test_cached_candidates_skip_parsing(self):
+        table = self._make_table()
+        parse_cache = json.dumps(
+            {
+                "version": PARSER_VERSION,
+                "tables": {"tabNote": [{"type": "ORDER_BY", "columns": ["title"], "ctx": None}]},
+            }
+        )
+        query = Query("SELECT name FROM `tabNote` ORDER BY title", parse_cache=parse_cache)
+
+        with patch("toolbox.utils.parse") as mock_parse:
+            candidates = table.find_index_candidates([query])
+
+        mock_parse.assert_not_called()
+        self.assertFalse(query.parse_cache_updated)
+        self.assertEqual(candidates, [["title"]])
+        self.assertEqual(candidates[0].type, IndexCandidateType.ORDER_BY)
+        self.assertIs(candidates[0].query, query)
+
+    def test_stale_parser_version_is_regenerated(self):
+        table = self._make_table()
+        parse_cache = {
+            "version": PARSER_VERSION - 1,
+            "tables": {"tabNote": [{"type": "WHERE", "columns": ["stale"], "ctx": None}]},
+        }
+        query = Query("SELECT name FROM `tabNote` WHERE `owner` = 'x'", parse_cache=parse_cache)
+        candidates = table.find_index_candidates([query])
+
+        self.assertEqual(candidates, [["owner"]])
+        self.assertEqual(parse_cache["version"], PARSER_VERSION)
+        self.assertEqual(list(parse_cache["tables"]), ["tabNote"])
+
+    def test_cache_is_shared_across_tables(self):
+        parse_cache = {}
+        sql = "SELECT n.name FROM `tabNote` n JOIN `tabToDo` t ON t.owner = n.owner ORDER BY title"
+        for table in ("tabNote", "tabToDo"):
+            self._make_table(table).find_index_candidates([Query(sql, parse_cache=parse_cache)])
+
+        self.assertEqual(set(parse_cache["tables"]), {"tabNote", "tabToDo"})
+
+    @patch("toolbox.utils.frappe")
+    def test_save_parse_caches(self, mock_frappe):
+        analyzed = Query("SELECT name FROM `tabNote` WHERE `owner` = 'x'", name="1")
+        self._make_table().find_index_candidates([analyzed])
+        unchanged = Query("SELECT name FROM `tabNote`", name="2")
+
+        save_parse_caches([analyzed, unchanged])
+
+        mock_frappe.db.set_value.assert_called_once_with(
+            "MariaDB Query",
+            "1",
+            "parse_cache",
+            json.dumps(analyzed.parse_cache),
+            update_modified=False,
+        )
+        self.assertFalse(analyzed.parse_cache_updated)
+
+
+class TestWhereScanner(unittest.TestCase):
+    """Tests for scan_where_clause, the sqlparse-free path for Frappe generated queries."""
+
+    SCANNABLE = [
+        "SELECT `name` FROM `tabNote` WHERE `tabNote`.`owner` = %s AND `public` = 1",
+        "select `name` from `tabNote` where `a` like %(txt)s or `b` not like 'x%' order by `c` desc",
+        "SELECT `name` FROM `tabNote` WHERE `a` IN ('x', 'y') AND `b` IS NOT NULL AND `c` <> `d`",
+        "SELECT `name` FROM `tabNote` WHERE (`a` = 1 OR `b` = 2) AND `c` BETWEEN 1 AND 2 LIMIT 20",
+        "UPDATE `tabNote` SET `title` = 'x' WHERE `name` = 'it''s'",
+        "SELECT `name` FROM `tabNote` WHERE `a` = 1 GROUP BY `b` ORDER BY `tabNote`.`c`, `d` ASC "
+        "LIMIT 20 OFFSET 40 FOR UPDATE",
+    ]
+
+    def test_matches_sqlparse(self):
+        for sql in self.SCANNABLE:
+            with self.subTest(sql=sql):
+                expected = list(iter_where_clause_items(Query(sql).parsed))
+                self.assertEqual(scan_where_clause(sql), expected)
+
+    def test_unfamiliar_constructs_fall_back(self):
+        for sql in [
+            "SELECT `name` FROM `tabNote`",
+            "SELECT `name` FROM `tabNote` WHERE ifnull(`a`, '') = 'x'",
+            "SELECT `name` FROM `tabNote` WHERE owner = 'x'",
+            "SELECT `name` FROM `tabNote` WHERE `a` = -1",
+            "SELECT `name` FROM `tabNote` WHERE `a` = 1 -- comment",
+            "SELECT `name` FROM `tabNote` WHERE `a` = 1 HAVING count(*) > 1",
+            "SELECT `name` FROM `tabNote` WHERE `a` = 1 ORDER BY 2",
+            "SELECT `a` FROM `tabNote` WHERE `a` = 1 UNION SELECT `b` FROM `tabToDo`",
+        ]:
+            with self.subTest(sql=sql):
+                self.assertIsNone(scan_where_clause(sql))
+
+    def test_find_index_candidates_skips_sqlparse(self):
+        table = Table.__new__(Table)
+        table.id, table.name = "test-id", "tabNote"
+        query = Query(self.SCANNABLE[0])
+
+        with patch("toolbox.utils.parse") as mock_parse:
+            candidates = table.find_index_candidates([query])
+
+        mock_parse.assert_not_called()
+        self.assertEqual(candidates, [["owner", "public"]])
+        self.assertEqual(candidates[0].ctx, ["`public`", "=", "1"])
+
+    @patch("toolbox.index_manager.frappe")
+    def test_benchmark(self, mock_frappe):
+        from toolbox.index_manager import benchmark_where_scanner
+
+        mock_frappe.get_all.return_value = [*self.SCANNABLE, "SELECT `name` FROM `tabNote`"]
+        result = benchmark_where_scanner(limit=10)
+
+        self.assertEqual(result["queries"], len(self.SCANNABLE) + 1)
+        self.assertEqual(result["scanned"], len(self.SCANNABLE))
+        self.assertEqual(result["mismatched"], 0)
+        self.assertGreater(result["sqlparse_time"], 0)
+
+
 class TestQualifyIndexCandidates(unittest.TestCase):
     """Tests for Table.qualify_index_candidates (dedup, subset removal, 5-col cap)."""
 
@@ -305,6 +547,85 @@ class TestQueryBenchmarkLogic(unittest.TestCase):
         self.assertIn("before", results[0][0])
         self.assertIn("after", results[0][0])
 
+    def _runs(self, times, rows=100):
+        return [{"time_ms": t, "rows_read": rows} for t in times]
+
+    def test_timed_runs_decide_over_single_analyze(self):
+        ic = IndexCandidate(query=Query("SELECT 1"))
+        qbm = QueryBenchmark(index_candidates=[ic], runs=5)
+
+        # the single ANALYZE shows fewer rows, but the timed runs are just noise
+        qbm.before = [[{"r_rows": "100.00", "r_filtered": 50.0, "Extra": "Using where"}]]
+        qbm.after = [[{"r_rows": "10.00", "r_filtered": 100.0, "Extra": "Using index"}]]
+        qbm.before_runs = [self._runs([20, 22, 19, 21, 20])]
+        qbm.after_runs = [self._runs([21, 19, 20, 22, 20])]
+
+        unchanged = dict(qbm.get_unchanged_results())
+        self.assertEqual(len(unchanged), 1)
+
+    @patch("toolbox.utils.get_analyzed_run", return_value={"time_ms": 1.0, "rows_read": 1})
+    @patch("toolbox.utils.get_analyzed_result", return_value=[])
+    def test_only_selects_get_timed_runs(self, mock_result, mock_run):
+        select = IndexCandidate(query=Query("SELECT `name` FROM `tabNote` WHERE `owner` = 'x'"))
+        delete = IndexCandidate(query=Query("DELETE FROM `tabNote` WHERE `owner` = 'x'"))
+        qbm = QueryBenchmark(index_candidates=[select, delete], runs=5)
+
+        results, runs = qbm.conduct_benchmark()
+
+        # ANALYZE executes the statement - DML samples only run once
+        self.assertEqual(mock_result.call_count, 2)
+        self.assertEqual(mock_run.call_count, 5)
+        self.assertEqual([len(r) for r in runs], [5, 0])
+
+    def test_significantly_faster_runs_are_improved(self):
+        qbm = QueryBenchmark(index_candidates=[], min_improvement=0.1)
+        result = qbm.compare_runs(self._runs([20, 22, 19, 21, 20]), self._runs([5, 6, 5, 4, 6]))
+        self.assertTrue(result["improved"])
+        self.assertAlmostEqual(result["p_value"], 1 / 252)
+        self.assertAlmostEqual(result["improvement"], 74.51, places=2)
+
+    def test_fewer_rows_read_is_improved(self):
+        qbm = QueryBenchmark(index_candidates=[], min_improvement=0.1)
+        result = qbm.compare_runs(self._runs([1, 1, 1], rows=1000), self._runs([1, 1, 1], rows=10))
+        self.assertTrue(result["improved"])
+
+    def test_improvement_below_threshold(self):
+        qbm = QueryBenchmark(index_candidates=[], min_improvement=0.5)
+        result = qbm.compare_runs(
+            self._runs([20, 22, 19, 21, 20]), self._runs([15, 16, 15, 14, 16])
+        )
+        self.assertFalse(result["improved"])
+
+    def test_no_improvement_without_threshold(self):
+        qbm = QueryBenchmark(index_candidates=[], min_improvement=0)
+        result = qbm.compare_runs(self._runs([2, 2, 2]), self._runs([2, 2, 2]))
+        self.assertFalse(result["improved"])
+
+    def test_permutation_test(self):
+        self.assertAlmostEqual(permutation_test([3, 4, 5], [0, 1, 2]), 1 / 20)
+        self.assertEqual(permutation_test([0, 1, 2], [3, 4, 5]), 1)
+        # too many splits to try them all, a fixed sample is used
+        p = permutation_test(list(range(20, 40)), list(range(0, 20)))
+        self.assertLess(p, 0.01)
+        self.assertEqual(p, permutation_test(list(range(20, 40)), list(range(0, 20))))
+
+    @patch("toolbox.utils.frappe")
+    def test_analyzed_run(self, mock_frappe):
+        analyzed = {
+            "query_block": {
+                "r_total_time_ms": 1.5,
+                "nested_loop": [
+                    {"table": {"table_name": "tabNote", "r_loops": 1, "r_rows": 100}},
+                    {"table": {"table_name": "tabToDo", "r_loops": 100, "r_rows": 2}},
+                ],
+            }
+        }
+        mock_frappe.db.sql.return_value = [(json.dumps(analyzed),)]
+        self.assertEqual(get_analyzed_run("SELECT 1"), {"time_ms": 1.5, "rows_read": 300.0})
+
+        mock_frappe.db.sql.side_effect = Exception("syntax error")
+        self.assertIsNone(get_analyzed_run("SELECT 1"))
+
 
 class TestIndexManagerPipeline(unittest.TestCase):
     """Integration-style tests for the full index manager pipeline."""
@@ -348,6 +669,10 @@ class TestIndexManagerPipeline(unittest.TestCase):
             mock_table = MockTable.return_value
             mock_table.name = "tabUser"
             mock_table.exists.return_value = True
+            mock_table.get_row_count.return_value = 0
+            mock_table.weigh_write_cost.side_effect = lambda ics, write_cost: ics
+            mock_table.get_index_length.return_value = 0
+            mock_table.estimate_index_size.return_value = 0
             ic = IndexCandidate(query=Query("SELECT name FROM tabUser"))
             ic.append("name")
             mock_table.find_index_candidates.return_value = [ic]
@@ -358,6 +683,63 @@ class TestIndexManagerPipeline(unittest.TestCase):
 
             mock_idx.create.assert_called_once()
 
+    @patch("toolbox.index_manager.QueryBenchmark")
+    @patch("toolbox.index_manager.MariaDBIndex")
+    @patch("toolbox.index_manager.frappe")
+    def test_busy_server_skips_table_before_benchmark(self, mock_frappe, mock_idx, mock_qbm):
+        from toolbox.index_manager import process_index_manager
+
+        mock_frappe.get_all.return_value = [
+            MagicMock(table="test_table_id", query="SELECT name FROM tabUser", occurrence=5)
+        ]
+        mock_idx.wait_for_ddl_window.return_value = False
+
+        with patch("toolbox.index_manager.Table") as MockTable, patch(
+            "toolbox.index_manager.get_table_id"
+        ):
+            mock_table = MockTable.return_value
+            mock_table.name = "tabUser"
+            mock_table.weigh_write_cost.side_effect = lambda ics, write_cost: ics
+            ic = IndexCandidate(query=Query("SELECT name FROM tabUser"))
+            ic.append("name")
+            mock_table.qualify_index_candidates.return_value = [ic]
+
+            process_index_manager()
+
+        mock_idx.wait_for_ddl_window.assert_called_once_with("tabUser")
+        mock_qbm.assert_not_called()
+        mock_idx.create.assert_not_called()
+
+    @patch("toolbox.index_manager.QueryBenchmark")
+    @patch("toolbox.index_manager.MariaDBIndex")
+    @patch("toolbox.index_manager.frappe")
+    def test_unset_benchmark_settings_use_defaults(self, mock_frappe, mock_idx, mock_qbm):
+        from toolbox.index_manager import process_index_manager
+
+        mock_frappe.get_all.return_value = [
+            MagicMock(table="test_table_id", query="SELECT name FROM tabUser", occurrence=5)
+        ]
+        mock_idx.create.return_value = []
+        mock_qbm.return_value.__enter__.return_value.get_unchanged_results.return_value = []
+
+        with patch("toolbox.index_manager.Table") as MockTable, patch(
+            "toolbox.index_manager.get_table_id"
+        ), patch("toolbox.index_manager.toolbox.get_settings", return_value=None):
+            mock_table = MockTable.return_value
+            mock_table.name = "tabUser"
+            ic = IndexCandidate(query=Query("SELECT name FROM tabUser"))
+            ic.append("name")
+            mock_table.qualify_index_candidates.return_value = [ic]
+
+            process_index_manager()
+
+        mock_qbm.assert_called_once_with(
+            index_candidates=[ic],
+            verbose=False,
+            runs=BENCHMARK_RUNS,
+            min_improvement=BENCHMARK_MIN_IMPROVEMENT,
+        )
+
     @patch("toolbox.index_manager.MariaDBIndex")
     @patch("toolbox.index_manager.frappe")
     def test_no_candidates_skips_table(self, mock_frappe, mock_idx):
@@ -385,6 +767,446 @@ class TestIndexManagerPipeline(unittest.TestCase):
             mock_idx.create.assert_not_called()
 
 
+class TestParallelCandidateGeneration(unittest.TestCase):
+    """Tests for generating index candidates per table in worker processes."""
+
+    QUERIES = {
+        "tabNote": [
+            "SELECT `name` FROM `tabNote` WHERE `owner` = 'x' AND `public` = 1",
+            "SELECT `name` FROM `tabNote` WHERE ifnull(`title`, '') = 'x' ORDER BY `modified`",
+        ],
+        "tabToDo": [
+            "SELECT `name` FROM `tabToDo` WHERE `status` = 'Open' OR `allocated_to` = 'x'",
+            "SELECT `name`, `description` FROM `tabToDo` ORDER BY `date` DESC",
+        ],
+    }
+
+    def _make_tables(self):
+        tables = []
+        for table_name, queries in self.QUERIES.items():
+            table = Table(id=f"{table_name}-id", name=table_name)
+            tables.append((table, [Query(sql, occurrence=2, table=table) for sql in queries]))
+        return tables
+
+    def _summarize(self, results):
+        return [
+            (table.name, [(ic.query.sql, ic.type, list(ic), ic.ctx) for ic in index_candidates])
+            for table, _, index_candidates in results
+        ]
+
+    def test_generate_index_candidates(self):
+        from toolbox.index_manager import generate_index_candidates
+
+        candidates, cache_entries = generate_index_candidates(
+            "tabNote", [{"sql": sql} for sql in self.QUERIES["tabNote"]]
+        )
+        self.assertEqual(candidates[0], (0, "WHERE", ["owner", "public"], ["`public`", "=", "1"]))
+        self.assertEqual(set(cache_entries), {0, 1})
+
+    def test_generate_index_candidates_qualifier(self):
+        from toolbox.index_manager import generate_index_candidates
+
+        candidates, cache_entries = generate_index_candidates(
+            "tabNote", [{"sql": sql} for sql in self.QUERIES["tabNote"]], sql_occurrence=1
+        )
+        self.assertEqual((candidates, cache_entries), ([], {}))
+
+    def test_processes_match_sequential(self):
+        from toolbox.index_manager import iter_index_candidates
+
+        sequential = self._summarize(iter_index_candidates(self._make_tables(), processes=1))
+        parallel_tables = self._make_tables()
+        parallel = list(iter_index_candidates(parallel_tables, processes=2))
+
+        self.assertEqual(self._summarize(parallel), sequential)
+        for table, query_candidates in parallel_tables:
+            for query in query_candidates:
+                self.assertTrue(query.parse_cache_updated)
+                self.assertIn(table.name, query.parse_cache["tables"])
+
+
+class TestIndexCandidateScoring(unittest.TestCase):
+    """Tests for ranking index candidates by the rows they are expected to save."""
+
+    def _make_candidate(self, columns, occurrence=10, rows_examined=1000, rows_filtered=10):
+        query = Query(
+            "SELECT 1",
+            occurrence=occurrence,
+            rows_examined=rows_examined,
+            rows_filtered=rows_filtered,
+        )
+        ic = IndexCandidate(query=query)
+        ic.extend(columns)
+        return ic
+
+    def _score(self, index_candidates, table_rows=0, cardinality=None):
+        table = Table(id="test-id", name="tabNote")
+        with patch.object(Table, "get_row_count", return_value=table_rows), patch.object(
+            Table, "get_column_cardinality", return_value=cardinality or {}
+        ):
+            table.score_index_candidates(index_candidates)
+
+    def test_score_uses_explain_filtered(self):
+        ic = self._make_candidate(["owner"])
+        self._score([ic])
+        # (1000 examined - 10 kept) x 10 executions
+        self.assertEqual(ic.score, 9900)
+
+    def test_score_uses_cardinality(self):
+        ic = self._make_candidate(["owner", "status"])
+        self._score([ic], table_rows=1000, cardinality={"owner": 4, "status": 500})
+        # the most selective column reads 1000 / 500 rows per execution
+        self.assertEqual(ic.score, 9980)
+
+    def test_score_ranks_frequent_queries_higher(self):
+        rare = self._make_candidate(["owner"], occurrence=1)
+        frequent = self._make_candidate(["status"], occurrence=100, rows_examined=100)
+        self._score([rare, frequent])
+        self.assertGreater(frequent.score, rare.score)
+
+    def _cardinality(self, sql_results, columns=("owner", "status"), table_rows=1_000_000):
+        table = Table(id="test-id", name="tabNote")
+        with patch("toolbox.utils.frappe") as mock_frappe, patch(
+            "toolbox.doctypes.MariaDBIndex"
+        ) as mock_idx, patch.object(Table, "get_row_count", return_value=table_rows):
+            mock_idx.get_indexes.return_value = [
+                {"seq_id": 1, "column_name": "name", "cardinality": table_rows}
+            ]
+            mock_frappe.db.sql.side_effect = sql_results
+            return table.get_column_cardinality(columns), mock_frappe.db.sql
+
+    def test_cardinality_from_column_stats(self):
+        cardinality, sql = self._cardinality([[("owner", 2500.0), ("status", 200000.0)]])
+        self.assertEqual(cardinality, {"name": 1_000_000, "owner": 400, "status": 5})
+        sql.assert_called_once()
+
+    def test_cardinality_from_sample(self):
+        cardinality, sql = self._cardinality([[], [(10_000, 5, 8_000)]])
+        # owner repeats in the sample & is taken as is, status is scaled to the table's size
+        self.assertEqual(cardinality, {"name": 1_000_000, "owner": 5, "status": 800_000})
+        self.assertIn("LIMIT 10000", sql.call_args[0][0])
+
+    def test_cardinality_without_column_stats_privileges(self):
+        cardinality, _ = self._cardinality([Exception("denied"), [(500, 20, 450)]])
+        # the whole table fits in the sample
+        self.assertEqual(cardinality, {"name": 1_000_000, "owner": 20, "status": 450})
+
+    def test_score_unindexed_column(self):
+        ic = self._make_candidate(["status"], rows_examined=1000, rows_filtered=1000)
+        self._score([ic], table_rows=1000, cardinality={"status": 100})
+        # EXPLAIN filtered=100 alone would expect no rows saved
+        self.assertEqual(ic.score, 9900)
+
+    def test_score_without_explain_rows(self):
+        ic = self._make_candidate(["owner"], rows_examined=0, rows_filtered=0)
+        self._score([ic], table_rows=1000, cardinality={"owner": 10})
+        self.assertIsNone(ic.score)
+
+    @patch(
+        "toolbox.index_manager.toolbox.get_settings",
+        side_effect=lambda key: {"max_indexes_per_run": 1}.get(key, 0),
+    )
+    @patch("toolbox.index_manager.MariaDBIndex")
+    @patch("toolbox.index_manager.frappe")
+    def test_top_candidates_are_created_across_tables(self, mock_frappe, mock_idx, _):
+        from toolbox.index_manager import process_index_manager
+
+        mock_frappe.get_all.return_value = [
+            MagicMock(table=f"{name}-id", query="SELECT 1", occurrence=5, rows=1, filtered=100)
+            for name in ("tabNote", "tabToDo")
+        ]
+        mock_idx.create.return_value = []
+        candidates = {
+            "tabNote": self._make_candidate(["owner"]),
+            "tabToDo": self._make_candidate(["status"]),
+        }
+        candidates["tabNote"].score, candidates["tabToDo"].score = 10, 20
+
+        def make_table(id):
+            table = MagicMock()
+            table.name = id.removesuffix("-id")
+            table.qualify_index_candidates.return_value = [candidates[table.name]]
+            return table
+
+        with patch("toolbox.index_manager.Table", side_effect=make_table):
+            process_index_manager(skip_backtest=True)
+
+        mock_idx.create.assert_called_once_with("tabToDo", [candidates["tabToDo"]], verbose=False)
+
+
+class TestIndexBudget(unittest.TestCase):
+    """Tests for weighing index candidates against their size & write overhead."""
+
+    COLUMNS = [
+        {"name": "name", "data_type": "varchar", "column_key": "PRI", "max_length": 140},
+        {"name": "idx", "data_type": "int", "column_key": "", "max_length": None},
+        {"name": "modified", "data_type": "datetime", "column_key": "", "datetime_precision": 6},
+    ]
+
+    def _make_candidate(self, columns, score=0):
+        ic = IndexCandidate(query=Query("SELECT 1"))
+        ic.extend(columns)
+        ic.score = score
+        return ic
+
+    def test_column_widths(self):
+        self.assertEqual(get_column_width({"data_type": "bigint"}), 8)
+        self.assertEqual(get_column_width({"data_type": "decimal", "numeric_precision": 21}), 11)
+        self.assertEqual(get_column_width({"data_type": "datetime", "datetime_precision": 6}), 8)
+        self.assertEqual(get_column_width({"data_type": "varchar", "max_length": 140}), 72)
+        self.assertEqual(get_column_width({"data_type": "longtext", "max_length": 2**32}), 3072)
+
+    @patch("toolbox.utils.frappe")
+    def test_estimate_index_size(self, mock_frappe):
+        mock_frappe.db.sql.side_effect = [self.COLUMNS, [(1000, 16384)]]
+        table = Table(id="test-id", name="tabNote")
+
+        # (idx 4 + modified 8 + primary key 72 + 8 record overhead) bytes / 0.75 page fill
+        self.assertEqual(
+            table.estimate_index_size(self._make_candidate(["idx", "modified"])), 122666
+        )
+        # the primary key isn't stored twice
+        self.assertEqual(table.estimate_index_size(self._make_candidate(["name"])), 106666)
+        self.assertEqual(table.get_index_length(), 16384)
+        self.assertEqual(mock_frappe.db.sql.call_count, 2)
+
+    def test_write_cost_is_deducted_from_score(self):
+        table = Table(id="test-id", name="tabNote")
+        cheap = self._make_candidate(["idx"], score=5000)
+        marginal = self._make_candidate(["modified"], score=1000)
+
+        with patch.object(Table, "get_write_count", return_value=100):
+            kept = table.weigh_write_cost([cheap, marginal], write_cost=10)
+
+        self.assertEqual(kept, [cheap])
+        self.assertEqual(cheap.score, 4000)
+
+    def test_candidates_without_estimated_benefit_are_kept(self):
+        table = Table(id="test-id", name="tabNote")
+        unestimated = self._make_candidate(["idx"], score=None)
+
+        with patch.object(Table, "get_write_count", return_value=100):
+            self.assertEqual(table.weigh_write_cost([unestimated], write_cost=10), [unestimated])
+        self.assertIsNone(unestimated.score)
+
+    def test_candidates_saving_no_rows_are_dropped(self):
+        table = Table(id="test-id", name="tabNote")
+        useless = self._make_candidate(["idx"], score=0)
+
+        with patch.object(Table, "get_write_count", return_value=100):
+            self.assertEqual(table.weigh_write_cost([useless], write_cost=10), [])
+
+    def test_tables_without_writes_keep_candidates(self):
+        table = Table(id="test-id", name="tabNote")
+        ic = self._make_candidate(["idx"], score=1)
+
+        with patch.object(Table, "get_write_count", return_value=0):
+            self.assertEqual(table.weigh_write_cost([ic], write_cost=10), [ic])
+        self.assertEqual(ic.score, 1)
+
+    def test_index_size_budget_per_table(self):
+        from toolbox.index_manager import apply_index_size_budget
+
+        def make_table(index_length):
+            table = MagicMock()
+            table.get_index_length.return_value = index_length
+            table.estimate_index_size.side_effect = lambda ic: ic.size
+            return table
+
+        note, todo = make_table(600), make_table(0)
+        ranked = []
+        for table, size in ((note, 300), (todo, 700), (note, 100), (todo, 400)):
+            ic = self._make_candidate(["idx"])
+            ic.size = size
+            ranked.append((table, ic))
+
+        within_budget = apply_index_size_budget(ranked, 1000)
+
+        # the best ranked candidate that fits is built, smaller ones fill the remaining budget
+        self.assertEqual(within_budget, [ranked[0], ranked[1], ranked[2]])
+
+    @patch(
+        "toolbox.index_manager.toolbox.get_settings",
+        side_effect=lambda key: {"index_write_cost": 10}.get(key, 0),
+    )
+    @patch("toolbox.index_manager.MariaDBIndex")
+    @patch("toolbox.index_manager.frappe")
+    def test_write_heavy_table_is_skipped(self, mock_frappe, mock_idx, _):
+        from toolbox.index_manager import process_index_manager
+
+        mock_frappe.get_all.return_value = [
+            MagicMock(table="tabNote-id", query="SELECT 1", occurrence=5, rows=1, filtered=100)
+        ]
+        table = MagicMock()
+        table.name = "tabNote"
+        table.qualify_index_candidates.return_value = [self._make_candidate(["idx"], score=100)]
+        table.weigh_write_cost.return_value = []
+
+        with patch("toolbox.index_manager.Table", return_value=table):
+            process_index_manager(skip_backtest=True)
+
+        table.weigh_write_cost.assert_called_once_with(
+            table.qualify_index_candidates.return_value, 10
+        )
+        mock_idx.create.assert_not_called()
+
+
+class TestWhatIfAnalysis(unittest.TestCase):
+    """Tests for predicting index candidate gains on a sampled shadow table."""
+
+    def _make_analysis(self, sql="SELECT * FROM `tabNote` WHERE `tabNote`.`owner` = 'x'"):
+        query = Query(sql)
+        ic = IndexCandidate(query=query)
+        ic.append("owner")
+        analysis = WhatIfAnalysis(Table(id="test-id", name="tabNote"), [ic])
+        analysis.shadow_table = "_toolbox_what_if_test"
+        return analysis, ic
+
+    def _is_helpful(self, before, after):
+        analysis, ic = self._make_analysis()
+        with patch("toolbox.utils.frappe") as mock_frappe, patch(
+            "toolbox.doctypes.MariaDBIndex"
+        ) as mock_idx:
+            mock_frappe.db.sql.side_effect = [before, after]
+            mock_idx.create.return_value = []
+            helpful = analysis.is_helpful(ic)
+        mock_idx.drop.assert_called_once_with("_toolbox_what_if_test", [ic], verbose=False)
+        return helpful
+
+    def test_shadow_sql_replaces_table_references(self):
+        analysis, ic = self._make_analysis()
+        self.assertEqual(
+            analysis.get_shadow_sql(ic.query.sql),
+            "SELECT * FROM `_toolbox_what_if_test` WHERE `_toolbox_what_if_test`.`owner` = 'x'",
+        )
+        self.assertEqual(
+            analysis.get_shadow_sql("SELECT name FROM tabNote WHERE tabNoteItem = 1"),
+            "SELECT name FROM `_toolbox_what_if_test` WHERE tabNoteItem = 1",
+        )
+
+    def test_candidate_reading_fewer_rows_is_helpful(self):
+        before = [{"key": None, "rows": 1000, "filtered": 10, "Extra": "Using where"}]
+        after = [{"key": "toolbox_index_owner", "rows": 10, "filtered": 100, "Extra": ""}]
+        self.assertTrue(self._is_helpful(before, after))
+
+    def test_unused_candidate_is_not_helpful(self):
+        before = [{"key": None, "rows": 1000, "filtered": 10, "Extra": "Using where"}]
+        self.assertFalse(self._is_helpful(before, before))
+
+    def test_candidate_skipping_filesort_is_helpful(self):
+        before = [{"key": None, "rows": 100, "filtered": 100, "Extra": "Using filesort"}]
+        after = [{"key": "toolbox_index_owner", "rows": 100, "filtered": 100, "Extra": ""}]
+        self.assertTrue(self._is_helpful(before, after))
+
+    def test_unexplainable_candidate_is_kept(self):
+        analysis, ic = self._make_analysis()
+        with patch("toolbox.utils.frappe") as mock_frappe, patch(
+            "toolbox.doctypes.MariaDBIndex"
+        ) as mock_idx:
+            mock_frappe.db.sql.side_effect = Exception("syntax error")
+            self.assertTrue(analysis.is_helpful(ic))
+        mock_idx.create.assert_not_called()
+
+    def _enter(self, mock_frappe, primary_key=("name",)):
+        analysis, _ = self._make_analysis()
+        with patch.object(Table, "get_row_count", return_value=1_000_000), patch.object(
+            Table, "get_primary_key", return_value=list(primary_key)
+        ):
+            with analysis:
+                pass
+        return [c.args for c in mock_frappe.db.sql.call_args_list]
+
+    @patch("toolbox.utils.frappe")
+    def test_shadow_table_is_sampled_and_dropped(self, mock_frappe):
+        mock_frappe.cache.get_value.return_value = None
+        mock_frappe.db.sql.side_effect = lambda query, *args, **kwargs: (
+            [("REPEATABLE-READ",)] if "tx_isolation" in query and not args else []
+        )
+
+        queries = self._enter(mock_frappe, primary_key=())
+
+        ddl = [c.args[0] for c in mock_frappe.db.sql_ddl.call_args_list]
+        self.assertEqual(
+            ddl,
+            [
+                "CREATE TABLE `_toolbox_what_if_test` LIKE `tabNote`",
+                "DROP TABLE IF EXISTS `_toolbox_what_if_test`",
+            ],
+        )
+        _, set_isolation, insert, restore_isolation, analyze = queries
+        self.assertIn("READ COMMITTED", set_isolation[0])
+        self.assertNotIn("LIMIT", insert[0])
+        self.assertEqual(insert[1], (0.1,))
+        self.assertEqual(restore_isolation[1], "REPEATABLE-READ")
+        self.assertIn("PERSISTENT FOR COLUMNS (`owner`) INDEXES ALL", analyze[0])
+
+    @patch("toolbox.utils.frappe")
+    def test_sample_is_copied_in_primary_key_ranges(self, mock_frappe):
+        mock_frappe.cache.get_value.return_value = None
+        bounds = iter([[("b",)], [("d",)], []])
+
+        def sql(query, *args, **kwargs):
+            if "tx_isolation" in query and not args:
+                return [("REPEATABLE-READ",)]
+            if query.startswith("SELECT `name`"):
+                return next(bounds)
+            return []
+
+        mock_frappe.db.sql.side_effect = sql
+
+        queries = self._enter(mock_frappe)
+
+        inserts = [args[:2] for args in queries if args[0].startswith("INSERT")]
+        self.assertEqual(
+            inserts,
+            [
+                (
+                    "INSERT INTO `_toolbox_what_if_test` SELECT * FROM `tabNote` "
+                    "WHERE `name` <= %s AND RAND() < %s",
+                    ("b", 0.1),
+                ),
+                (
+                    "INSERT INTO `_toolbox_what_if_test` SELECT * FROM `tabNote` "
+                    "WHERE `name` > %s AND `name` <= %s AND RAND() < %s",
+                    ("b", "d", 0.1),
+                ),
+                (
+                    "INSERT INTO `_toolbox_what_if_test` SELECT * FROM `tabNote` "
+                    "WHERE `name` > %s AND RAND() < %s",
+                    ("d", 0.1),
+                ),
+            ],
+        )
+        # every range is committed on its own
+        self.assertGreaterEqual(mock_frappe.db.commit.call_count, 4)
+
+    @patch("toolbox.utils.frappe")
+    def test_cached_verdicts_skip_shadow_table(self, mock_frappe):
+        mock_frappe.cache.get_value.return_value = 0
+        analysis, _ = self._make_analysis()
+
+        with analysis:
+            self.assertEqual(analysis.get_helpful_index_candidates(), [])
+
+        mock_frappe.db.sql_ddl.assert_not_called()
+        mock_frappe.db.sql.assert_not_called()
+
+    def test_verdict_is_cached(self):
+        before = [{"key": None, "rows": 1000, "filtered": 10, "Extra": "Using where"}]
+        after = [{"key": "toolbox_index_owner", "rows": 10, "filtered": 100, "Extra": ""}]
+        analysis, ic = self._make_analysis()
+        with patch("toolbox.utils.frappe") as mock_frappe, patch(
+            "toolbox.doctypes.MariaDBIndex"
+        ) as mock_idx:
+            mock_frappe.db.sql.side_effect = [before, after]
+            mock_idx.create.return_value = []
+            analysis.is_helpful(ic)
+
+        mock_frappe.cache.set_value.assert_called_once_with(
+            analysis.get_verdict_key(ic), 1, expires_in_sec=WHAT_IF_VERDICT_TTL
+        )
+
+
 class TestToolboxIndexPrefix(unittest.TestCase):
     """Test that toolbox_index_ prefix is applied correctly."""
 
@@ -1,6 +1,7 @@
 # Copyright (c) 2023, Gavin D'souza and Contributors
 # See license.txt
 
+import json
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -184,6 +185,41 @@ class TestUtilHelpers(unittest.TestCase):
 
         self.assertEqual(wrap("0"), 0.0)
 
+    @patch("toolbox.utils.frappe")
+    def test_explain_queries_closes_worker_connections(self, mock_frappe):
+        from toolbox.utils import explain_queries
+
+        main_db = mock_frappe.db
+        worker_db = mock_frappe.local.db
+        mock_frappe.db.sql.return_value = [{"table": "tabNote"}]
+
+        explain_queries(["SELECT 1", "SELECT 2"], concurrency=2)
+
+        main_db.close.assert_not_called()
+        worker_db.close.assert_called()
+
+    @patch("toolbox.utils.frappe")
+    def test_record_database_state_counts_write_queries(self, mock_frappe):
+        from toolbox.utils import record_database_state
+
+        mock_frappe.get_all.return_value = [
+            {"parameterized_query": "SELECT `name` FROM `tabNote`", "table": "note-id"},
+            {"parameterized_query": " insert into `tabNote` values (%s)", "table": "note-id"},
+            {"parameterized_query": "UPDATE `tabNote` SET `title` = %s", "table": "note-id"},
+        ]
+
+        record_database_state()
+
+        mock_frappe.db.set_value.assert_called_once()
+        self.assertEqual(
+            mock_frappe.db.set_value.call_args[0][:3],
+            ("MariaDB Table", "note-id", "table_category_meta"),
+        )
+        self.assertEqual(
+            json.loads(mock_frappe.db.set_value.call_args[0][3]),
+            {"total_queries": 3, "write_queries": 2},
+        )
+
     @patch("toolbox.utils.secho")
     def test_check_dbms_compatibility_warns_non_mariadb(self, mock_secho):
         from toolbox.utils import check_dbms_compatibility
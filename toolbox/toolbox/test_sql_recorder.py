@@ -1,19 +1,54 @@
 # Copyright (c) 2023, Gavin D'souza and Contributors
 # See license.txt
 
+import json
+import pickle
 import unittest
 from collections import Counter
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
 from toolbox.sql_recorder import (
+    CLAIM_CHUNK_SCRIPT,
+    HISTOGRAM_BUCKETS,
+    HISTOGRAM_MIN_TIME,
+    PARAMETER_MAX_LENGTH,
+    PARAMETER_SAMPLES,
+    REPLACE_FLAG_SCRIPT,
+    SAMPLE_PARAMETERS_SCRIPT,
+    TOOLBOX_RECORDER_CHUNKS,
     TOOLBOX_RECORDER_DATA,
+    TOOLBOX_RECORDER_DROPPED,
     TOOLBOX_RECORDER_FLAG,
+    TOOLBOX_RECORDER_FLAG_TTL,
+    TOOLBOX_RECORDER_PROCESSING,
+    TOOLBOX_RECORDER_SHARDS,
+    TOOLBOX_RECORDER_STATS,
+    UPDATE_EXTREMES_SCRIPT,
+    RecorderFlusher,
     SQLRecorder,
     _patch,
+    _recorder_flag_cache,
     _unpatch,
     after_hook,
+    after_job_hook,
     before_hook,
+    clear_recorder_flag_cache,
+    fingerprint_query,
+    flush_recorder,
+    get_chunk_key,
+    get_chunk_stats,
+    get_chunk_stats_key,
     get_current_stack_frames,
+    get_histogram_bucket,
+    get_histogram_percentile,
+    get_parameter_sample,
+    get_query_data_key,
+    get_query_digest,
+    get_query_stats_key,
+    get_recorder_flusher,
+    is_recorder_enabled,
+    iter_recorded_chunks,
+    release_recorded_chunk,
     sql,
 )
 
@@ -21,89 +56,609 @@ from toolbox.sql_recorder import (
 class TestSQLRecorderClass(unittest.TestCase):
     """Unit tests for the SQLRecorder accumulator class."""
 
+    def setUp(self):
+        # an unstarted flusher, so writes happen only when a test flushes
+        patcher = patch("toolbox.sql_recorder._flusher", RecorderFlusher())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_init_empty(self):
         recorder = SQLRecorder()
-        self.assertEqual(recorder.queries, [])
+        self.assertEqual(recorder.stats, {})
 
     def test_register_single_query(self):
         recorder = SQLRecorder()
-        recorder.register("SELECT 1")
-        self.assertEqual(recorder.queries, ["SELECT 1"])
+        recorder.register("SELECT a")
+        self.assertEqual(list(recorder.stats), ["SELECT a"])
+        self.assertEqual(recorder.stats["SELECT a"].count, 1)
 
     def test_register_multiple_queries(self):
         recorder = SQLRecorder()
-        recorder.register("SELECT 1")
-        recorder.register("SELECT 2")
-        recorder.register("SELECT 1")
-        self.assertEqual(recorder.queries, ["SELECT 1", "SELECT 2", "SELECT 1"])
-
-    def test_register_preserves_duplicates(self):
-        """Queries are accumulated raw — deduplication happens in dump()."""
+        recorder.register("SELECT a")
+        recorder.register("SELECT b")
+        recorder.register("SELECT a")
+        self.assertEqual(list(recorder.stats), ["SELECT a", "SELECT b"])
+        self.assertEqual(recorder.stats["SELECT a"].count, 2)
+        self.assertEqual(recorder.stats["SELECT b"].count, 1)
+
+    def test_register_aggregates_duplicates_in_place(self):
+        """Repeated queries are counted as they arrive rather than kept around."""
         recorder = SQLRecorder()
         for _ in range(5):
-            recorder.register("SELECT 1")
-        self.assertEqual(len(recorder.queries), 5)
+            recorder.register("SELECT a")
+        self.assertEqual(len(recorder.stats), 1)
+        self.assertEqual(recorder.stats["SELECT a"].count, 5)
+
+    @patch("toolbox.sql_recorder.TOOLBOX_RECORDER_MAX_QUERIES", 2)
+    @patch("toolbox.sql_recorder.frappe")
+    def test_register_flushes_early_at_max_queries(self, mock_frappe):
+        mock_cache = MagicMock()
+        mock_frappe.cache = mock_cache
+        mock_cache.make_key.side_effect = lambda k: k
+        mock_pipe = mock_cache.pipeline.return_value
+
+        recorder = SQLRecorder()
+        for _ in range(3):
+            recorder.register("SELECT a")
+        recorder.register("SELECT b")
+        mock_cache.pipeline.assert_not_called()
+
+        recorder.register("SELECT c")
+        flush_recorder()
+        mock_pipe.hincrby.assert_any_call(get_query_data_key("SELECT a"), "SELECT a", 3)
+        mock_pipe.hincrby.assert_any_call(get_query_data_key("SELECT b"), "SELECT b", 1)
+        self.assertEqual(list(recorder.stats), ["SELECT c"])
 
     @patch("toolbox.sql_recorder.frappe")
     def test_dump_empty_queries_noop(self, mock_frappe):
         """dump() with no queries should not touch Redis at all."""
         recorder = SQLRecorder()
         recorder.dump()
+        flush_recorder()
         mock_frappe.cache.pipeline.assert_not_called()
 
     @patch("toolbox.sql_recorder.frappe")
-    def test_dump_deduplicates_via_counter(self, mock_frappe):
-        """dump() should aggregate identical queries using Counter before Redis ops."""
+    def test_dump_deduplicates_queries(self, mock_frappe):
+        """dump() should write each distinct query once with its occurrence count."""
         mock_cache = MagicMock()
         mock_frappe.cache = mock_cache
         mock_pipe = MagicMock()
         mock_cache.pipeline.return_value = mock_pipe
 
         recorder = SQLRecorder()
-        recorder.register("SELECT 1")
-        recorder.register("SELECT 1")
-        recorder.register("SELECT 2")
+        recorder.register("SELECT a")
+        recorder.register("SELECT a")
+        recorder.register("SELECT b")
 
-        # hsetnx returns True if key was set (new), False if existed
-        mock_cache.hsetnx.return_value = True
+        mock_cache.make_key.side_effect = lambda k: k
         recorder.dump()
+        flush_recorder()
 
-        # Counter should produce: {"SELECT 1": 2, "SELECT 2": 1}
-        # hsetnx called for each unique query
-        self.assertEqual(mock_cache.hsetnx.call_count, 2)
+        # one increment for each unique query
+        mock_pipe.hincrby.assert_any_call(get_query_data_key("SELECT a"), "SELECT a", 2)
+        mock_pipe.hincrby.assert_any_call(get_query_data_key("SELECT b"), "SELECT b", 1)
         mock_pipe.execute.assert_called_once()
-        # queries list should be cleared after dump
-        self.assertEqual(recorder.queries, [])
+        # aggregated queries should be cleared after dump
+        self.assertEqual(recorder.stats, {})
 
     @patch("toolbox.sql_recorder.frappe")
-    def test_dump_hincrby_when_key_exists(self, mock_frappe):
-        """When hsetnx returns False (key exists), hincrby should be pipelined."""
+    def test_dump_single_round_trip(self, mock_frappe):
+        """All writes go through one non-transactional pipeline - no per-query round trips."""
         mock_cache = MagicMock()
         mock_frappe.cache = mock_cache
         mock_pipe = MagicMock()
         mock_cache.pipeline.return_value = mock_pipe
+        mock_cache.make_key.side_effect = lambda k: k
 
         recorder = SQLRecorder()
-        recorder.register("SELECT 1")
-
-        # hsetnx returns False — key already existed
-        mock_cache.hsetnx.return_value = False
+        for i in range(300):
+            recorder.register(f"SELECT `col{i}` FROM t")
         recorder.dump()
+        flush_recorder()
 
-        key = mock_cache.make_key.return_value
-        mock_pipe.hincrby.assert_called_once_with(key, "SELECT 1", 1)
+        mock_cache.pipeline.assert_called_once_with(transaction=False)
+        mock_pipe.hincrby.assert_any_call(
+            get_query_data_key("SELECT `col0` FROM t"), "SELECT `col0` FROM t", 1
+        )
+        mock_pipe.eval.assert_called_once()
+        mock_pipe.execute.assert_called_once()
+        mock_cache.hsetnx.assert_not_called()
+        mock_cache.hincrby.assert_not_called()
 
     @patch("toolbox.sql_recorder.frappe")
     def test_dump_clears_queries(self, mock_frappe):
         mock_cache = MagicMock()
         mock_frappe.cache = mock_cache
         mock_cache.pipeline.return_value = MagicMock()
-        mock_cache.hsetnx.return_value = True
 
         recorder = SQLRecorder()
-        recorder.register("SELECT 1")
+        recorder.register("SELECT a")
+        recorder.dump()
+        flush_recorder()
+        self.assertEqual(recorder.stats, {})
+
+
+class TestQueryStats(unittest.TestCase):
+    """Tests for per-query execution time & row tracking."""
+
+    def setUp(self):
+        # an unstarted flusher, so writes happen only when a test flushes
+        patcher = patch("toolbox.sql_recorder._flusher", RecorderFlusher())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_register_aggregates_stats(self):
+        recorder = SQLRecorder()
+        recorder.register("SELECT a", 2.0, 1)
+        recorder.register("SELECT a", 4.0, 3)
+
+        stats = recorder.stats["SELECT a"]
+        self.assertEqual(stats.total_time, 6.0)
+        self.assertEqual(stats.total_time_squared, 20.0)
+        self.assertEqual(stats.min_time, 2.0)
+        self.assertEqual(stats.max_time, 4.0)
+        self.assertEqual(stats.total_rows, 4)
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_dump_flushes_stats_in_same_pipeline(self, mock_frappe):
+        mock_cache = MagicMock()
+        mock_frappe.cache = mock_cache
+        mock_pipe = MagicMock()
+        mock_cache.pipeline.return_value = mock_pipe
+        mock_cache.make_key.side_effect = lambda k: k
+
+        recorder = SQLRecorder(sample_rate=50)
+        recorder.register("SELECT a", 2.0, 1)
+        recorder.register("SELECT a", 4.0, 3)
         recorder.dump()
-        self.assertEqual(recorder.queries, [])
+        flush_recorder()
+
+        stats_key = get_query_stats_key("SELECT a")
+        mock_pipe.hincrbyfloat.assert_any_call(stats_key, "time", 12.0)
+        mock_pipe.hincrbyfloat.assert_any_call(stats_key, "time_sq", 40.0)
+        mock_pipe.hincrby.assert_any_call(stats_key, "rows", 8)
+        mock_pipe.hincrby.assert_any_call(stats_key, f"h{get_histogram_bucket(2.0)}", 2)
+        mock_pipe.hincrby.assert_any_call(stats_key, f"h{get_histogram_bucket(4.0)}", 2)
+        mock_pipe.eval.assert_called_once_with(UPDATE_EXTREMES_SCRIPT, 1, stats_key, 2.0, 4.0)
+        mock_pipe.execute.assert_called_once()
+        self.assertEqual(recorder.stats, {})
+
+    def test_stats_key_is_stable_per_query(self):
+        self.assertEqual(get_query_stats_key("SELECT a"), get_query_stats_key("SELECT a"))
+        self.assertNotEqual(get_query_stats_key("SELECT a"), get_query_stats_key("SELECT b"))
+        self.assertTrue(get_query_stats_key("SELECT a").startswith(TOOLBOX_RECORDER_STATS))
+        # shared with MariaDB Query's query_hash column
+        self.assertEqual(
+            get_query_stats_key("SELECT a").split(":")[-1], get_query_digest("SELECT a")
+        )
+        self.assertEqual(len(get_query_digest("SELECT a")), 32)
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_get_chunk_stats(self, mock_frappe):
+        mock_pipe = MagicMock()
+        mock_frappe.cache.make_key.side_effect = lambda k: k
+        mock_frappe.cache.pipeline.return_value = mock_pipe
+        mock_pipe.execute.return_value = [
+            {b"time": b"6.5", b"rows": b"4", b"min_time": b"2", b"max_time": b"4.5", b"h40": b"2"},
+            {},
+        ]
+
+        stats = get_chunk_stats("abc", ["SELECT a", "SELECT b"])
+
+        mock_pipe.execute_command.assert_any_call(
+            "HGETALL", get_chunk_stats_key("abc", "SELECT a")
+        )
+        self.assertEqual(
+            stats,
+            {
+                "SELECT a": {
+                    "time": 6.5,
+                    "rows": 4.0,
+                    "min_time": 2.0,
+                    "max_time": 4.5,
+                    "histogram": {40: 2},
+                }
+            },
+        )
+
+
+class TestShardedStorage(unittest.TestCase):
+    """Tests for spreading recorded queries over hash shards & draining them."""
+
+    def test_queries_spread_over_shards(self):
+        keys = {get_query_data_key(f"SELECT `col{i}` FROM t") for i in range(200)}
+        self.assertEqual(len(keys), TOOLBOX_RECORDER_SHARDS)
+        self.assertTrue(all(key.startswith(f"{TOOLBOX_RECORDER_DATA}:") for key in keys))
+        self.assertEqual(get_query_data_key("SELECT a"), get_query_data_key("SELECT a"))
+
+    @patch("toolbox.sql_recorder.TOOLBOX_RECORDER_SHARDS", 2)
+    @patch("toolbox.sql_recorder.frappe")
+    def test_renames_then_claims_chunks_of_each_shard(self, mock_frappe):
+        mock_cache = mock_frappe.cache
+        mock_cache.make_key.side_effect = lambda k: k
+        mock_frappe.generate_hash.side_effect = ["c1", "c2"]
+
+        def execute_command(cmd, *args):
+            if cmd == "SMEMBERS":
+                return set()
+            # shard 0 has data, shard 1 is empty
+            return cmd == "EXISTS" and args[0] == f"{TOOLBOX_RECORDER_DATA}:0"
+
+        mock_cache.execute_command.side_effect = execute_command
+        mock_cache.hscan.side_effect = [
+            (7, {b"SELECT a": b"2"}),
+            (0, {b"SELECT b": b"1"}),
+            (0, {}),
+        ]
+        mock_cache.eval.side_effect = [[b"SELECT a", b"2"], [b"SELECT b", b"1"]]
+
+        chunks = list(iter_recorded_chunks())
+
+        self.assertEqual(chunks, [("c1", {"SELECT a": 2}), ("c2", {"SELECT b": 1})])
+        mock_cache.execute_command.assert_any_call(
+            "RENAMENX", f"{TOOLBOX_RECORDER_DATA}:0", f"{TOOLBOX_RECORDER_PROCESSING}:0"
+        )
+        self.assertNotIn(
+            call("RENAMENX", f"{TOOLBOX_RECORDER_DATA}:1", f"{TOOLBOX_RECORDER_PROCESSING}:1"),
+            mock_cache.execute_command.call_args_list,
+        )
+        mock_cache.hscan.assert_any_call(f"{TOOLBOX_RECORDER_PROCESSING}:0", 7, count=ANY)
+        mock_cache.eval.assert_any_call(
+            CLAIM_CHUNK_SCRIPT,
+            5,
+            f"{TOOLBOX_RECORDER_PROCESSING}:0",
+            get_chunk_key("c1"),
+            TOOLBOX_RECORDER_CHUNKS,
+            get_query_stats_key("SELECT a"),
+            get_chunk_stats_key("c1", "SELECT a"),
+            "c1",
+            b"SELECT a",
+        )
+        mock_cache.hgetall.assert_not_called()
+
+    @patch("toolbox.sql_recorder.TOOLBOX_RECORDER_CHUNK_SIZE", 2)
+    @patch("toolbox.sql_recorder.TOOLBOX_RECORDER_SHARDS", 1)
+    @patch("toolbox.sql_recorder.frappe")
+    def test_chunks_bounded_by_chunk_size(self, mock_frappe):
+        mock_cache = mock_frappe.cache
+        mock_cache.execute_command.return_value = set()
+        # HSCAN's COUNT is only a hint - small hashes come back whole
+        mock_cache.hscan.return_value = (
+            0,
+            {b"SELECT a": b"1", b"SELECT b": b"1", b"SELECT c": b"1"},
+        )
+        # every field passed to the claim script gets claimed with an occurrence of 1
+        mock_cache.eval.side_effect = lambda script, numkeys, *args: [
+            value for field in args[numkeys + 1 :] for value in (field, b"1")
+        ]
+
+        chunks = [queries for _, queries in iter_recorded_chunks()]
+
+        self.assertEqual([len(queries) for queries in chunks], [2, 1])
+
+    @patch("toolbox.sql_recorder.TOOLBOX_RECORDER_SHARDS", 0)
+    @patch("toolbox.sql_recorder.frappe")
+    def test_interrupted_chunks_yielded_first(self, mock_frappe):
+        mock_cache = mock_frappe.cache
+        mock_cache.make_key.side_effect = lambda k: k
+        mock_cache.execute_command.side_effect = lambda cmd, *args: (
+            {b"c0"} if cmd == "SMEMBERS" else {b"SELECT a": b"3"}
+        )
+
+        chunks = list(iter_recorded_chunks())
+
+        self.assertEqual(chunks, [("c0", {"SELECT a": 3})])
+        mock_cache.execute_command.assert_any_call("HGETALL", get_chunk_key("c0"))
+        mock_cache.eval.assert_not_called()
+
+    @patch("toolbox.patches.shard_recorded_queries.frappe")
+    def test_patch_moves_unsharded_queries_into_shards(self, mock_frappe):
+        from toolbox.patches.shard_recorded_queries import execute
+
+        mock_cache = mock_frappe.cache
+        mock_cache.make_key.side_effect = lambda k: k
+        mock_cache.execute_command.return_value = 1
+        mock_cache.hscan.side_effect = [(7, {b"SELECT a": b"2"}), (0, {b"SELECT b": b"1"})]
+        mock_pipe = mock_cache.pipeline.return_value
+
+        execute()
+
+        mock_pipe.hincrby.assert_has_calls(
+            [
+                call(get_query_data_key("SELECT a"), b"SELECT a", 2),
+                call(get_query_data_key("SELECT b"), b"SELECT b", 1),
+            ]
+        )
+        mock_pipe.hdel.assert_has_calls(
+            [call(TOOLBOX_RECORDER_DATA, b"SELECT a"), call(TOOLBOX_RECORDER_DATA, b"SELECT b")]
+        )
+        self.assertEqual(mock_pipe.execute.call_count, 2)
+
+    @patch("toolbox.patches.shard_recorded_queries.frappe")
+    def test_patch_skips_missing_unsharded_hash(self, mock_frappe):
+        from toolbox.patches.shard_recorded_queries import execute
+
+        mock_frappe.cache.execute_command.return_value = 0
+
+        execute()
+
+        mock_frappe.cache.hscan.assert_not_called()
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_release_deletes_chunk_data(self, mock_frappe):
+        mock_frappe.cache.make_key.side_effect = lambda k: k
+        mock_pipe = mock_frappe.cache.pipeline.return_value
+
+        release_recorded_chunk("c1", ["SELECT a"])
+
+        mock_pipe.execute_command.assert_any_call(
+            "DEL", get_chunk_key("c1"), get_chunk_stats_key("c1", "SELECT a")
+        )
+        mock_pipe.execute_command.assert_any_call("SREM", TOOLBOX_RECORDER_CHUNKS, "c1")
+        mock_pipe.execute.assert_called_once()
+
+
+class TestFingerprintQuery(unittest.TestCase):
+    """Tests for literal-normalizing query fingerprints."""
+
+    def test_literals_become_placeholders(self):
+        self.assertEqual(
+            fingerprint_query("SELECT name FROM `tabUser` WHERE name = 'Admin' AND age > 30"),
+            "SELECT name FROM `tabUser` WHERE name = %s AND age > %s",
+        )
+        self.assertEqual(
+            fingerprint_query('SELECT * FROM t WHERE a = "it\\"s" AND b = 0xFF AND c = 1.5e3'),
+            "SELECT * FROM t WHERE a = %s AND b = %s AND c = %s",
+        )
+
+    def test_same_shape_shares_fingerprint(self):
+        self.assertEqual(
+            fingerprint_query("SELECT * FROM t WHERE name = 'SINV-0001'"),
+            fingerprint_query("SELECT * FROM t WHERE name = 'SINV-0002'"),
+        )
+
+    def test_lists_are_collapsed(self):
+        self.assertEqual(
+            fingerprint_query("SELECT * FROM t WHERE name IN ('a', 'b', 'c')"),
+            fingerprint_query("SELECT * FROM t WHERE name IN ('a')"),
+        )
+        self.assertEqual(
+            fingerprint_query("INSERT INTO t (a, b) VALUES (1, 'x'), (2, 'y')"),
+            "INSERT INTO t (a, b) VALUES (%s, %s)",
+        )
+
+    def test_identifiers_and_placeholders_are_kept(self):
+        self.assertEqual(
+            fingerprint_query("SELECT `col1`, `a  b` FROM `tab2` WHERE x = %(x)s AND y = %s"),
+            "SELECT `col1`, `a  b` FROM `tab2` WHERE x = %(x)s AND y = %s",
+        )
+        self.assertEqual(fingerprint_query("SELECT `x`-1 FROM t2"), "SELECT `x`-%s FROM t2")
+
+    def test_comments_and_whitespace_are_normalized(self):
+        self.assertEqual(
+            fingerprint_query("SELECT a  /* hint */\n FROM t -- trailing\nWHERE b = 1 # note"),
+            "SELECT a FROM t WHERE b = %s",
+        )
+
+    def test_register_stores_fingerprint(self):
+        recorder = SQLRecorder()
+        recorder.register("SELECT * FROM t WHERE name = 'a'")
+        recorder.register("SELECT * FROM t WHERE name = 'b'")
+        self.assertEqual(list(recorder.stats), ["SELECT * FROM t WHERE name = %s"])
+        self.assertEqual(recorder.stats["SELECT * FROM t WHERE name = %s"].count, 2)
+
+
+class TestParameterSamples(unittest.TestCase):
+    """Tests for reservoir sampling the parameter values of recorded queries."""
+
+    def setUp(self):
+        patcher = patch("toolbox.sql_recorder._flusher", RecorderFlusher())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_positional_values(self):
+        query = "SELECT name FROM tabUser WHERE owner = %s AND creation > %s"
+        self.assertEqual(
+            get_parameter_sample(query, query, ("Administrator", 5)), '["Administrator",5]'
+        )
+
+    def test_named_values(self):
+        query = "SELECT name FROM tabUser WHERE owner = %(owner)s"
+        self.assertEqual(
+            get_parameter_sample(query, query, {"owner": "Guest", "unused": 1}),
+            '{"owner":"Guest"}',
+        )
+
+    def test_values_not_matching_fingerprint_are_skipped(self):
+        query = "SELECT name FROM tabUser WHERE owner = %s AND enabled = 1"
+        fingerprint = fingerprint_query(query)
+        self.assertIsNone(get_parameter_sample(query, fingerprint, ("Guest",)))
+        self.assertIsNone(get_parameter_sample(query, query, (b"binary",)))
+
+    def test_values_are_capped_and_hashed(self):
+        query = "SELECT name FROM tabUser WHERE owner IN %s AND bio = %s"
+        params = get_parameter_sample(query, query, (tuple(range(20)), "x" * 500))
+        owners, bio = json.loads(params)
+        self.assertEqual(len(owners), 10)
+        self.assertEqual(len(bio), PARAMETER_MAX_LENGTH)
+
+        hashed = json.loads(get_parameter_sample(query, query, ((1,), "secret"), True))
+        self.assertEqual(hashed[0], [1])
+        self.assertEqual(list(hashed[1]), ["sha1"])
+        self.assertNotIn("secret", hashed[1]["sha1"])
+
+    def test_recorder_keeps_a_reservoir(self):
+        recorder = SQLRecorder(parameter_samples="Values")
+        for i in range(100):
+            recorder.register("SELECT name FROM tabUser WHERE idx = %s", 1.0, 1, (i,))
+
+        stats = recorder.stats["SELECT name FROM tabUser WHERE idx = %s"]
+        self.assertEqual(len(stats.params), PARAMETER_SAMPLES)
+        self.assertEqual(stats.params_seen, 100)
+
+    def test_recorder_skips_write_queries(self):
+        recorder = SQLRecorder(parameter_samples="Values")
+        recorder.register(
+            "UPDATE `__Auth` SET `password` = %s WHERE `name` = %s", 1.0, 1, ("x", "y")
+        )
+        recorder.register("INSERT INTO `tabNote` (`title`) VALUES (%s)", 1.0, 1, ("secret",))
+
+        for stats in recorder.stats.values():
+            self.assertEqual(stats.params, [])
+            self.assertEqual(stats.params_seen, 0)
+
+    def test_recorder_without_parameter_samples(self):
+        recorder = SQLRecorder(parameter_samples="Off")
+        recorder.register("SELECT name FROM tabUser WHERE idx = %s", 1.0, 1, (1,))
+        self.assertEqual(recorder.stats["SELECT name FROM tabUser WHERE idx = %s"].params, [])
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_samples_are_flushed_with_stats(self, mock_frappe):
+        mock_frappe.cache.make_key.side_effect = lambda k: k
+        mock_pipe = mock_frappe.cache.pipeline.return_value
+
+        recorder = SQLRecorder(parameter_samples="Values")
+        recorder.register("SELECT a FROM t WHERE b = %s", 1.0, 1, ("x",))
+        recorder.dump()
+        flush_recorder()
+
+        stats_key = get_query_stats_key("SELECT a FROM t WHERE b = %s")
+        mock_pipe.eval.assert_any_call(
+            SAMPLE_PARAMETERS_SCRIPT, 1, stats_key, PARAMETER_SAMPLES, ANY, '["x"]'
+        )
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_get_chunk_stats_reads_samples(self, mock_frappe):
+        mock_frappe.cache.make_key.side_effect = lambda k: k
+        mock_frappe.cache.pipeline.return_value.execute.return_value = [
+            {b"time": b"1", b"p0": b'["x"]', b"p1": b'["y"]', b"params_seen": b"7"}
+        ]
+
+        stats = get_chunk_stats("abc", ["SELECT a FROM t WHERE b = %s"])
+
+        self.assertEqual(
+            stats["SELECT a FROM t WHERE b = %s"],
+            {"time": 1.0, "histogram": {}, "params": [["x"], ["y"]]},
+        )
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    """Tests for the fixed log-scale latency histogram."""
+
+    def test_buckets_are_monotonic(self):
+        durations = [0.0, 0.005, 0.01, 0.1, 1, 10, 100, 1_000, 10_000]
+        buckets = [get_histogram_bucket(d) for d in durations]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[0], 0)
+        self.assertEqual(get_histogram_bucket(HISTOGRAM_MIN_TIME / 2), 0)
+
+    def test_slow_queries_land_in_last_bucket(self):
+        self.assertEqual(get_histogram_bucket(10**9), HISTOGRAM_BUCKETS - 1)
+
+    def test_recorder_fills_histogram(self):
+        recorder = SQLRecorder()
+        for duration in (1.0, 1.0, 50.0):
+            recorder.register("SELECT a", duration)
+
+        histogram = recorder.stats["SELECT a"].histogram
+        self.assertEqual(histogram[get_histogram_bucket(1.0)], 2)
+        self.assertEqual(histogram[get_histogram_bucket(50.0)], 1)
+
+    def test_percentile_estimate_within_bucket_error(self):
+        histogram = {}
+        durations = [1.0] * 90 + [100.0] * 9 + [1_000.0]
+        for duration in durations:
+            bucket = get_histogram_bucket(duration)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        for percentile, expected in ((50, 1.0), (95, 100.0), (99, 100.0), (100, 1_000.0)):
+            estimate = get_histogram_percentile(histogram, percentile)
+            self.assertAlmostEqual(estimate / expected, 1, delta=0.15)
+
+    def test_percentile_of_empty_histogram(self):
+        self.assertIsNone(get_histogram_percentile({}, 50))
+
+
+class TestRecorderFlusher(unittest.TestCase):
+    """Tests for handing recorder dumps to the per-process background flusher."""
+
+    def setUp(self):
+        self.flusher = RecorderFlusher()
+        patcher = patch("toolbox.sql_recorder._flusher", self.flusher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_dump_does_not_touch_redis(self, mock_frappe):
+        recorder = SQLRecorder()
+        recorder.register("SELECT a")
+        recorder.dump()
+
+        mock_frappe.cache.pipeline.assert_not_called()
+        self.assertEqual(self.flusher.queue.qsize(), 1)
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_flush_batches_many_dumps(self, mock_frappe):
+        mock_cache = mock_frappe.cache
+        mock_cache.make_key.side_effect = lambda k: k
+        mock_pipe = mock_cache.pipeline.return_value
+
+        for _ in range(3):
+            recorder = SQLRecorder()
+            recorder.register("SELECT a", 2.0)
+            recorder.dump()
+        flush_recorder()
+
+        mock_cache.pipeline.assert_called_once_with(transaction=False)
+        mock_pipe.hincrby.assert_any_call(get_query_data_key("SELECT a"), "SELECT a", 3)
+        mock_pipe.hincrbyfloat.assert_any_call(get_query_stats_key("SELECT a"), "time", 6.0)
+        mock_pipe.execute.assert_called_once()
+
+    @patch("toolbox.sql_recorder.TOOLBOX_RECORDER_QUEUE_SIZE", 1)
+    @patch("toolbox.sql_recorder.frappe")
+    def test_full_queue_drops_and_counts(self, mock_frappe):
+        mock_cache = mock_frappe.cache
+        mock_cache.make_key.side_effect = lambda k: k
+        mock_pipe = mock_cache.pipeline.return_value
+        flusher = RecorderFlusher()
+
+        with patch("toolbox.sql_recorder._flusher", flusher):
+            for query in ("SELECT a", "SELECT b", "SELECT c"):
+                recorder = SQLRecorder()
+                recorder.register(query)
+                recorder.dump()
+            flush_recorder()
+
+        mock_pipe.hincrby.assert_any_call(get_query_data_key("SELECT a"), "SELECT a", 1)
+        mock_pipe.incrby.assert_called_once_with(TOOLBOX_RECORDER_DROPPED, 2)
+        self.assertEqual(flusher.dropped, {})
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_flush_with_nothing_buffered_skips_redis(self, mock_frappe):
+        flush_recorder()
+        mock_frappe.cache.pipeline.assert_not_called()
+
+    @patch("toolbox.sql_recorder.RecorderFlusher.start")
+    @patch("toolbox.sql_recorder.os.getpid")
+    def test_forked_process_gets_own_flusher(self, mock_getpid, mock_start):
+        mock_getpid.return_value = self.flusher.pid + 1
+
+        flusher = get_recorder_flusher()
+
+        self.assertIsNot(flusher, self.flusher)
+        self.assertEqual(flusher.pid, self.flusher.pid + 1)
+        mock_start.assert_called_once()
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_after_job_hook_flushes_synchronously(self, mock_frappe):
+        mock_frappe.cache.get_value.return_value = True
+        mock_frappe.local.toolbox_recorder = SQLRecorder()
+        mock_frappe.local.toolbox_recorder.register("SELECT a")
+
+        after_job_hook()
+
+        mock_frappe.cache.pipeline.return_value.execute.assert_called_once()
+        self.assertTrue(self.flusher.queue.empty())
 
 
 class TestMonkeyPatching(unittest.TestCase):
@@ -137,21 +692,40 @@ class TestMonkeyPatching(unittest.TestCase):
         mock_frappe.local.db_sql = original_sql
         mock_recorder = MagicMock()
         mock_frappe.local.toolbox_recorder = mock_recorder
+        mock_frappe.db._cursor.rowcount = 1
 
         result = sql("SELECT * FROM tabUser WHERE name = %s", ("Admin",))
 
         original_sql.assert_called_once_with("SELECT * FROM tabUser WHERE name = %s", ("Admin",))
-        mock_recorder.register.assert_called_once_with("SELECT * FROM tabUser WHERE name = %s")
+        mock_recorder.register.assert_called_once_with(
+            "SELECT * FROM tabUser WHERE name = %s", ANY, 1, ("Admin",)
+        )
         self.assertEqual(result, [{"name": "test"}])
 
+    @patch("toolbox.sql_recorder.perf_counter")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_sql_wrapper_times_query(self, mock_frappe, mock_perf_counter):
+        mock_perf_counter.side_effect = [10.0, 10.25]
+        mock_frappe.db._cursor.rowcount = -1
+
+        sql("SELECT a")
+
+        mock_frappe.local.toolbox_recorder.register.assert_called_once_with(
+            "SELECT a", 250.0, 0, None
+        )
+
 
 class TestBeforeAfterHook(unittest.TestCase):
     """Tests for the request/job hook lifecycle."""
 
+    def setUp(self):
+        _recorder_flag_cache.clear()
+
     @patch("toolbox.sql_recorder.toolbox")
     @patch("toolbox.sql_recorder.frappe")
     def test_before_hook_enabled_creates_recorder_and_patches(self, mock_frappe, mock_toolbox):
         mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.return_value = 100
         mock_frappe.local = MagicMock()
         original_sql = MagicMock()
         mock_frappe.db.sql = original_sql
@@ -217,6 +791,203 @@ class TestBeforeAfterHook(unittest.TestCase):
         mock_recorder.dump.assert_not_called()
 
 
+class TestRecorderFlagCache(unittest.TestCase):
+    """Tests for the per-process cache of the recorder flag."""
+
+    def setUp(self):
+        _recorder_flag_cache.clear()
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_flag_read_once_within_ttl(self, mock_frappe, mock_toolbox):
+        mock_frappe.local.site = "test.localhost"
+        mock_frappe.cache.get_value.return_value = False
+
+        for _ in range(5):
+            before_hook()
+            self.assertFalse(is_recorder_enabled())
+
+        mock_frappe.cache.get_value.assert_called_once_with(TOOLBOX_RECORDER_FLAG)
+
+    @patch("toolbox.sql_recorder.monotonic")
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_flag_refreshed_after_ttl(self, mock_frappe, mock_toolbox, mock_monotonic):
+        mock_toolbox.get_settings.return_value = None
+        mock_frappe.local.site = "test.localhost"
+        mock_frappe.cache.get_value.return_value = False
+        mock_monotonic.return_value = 100.0
+        self.assertFalse(is_recorder_enabled())
+
+        mock_frappe.cache.get_value.return_value = True
+        mock_monotonic.return_value = 100.0 + TOOLBOX_RECORDER_FLAG_TTL - 1
+        self.assertFalse(is_recorder_enabled())
+
+        mock_monotonic.return_value = 100.0 + TOOLBOX_RECORDER_FLAG_TTL + 1
+        self.assertTrue(is_recorder_enabled())
+        self.assertEqual(mock_frappe.cache.get_value.call_count, 2)
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_flag_cached_per_site(self, mock_frappe, mock_toolbox):
+        mock_toolbox.get_settings.return_value = None
+        mock_frappe.cache.get_value.return_value = True
+
+        mock_frappe.local.site = "a.localhost"
+        is_recorder_enabled()
+        mock_frappe.local.site = "b.localhost"
+        is_recorder_enabled()
+
+        self.assertEqual(mock_frappe.cache.get_value.call_count, 2)
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_clear_forces_refresh(self, mock_frappe, mock_toolbox):
+        mock_toolbox.get_settings.return_value = None
+        mock_frappe.local.site = "test.localhost"
+        mock_frappe.cache.get_value.return_value = False
+        is_recorder_enabled()
+
+        mock_frappe.cache.get_value.return_value = True
+        clear_recorder_flag_cache()
+
+        self.assertTrue(is_recorder_enabled())
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_enabled_flag_carries_settings(self, mock_frappe, mock_toolbox):
+        mock_frappe.local.site = "test.localhost"
+        mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.side_effect = {
+            "sql_recorder_sample_rate": 25,
+            "sql_recorder_parameter_samples": "Values",
+        }.get
+
+        mock_frappe.cache.make_key.side_effect = lambda key: f"site|{key}"
+        is_recorder_enabled()
+
+        # only replaces the flag it read, a toggle or `stop` in between wins
+        mock_frappe.cache.set_value.assert_not_called()
+        mock_frappe.cache.eval.assert_called_once_with(
+            REPLACE_FLAG_SCRIPT,
+            1,
+            f"site|{TOOLBOX_RECORDER_FLAG}",
+            pickle.dumps(True),
+            pickle.dumps([True, 25.0, "Values"]),
+        )
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_cold_process_reads_state_with_one_get(self, mock_frappe, mock_toolbox):
+        # a forked RQ work-horse starts with an empty cache
+        mock_frappe.local.site = "test.localhost"
+        mock_frappe.cache.get_value.return_value = [True, 25.0, "Off"]
+
+        before_hook()
+
+        mock_frappe.cache.get_value.assert_called_once_with(TOOLBOX_RECORDER_FLAG)
+        mock_toolbox.get_settings.assert_not_called()
+        mock_frappe.cache.set_value.assert_not_called()
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_after_hook_without_recorder_skips_redis(self, mock_frappe):
+        mock_frappe.local = MagicMock(spec=["site"])
+
+        after_hook()
+
+        mock_frappe.cache.get_value.assert_not_called()
+
+
+class TestRequestSampling(unittest.TestCase):
+    """Tests for recording only a sample of requests & jobs."""
+
+    def setUp(self):
+        _recorder_flag_cache.clear()
+        patcher = patch("toolbox.sql_recorder._flusher", RecorderFlusher())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch("toolbox.sql_recorder.random")
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_request_outside_sample_not_patched(self, mock_frappe, mock_toolbox, mock_random):
+        mock_frappe.local = MagicMock(spec=["site"])
+        mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.return_value = 10
+        mock_random.return_value = 0.5
+        original_sql = MagicMock()
+        mock_frappe.db.sql = original_sql
+
+        before_hook()
+
+        self.assertEqual(mock_frappe.db.sql, original_sql)
+        self.assertFalse(hasattr(mock_frappe.local, "toolbox_recorder"))
+
+    @patch("toolbox.sql_recorder.random")
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_request_inside_sample_patched(self, mock_frappe, mock_toolbox, mock_random):
+        mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.return_value = 10
+        mock_random.return_value = 0.05
+
+        before_hook()
+
+        self.assertEqual(mock_frappe.db.sql, sql)
+        self.assertEqual(mock_frappe.local.toolbox_recorder.sample_rate, 10)
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_unset_sample_rate_records_everything(self, mock_frappe, mock_toolbox):
+        mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.return_value = None
+
+        before_hook()
+
+        self.assertEqual(mock_frappe.local.toolbox_recorder.sample_rate, 100)
+
+    @patch("toolbox.sql_recorder.random")
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_zero_sample_rate_records_nothing(self, mock_frappe, mock_toolbox, mock_random):
+        mock_frappe.local = MagicMock(spec=["site"])
+        mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.return_value = 0
+        mock_random.return_value = 0.0
+        original_sql = MagicMock()
+        mock_frappe.db.sql = original_sql
+
+        before_hook()
+
+        self.assertEqual(mock_frappe.db.sql, original_sql)
+        self.assertFalse(hasattr(mock_frappe.local, "toolbox_recorder"))
+
+    @patch("toolbox.sql_recorder.toolbox")
+    @patch("toolbox.sql_recorder.frappe")
+    def test_unset_parameter_samples_are_off(self, mock_frappe, mock_toolbox):
+        mock_frappe.cache.get_value.return_value = True
+        mock_toolbox.get_settings.return_value = None
+
+        before_hook()
+
+        self.assertFalse(mock_frappe.local.toolbox_recorder.capture_parameters)
+
+    @patch("toolbox.sql_recorder.frappe")
+    def test_dump_scales_occurrences_by_sample_rate(self, mock_frappe):
+        mock_cache = MagicMock()
+        mock_frappe.cache = mock_cache
+        mock_pipe = mock_cache.pipeline.return_value
+
+        recorder = SQLRecorder(sample_rate=10)
+        recorder.register("SELECT a")
+        recorder.register("SELECT a")
+        recorder.dump()
+        flush_recorder()
+
+        key = mock_cache.make_key.return_value
+        mock_pipe.hincrby.assert_any_call(key, "SELECT a", 20)
+
+
 class TestGetCurrentStackFrames(unittest.TestCase):
     """Tests for stack frame extraction used in call stack recording."""
 
@@ -8,9 +8,12 @@ from toolbox.utils import (
     QueryBenchmark,
     Table,
     _explain_and_record_query,
-    _increment_query_count,
+    _increment_query_counts,
+    dedupe_recorded_queries,
+    explain_queries,
     process_sql_metadata_chunk,
     record_table,
+    table_id_cache,
 )
 
 
@@ -27,6 +30,20 @@ class TestToolBoxUtils(FrappeTestCase):
         self.assertNotEqual(table_id, table_name)
         self.assertTrue(frappe.db.exists("MariaDB Table", table_id))
 
+    def test_record_table_with_table_id_cache(self):
+        table_id = record_table("tabNote")
+
+        with table_id_cache():
+            self.assertEqual(record_table("tabNote"), table_id)
+            derived_id = record_table("<derived99>")
+            self.assertEqual(record_table("<derived99>"), derived_id)
+            # new tables are inserted in bulk on exit
+            self.assertFalse(frappe.db.exists("MariaDB Table", derived_id))
+
+        self.assertEqual(
+            frappe.db.get_value("MariaDB Table", derived_id, "_table_name"), "<derived99>"
+        )
+
     def test_table_find_index_where_candidates(self):
         queries = [
             Query(
@@ -146,12 +163,12 @@ class TestIncrementQueryCount(FrappeTestCase):
         frappe.db.rollback()
         return super().tearDown()
 
-    def test_returns_false_for_new_query(self):
-        mq_table = frappe.qb.DocType("MariaDB Query")
-        result = _increment_query_count(mq_table, "SELECT `nonexistent_xyz_query` FROM dual", 5)
-        self.assertFalse(result)
+    def test_returns_new_queries(self):
+        p_query = "SELECT `nonexistent_xyz_query` FROM dual"
+        self.assertEqual(_increment_query_counts({p_query: 5}), [p_query])
+        self.assertEqual(_increment_query_counts({}), [])
 
-    def test_returns_true_for_existing_query(self):
+    def test_increments_existing_query(self):
         from toolbox.utils import record_query
 
         p_query = "SELECT %s FROM `tabDocType` WHERE name = %s"
@@ -160,13 +177,108 @@ class TestIncrementQueryCount(FrappeTestCase):
         qr.insert()
         frappe.db.commit()
 
-        mq_table = frappe.qb.DocType("MariaDB Query")
-        result = _increment_query_count(mq_table, p_query, 3)
-        self.assertTrue(result)
+        self.assertEqual(_increment_query_counts({p_query: 3}), [])
 
         updated = frappe.get_doc("MariaDB Query", qr.name)
         self.assertEqual(updated.occurrence, 4)
 
+    def test_increments_execution_stats(self):
+        from toolbox.utils import record_query
+
+        p_query = "SELECT %s FROM `tabDocType` WHERE module = %s"
+        qr = record_query("SELECT 1 FROM `tabDocType` WHERE module = 1", p_query=p_query)
+        qr.occurrence = 1
+        qr.apply_stats({"time": 5.0, "time_sq": 25.0, "rows": 2, "min_time": 5.0, "max_time": 5.0})
+        qr.insert()
+
+        stats = {"time": 4.0, "time_sq": 10.0, "rows": 3, "min_time": 1.0, "max_time": 3.0}
+        self.assertEqual(_increment_query_counts({p_query: 2}, {p_query: stats}), [])
+
+        updated = frappe.get_doc("MariaDB Query", qr.name)
+        self.assertEqual(updated.occurrence, 3)
+        self.assertEqual(updated.total_time, 9.0)
+        self.assertEqual(updated.total_time_squared, 35.0)
+        self.assertEqual(updated.total_rows, 5)
+        self.assertEqual(updated.min_time, 1.0)
+        self.assertEqual(updated.max_time, 5.0)
+
+    def test_merges_time_histogram(self):
+        from toolbox.sql_recorder import get_histogram_bucket
+        from toolbox.utils import record_query
+
+        bucket = get_histogram_bucket(2.0)
+        p_query = "SELECT %s FROM `tabDocType` WHERE issingle = %s"
+        qr = record_query("SELECT 1 FROM `tabDocType` WHERE issingle = 1", p_query=p_query)
+        qr.occurrence = 1
+        qr.apply_stats({"histogram": {bucket: 1}})
+        qr.insert()
+
+        stats = {p_query: {"histogram": {bucket: 3}}}
+        self.assertEqual(_increment_query_counts({p_query: 3}, stats), [])
+
+        updated = frappe.get_doc("MariaDB Query", qr.name)
+        self.assertEqual(frappe.parse_json(updated.time_histogram), {str(bucket): 4})
+        self.assertAlmostEqual(updated.p95_time, 2.0, delta=0.3)
+
+    def test_looks_up_by_query_hash(self):
+        from toolbox.sql_recorder import get_query_digest
+        from toolbox.utils import record_query
+
+        p_query = "SELECT %s FROM `tabDocType` WHERE `custom` = %s"
+        qr = record_query("SELECT 1 FROM `tabDocType` WHERE `custom` = 1", p_query=p_query)
+        qr.insert()
+
+        self.assertEqual(qr.query_hash, get_query_digest(p_query))
+        self.assertEqual(len(qr.query_hash), 32)
+        self.assertEqual(
+            frappe.get_all(
+                "MariaDB Query", {"query_hash": get_query_digest(p_query)}, pluck="name"
+            ),
+            [qr.name],
+        )
+
+    def test_dedupe_recorded_queries(self):
+        from toolbox.sql_recorder import get_query_digest
+        from toolbox.utils import record_query
+
+        p_query = "SELECT %s FROM `tabDocType` WHERE `beta` = %s"
+        names = []
+        for occurrence in (2, 3):
+            qr = record_query("SELECT 1 FROM `tabDocType` WHERE `beta` = 1", p_query=p_query)
+            qr.occurrence = occurrence
+            qr.query_hash = None
+            qr.insert()
+            names.append(qr.name)
+
+        self.assertEqual(dedupe_recorded_queries(), 1)
+        self.assertFalse(frappe.db.exists("MariaDB Query", names[1]))
+        kept = frappe.get_doc("MariaDB Query", names[0])
+        self.assertEqual(kept.occurrence, 5)
+        self.assertEqual(kept.query_hash, get_query_digest(p_query))
+
+    def test_bulk_increments_mixed_queries(self):
+        from toolbox.utils import record_query
+
+        recorded = {}
+        for field in ("istable", "issubmittable"):
+            p_query = f"SELECT %s FROM `tabDocType` WHERE {field} = %s"
+            qr = record_query(f"SELECT 1 FROM `tabDocType` WHERE {field} = 1", p_query=p_query)
+            qr.occurrence = 1
+            qr.apply_stats({"time": 1.0, "min_time": 1.0, "max_time": 1.0})
+            qr.insert()
+            recorded[p_query] = qr.name
+
+        p_new = "SELECT %s FROM `tabDocType` WHERE `nonexistent_xyz_column` = %s"
+        queries = dict.fromkeys(recorded, 2) | {p_new: 7}
+        stats = {next(iter(recorded)): {"time": 3.0, "min_time": 0.5, "max_time": 2.5}}
+
+        self.assertEqual(_increment_query_counts(queries, stats), [p_new])
+
+        first, second = (frappe.get_doc("MariaDB Query", name) for name in recorded.values())
+        self.assertEqual((first.occurrence, second.occurrence), (3, 3))
+        self.assertEqual((first.total_time, first.min_time, first.max_time), (4.0, 0.5, 2.5))
+        self.assertEqual((second.total_time, second.min_time, second.max_time), (1.0, 1.0, 1.0))
+
 
 class TestExplainAndRecordQuery(FrappeTestCase):
     def tearDown(self) -> None:
@@ -184,6 +296,38 @@ class TestExplainAndRecordQuery(FrappeTestCase):
         self.assertIsNone(result)
 
 
+class TestExplainQueries(FrappeTestCase):
+    queries = [
+        "SELECT `name` FROM `tabDocType`",
+        "SELECT * FROM `nonexistent_table_xyz`",
+        "SELECT `name` FROM `tabDocField` WHERE `parent` = 'User'",
+    ]
+
+    def test_sequential(self):
+        results = explain_queries(self.queries)
+        self.assertTrue(results[0])
+        self.assertIsNone(results[1])
+        self.assertTrue(results[2])
+
+    def test_parallel_matches_sequential(self):
+        sequential = explain_queries(self.queries)
+        parallel = explain_queries(self.queries, concurrency=2)
+        self.assertEqual(
+            [[row["table"] for row in rows] if rows else None for rows in parallel],
+            [[row["table"] for row in rows] if rows else None for rows in sequential],
+        )
+
+    def test_parallel_keeps_callers_transaction(self):
+        frappe.db.set_single_value("ToolBox Settings", "explain_concurrency", 7)
+        try:
+            explain_queries(self.queries, concurrency=2)
+            self.assertEqual(
+                frappe.db.get_single_value("ToolBox Settings", "explain_concurrency"), 7
+            )
+        finally:
+            frappe.db.rollback()
+
+
 class TestProcessSqlMetadataChunk(FrappeTestCase):
     def tearDown(self) -> None:
         frappe.db.rollback()
@@ -222,9 +366,16 @@ class TestMigrationPatch(FrappeTestCase):
         with open(patches_path) as f:
             content = f.read()
         self.assertIn("toolbox.patches.rename_occurence_to_occurrence", content)
+        self.assertIn("toolbox.patches.set_mariadb_query_hash", content)
+        self.assertIn("toolbox.patches.shard_recorded_queries", content)
 
     def test_patch_module_is_importable(self):
         from toolbox.patches import rename_occurence_to_occurrence
 
         self.assertTrue(hasattr(rename_occurence_to_occurrence, "execute"))
         self.assertTrue(callable(rename_occurence_to_occurrence.execute))
+
+    def test_query_hash_patch_is_importable(self):
+        from toolbox.patches import set_mariadb_query_hash
+
+        self.assertTrue(callable(set_mariadb_query_hash.execute))
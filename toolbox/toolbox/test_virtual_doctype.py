@@ -2,19 +2,27 @@
 # See license.txt
 
 import unittest
+from unittest.mock import patch
 
 from toolbox.toolbox.doctype.mariadb_index.mariadb_index import (
     ALLOWED_OPERATORS,
     FIELD_ALIAS,
     TOOLBOX_INDEX_PREFIX,
+    MariaDBIndex,
+    _run_batched_index_ddl,
+    _run_index_ddl,
     get_accessible_fields,
     get_args,
     get_column_name,
     get_filter_clause,
     get_index_query,
     get_mapped_field,
+    wait_for_low_load,
     wrap_query_field,
 )
+from toolbox.utils import IndexCandidate, Query
+
+ER_LOCK_WAIT_TIMEOUT = 1205
 
 
 class TestWrapQueryField(unittest.TestCase):
@@ -231,5 +239,135 @@ class TestFieldAlias(unittest.TestCase):
         self.assertEqual(TOOLBOX_INDEX_PREFIX, "toolbox_index_")
 
 
+@patch("toolbox.toolbox.doctype.mariadb_index.mariadb_index.frappe")
+class TestOnlineIndexDDL(unittest.TestCase):
+    """Test that index DDL runs online, with a lock wait guard & load throttling."""
+
+    def _run(self, settings, changes=("DROP INDEX `idx`",), throttle=None):
+        with patch(
+            "toolbox.toolbox.doctype.mariadb_index.mariadb_index.toolbox.get_settings",
+            side_effect=settings.get,
+        ):
+            if throttle is None:
+                return _run_index_ddl("tabNote", list(changes))
+            return _run_batched_index_ddl("tabNote", [(c, c) for c in changes], throttle=throttle)
+
+    def test_ddl_is_inplace_and_lock_free(self, mock_frappe):
+        self._run({"index_ddl_lock_wait_timeout": 5})
+        mock_frappe.db.sql_ddl.assert_called_once_with(
+            "ALTER TABLE `tabNote` WAIT 5 DROP INDEX `idx`, ALGORITHM=INPLACE, LOCK=NONE",
+            debug=False,
+        )
+
+    def test_no_lock_wait_timeout(self, mock_frappe):
+        self._run({})
+        mock_frappe.db.sql_ddl.assert_called_once_with(
+            "ALTER TABLE `tabNote` DROP INDEX `idx`, ALGORITHM=INPLACE, LOCK=NONE", debug=False
+        )
+
+    def test_throttled_ddl_waits_for_low_load(self, mock_frappe):
+        mock_frappe.db.sql.side_effect = [[("Threads_running", "40")], [("Threads_running", "3")]]
+        with patch("toolbox.toolbox.doctype.mariadb_index.mariadb_index.sleep") as mock_sleep:
+            self._run({"index_ddl_max_threads_running": 8}, throttle=True)
+        mock_sleep.assert_called_once()
+        mock_frappe.db.sql_ddl.assert_called_once()
+
+    def test_throttled_ddl_gives_up_when_busy(self, mock_frappe):
+        with patch(
+            "toolbox.toolbox.doctype.mariadb_index.mariadb_index.wait_for_low_load",
+            return_value=False,
+        ):
+            failures = self._run(
+                {"index_ddl_max_threads_running": 8}, changes=("a", "b"), throttle=True
+            )
+        self.assertEqual(failures, ["a", "b"])
+        mock_frappe.throw.assert_not_called()
+        mock_frappe.db.sql_ddl.assert_not_called()
+
+    def test_wait_for_low_load_times_out(self, mock_frappe):
+        mock_frappe.db.sql.return_value = [("Threads_running", "40")]
+        self.assertFalse(wait_for_low_load(8, timeout=0))
+
+
+@patch("toolbox.toolbox.doctype.mariadb_index.mariadb_index.toolbox.get_settings")
+@patch("toolbox.toolbox.doctype.mariadb_index.mariadb_index.frappe")
+class TestBatchedIndexDDL(unittest.TestCase):
+    """Test that index changes on a table are batched into one ALTER TABLE."""
+
+    def _make_candidates(self, *columns):
+        ics = []
+        for col in columns:
+            ic = IndexCandidate(query=Query("SELECT 1"))
+            ic.append(col)
+            ics.append(ic)
+        return ics
+
+    def test_create_batches_indexes(self, mock_frappe, mock_settings):
+        mock_settings.return_value = None
+        ics = self._make_candidates("owner", "status")
+        self.assertEqual(MariaDBIndex.create("tabNote", ics), [])
+        mock_frappe.db.sql_ddl.assert_called_once_with(
+            "ALTER TABLE `tabNote` ADD INDEX `toolbox_index_owner` (`owner`), "
+            "ADD INDEX `toolbox_index_status` (`status`), ALGORITHM=INPLACE, LOCK=NONE",
+            debug=False,
+        )
+
+    def _mock_is_timedout(self, mock_frappe):
+        # mirrors frappe's MariaDB check on the error code of the raised exception
+        mock_frappe.db.is_timedout.side_effect = lambda e: e.args[0] == ER_LOCK_WAIT_TIMEOUT
+
+    def test_failed_batch_falls_back_to_single_indexes(self, mock_frappe, mock_settings):
+        mock_settings.return_value = None
+        self._mock_is_timedout(mock_frappe)
+        ics = self._make_candidates("owner", "status")
+
+        def sql_ddl(sql, debug=False):
+            if "`status`" in sql:
+                raise Exception(1061, "Duplicate key name 'toolbox_index_status'")
+
+        mock_frappe.db.sql_ddl.side_effect = sql_ddl
+        self.assertEqual(MariaDBIndex.create("tabNote", ics), [ics[1]])
+        self.assertEqual(mock_frappe.db.sql_ddl.call_count, 3)
+
+    def test_lock_wait_timeout_is_not_retried(self, mock_frappe, mock_settings):
+        mock_settings.return_value = None
+        self._mock_is_timedout(mock_frappe)
+        mock_frappe.db.sql_ddl.side_effect = Exception(
+            ER_LOCK_WAIT_TIMEOUT, "Lock wait timeout exceeded; try restarting transaction"
+        )
+
+        with self.assertRaises(Exception):
+            MariaDBIndex.create("tabNote", self._make_candidates("owner", "status"))
+        mock_frappe.db.sql_ddl.assert_called_once()
+
+    def test_busy_server_is_checked_once(self, mock_frappe, mock_settings):
+        mock_settings.side_effect = {"index_ddl_max_threads_running": 8}.get
+        ics = self._make_candidates("owner", "status")
+
+        with patch(
+            "toolbox.toolbox.doctype.mariadb_index.mariadb_index.wait_for_low_load",
+            return_value=False,
+        ) as mock_wait:
+            self.assertEqual(MariaDBIndex.create("tabNote", ics), ics)
+        mock_wait.assert_called_once()
+        mock_frappe.db.sql_ddl.assert_not_called()
+
+    def test_drop_toolbox_indexes_batches_drops(self, mock_frappe, mock_settings):
+        mock_settings.return_value = None
+        indexes = [
+            {"key_name": "toolbox_index_owner_status"},
+            {"key_name": "toolbox_index_owner_status"},
+            {"key_name": "modified"},
+            {"key_name": "toolbox_index_name"},
+        ]
+        with patch.object(MariaDBIndex, "get_indexes", return_value=indexes):
+            MariaDBIndex.drop_toolbox_indexes("tabNote")
+        mock_frappe.db.sql_ddl.assert_called_once_with(
+            "ALTER TABLE `tabNote` DROP INDEX IF EXISTS `toolbox_index_owner_status`, "
+            "DROP INDEX IF EXISTS `toolbox_index_name`, ALGORITHM=INPLACE, LOCK=NONE",
+            debug=False,
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
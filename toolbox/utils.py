@@ -1,22 +1,30 @@
 import json
 import re
-from contextlib import contextmanager, suppress
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, suppress
 from enum import Enum, auto
 from functools import lru_cache
 from html import escape
-from itertools import groupby
-from typing import TYPE_CHECKING, Callable
+from itertools import combinations, groupby
+from math import comb
+from random import Random
+from statistics import fmean, median
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
 
 import frappe
 from click import secho
 from frappe.model.document import bulk_insert, now
+from frappe.utils import cint
 from frappe.utils.caching import request_cache
 from redis.exceptions import ConnectionError
 from sql_metadata import Parser, QueryType
-from sqlparse import format as format_sql
 from sqlparse import parse
-from sqlparse.sql import Comparison, Identifier, IdentifierList, Where
-from sqlparse.tokens import Keyword
+from sqlparse.sql import Comparison, Function, Identifier, IdentifierList, Parenthesis, Where
+from sqlparse.tokens import DML, Keyword, Name, Punctuation, String, Wildcard
+from sqlparse.utils import split_unquoted_newlines
+
+import toolbox
+from toolbox.sql_recorder import get_query_digest
 
 if TYPE_CHECKING:
     from sqlparse.sql import Statement
@@ -24,6 +32,48 @@ if TYPE_CHECKING:
     from toolbox.doctypes import MariaDBQuery
 
 PARAMS_PATTERN = re.compile(r"\%\([\w]*\)s")
+# Note: Bump this when changes to index candidate generation should invalidate MariaDB Query.parse_cache
+PARSER_VERSION = 1
+
+# rows read to estimate the distinct values of unindexed columns without engine-independent stats
+CARDINALITY_SAMPLE_ROWS = 10_000
+
+# rows sampled into the shadow table that index candidates of big tables are evaluated on
+WHAT_IF_SAMPLE_ROWS = 100_000
+WHAT_IF_TABLE_PREFIX = "_toolbox_what_if_"
+# the sample is copied in primary key ranges of this many rows, each in its own transaction
+WHAT_IF_COPY_BATCH_SIZE = 10_000
+# seconds a candidate's what-if verdict is reused for, before its shadow table is built again
+WHAT_IF_VERDICT_KEY = "toolbox:what_if"
+WHAT_IF_VERDICT_TTL = 7 * 24 * 60 * 60
+
+# an index is kept if it reads BENCHMARK_MIN_IMPROVEMENT fewer rows, or is as much faster over
+# BENCHMARK_RUNS timed runs with a permutation test p-value within BENCHMARK_SIGNIFICANCE
+BENCHMARK_RUNS = 5
+BENCHMARK_MIN_IMPROVEMENT = 0.1
+BENCHMARK_MIN_TIME_SAVED_MS = 1.0
+BENCHMARK_SIGNIFICANCE = 0.05
+BENCHMARK_PERMUTATIONS = 10_000
+
+# an InnoDB secondary index holds a record of the indexed & primary key columns per row, plus a
+# record header, in pages that settle around 3/4 full once rows are inserted out of order
+INDEX_RECORD_OVERHEAD = 8
+INDEX_FILL_FACTOR = 0.75
+# bytes a value of each fixed width column type takes, see get_column_width for the rest
+COLUMN_TYPE_WIDTHS = {
+    "tinyint": 1,
+    "smallint": 2,
+    "mediumint": 3,
+    "int": 4,
+    "bigint": 8,
+    "float": 4,
+    "double": 8,
+    "year": 1,
+    "date": 3,
+    "time": 3,
+    "datetime": 5,
+    "timestamp": 4,
+}
 
 
 def wrap(value):
@@ -35,6 +85,10 @@ def wrap(value):
 def record_table(table: str) -> str:
     table = table or "NULL"
 
+    # resolve from the map loaded by table_id_cache, if there is one
+    if (table_ids := getattr(frappe.local, "toolbox_table_ids", None)) is not None:
+        return _record_cached_table(table_ids, table)
+
     if table_id := frappe.get_all("MariaDB Table", {"_table_name": table}, limit=1, pluck="name"):
         table_id = table_id[0]
     # handle derived tables & such
@@ -55,15 +109,67 @@ def record_table(table: str) -> str:
     return table_id
 
 
+def _record_cached_table(table_ids: dict[str, str], table: str) -> str:
+    # keys are lowercased as _table_name comparisons in MariaDB are case-insensitive
+    if table_id := table_ids.get(table.lower()) or table_ids.get(escape(table).lower()):
+        return table_id
+
+    table_record = frappe.new_doc("MariaDB Table")
+    table_record._table_name = table
+    table_record.set_new_name()
+    frappe.local.toolbox_new_tables.append(table_record)
+    table_ids[table.lower()] = table_record.name
+
+    return table_record.name
+
+
+@contextmanager
+def table_id_cache():
+    """Resolve MariaDB Table ids in record_table from a map loaded with a single query.
+
+    Tables that aren't recorded yet (derived tables, <subqueryN>, <derivedN>, new tables) get
+    their ids right away & are inserted in bulk on exit, without running their controllers.
+    """
+    table_ids = {}
+    for name, table_name in frappe.get_all(
+        "MariaDB Table", fields=["name", "_table_name"], order_by="creation desc", as_list=True
+    ):
+        # the oldest record wins, like the lookup in record_table
+        table_ids[(table_name or "").lower()] = name
+
+    frappe.local.toolbox_table_ids = table_ids
+    frappe.local.toolbox_new_tables = []
+
+    try:
+        yield
+
+        if new_tables := frappe.local.toolbox_new_tables:
+            existing_tables = set(frappe.db.get_tables(cached=False))
+            for table_record in new_tables:
+                # what MariaDBTable.validate would set for a table without recorded queries
+                table_record._table_exists = table_record._table_name in existing_tables
+                table_record.table_category = "Read"
+                table_record.table_category_meta = frappe.as_json(
+                    {"total_queries": 0, "write_queries": 0}
+                )
+            bulk_insert(doctype="MariaDB Table", documents=new_tables, ignore_duplicates=True)
+            frappe.logger("toolbox").info(
+                f"Recorded {len(new_tables):,} new 'MariaDB Table' records"
+            )
+    finally:
+        del frappe.local.toolbox_table_ids
+        del frappe.local.toolbox_new_tables
+
+
 @request_cache
 def already_recorded(query: str):
-    return frappe.get_all("MariaDB Query", {"query": query}, limit=1)
+    return frappe.get_all("MariaDB Query", {"query_hash": get_query_digest(query)}, limit=1)
 
 
 def record_query(
     query: str, p_query: str | None = None, call_stack: list[dict] | None = None
 ) -> "MariaDBQuery":
-    if query_name := already_recorded(query):
+    if query_name := already_recorded(p_query or query):
         query_record = frappe.get_doc("MariaDB Query", query_name[0])
         query_record.parameterized_query = p_query
 
@@ -76,12 +182,52 @@ def record_query(
     query_record = frappe.new_doc("MariaDB Query")
     query_record.query = query
     query_record.parameterized_query = p_query
+    query_record.query_hash = get_query_digest(p_query or query)
     query_record.occurrence = 0
     query_record.call_stack = frappe.as_json(call_stack)
 
     return query_record
 
 
+def dedupe_recorded_queries() -> int:
+    """Merge MariaDB Query records of the same query into the oldest one & set their query_hash.
+
+    Returns the number of records removed.
+    """
+    records = frappe.get_all(
+        "MariaDB Query",
+        fields=["name", "query", "parameterized_query", "query_hash", "occurrence"],
+        order_by="creation asc",
+    )
+    by_hash: dict[str, list] = {}
+    removed = 0
+
+    for record in records:
+        query_hash = get_query_digest(record.parameterized_query or record.query)
+        by_hash.setdefault(query_hash, []).append(record)
+
+    for query_hash, (pick, *duplicates) in by_hash.items():
+        if duplicates:
+            names = [record.name for record in duplicates]
+            frappe.db.delete("MariaDB Query Explain", {"parent": ("in", names)})
+            frappe.db.delete("MariaDB Query", {"name": ("in", names)})
+            removed += len(names)
+        elif pick.query_hash == query_hash:
+            continue
+
+        frappe.db.set_value(
+            "MariaDB Query",
+            pick.name,
+            {
+                "query_hash": query_hash,
+                "occurrence": pick.occurrence + sum(record.occurrence for record in duplicates),
+            },
+            update_modified=False,
+        )
+
+    return removed
+
+
 def record_database_state(init: bool = False):
     TABLE_DT = "MariaDB Table"
 
@@ -155,47 +301,185 @@ def handle_redis_connection_error():
 
 
 EXPLAINABLE_QUERIES = ("select", "insert", "update", "delete")
-_USE_FALLBACK_PROPERTY = object()
 
 
-def _increment_query_count(mq_table, p_query: str, p_occurrence: int) -> bool:
-    """Increment occurrence count for an existing query record.
+INCREMENT_FIELDS = (
+    "name",
+    "occurrence",
+    "total_time",
+    "total_time_squared",
+    "total_rows",
+    "min_time",
+    "max_time",
+    "time_histogram",
+    "parameter_samples",
+    "p50_time",
+    "p95_time",
+    "p99_time",
+)
+
 
-    Returns True if the query was already recorded (count incremented), False if new.
+def _increment_query_counts(
+    queries: dict[str, int], stats: dict[str, dict] | None = None
+) -> list[str]:
+    """Increment occurrence counts & execution stats for already recorded queries in bulk.
+
+    Existing records are looked up by query_hash with a single SELECT & updated with a single
+    UPDATE ... JOIN against a derived table of increments, instead of a round trip per query.
+
+    Returns the queries that aren't recorded yet.
     """
-    frappe.qb.update(mq_table).set(mq_table.occurrence, mq_table.occurrence + p_occurrence).set(
-        mq_table.modified, now()
-    ).where(mq_table.parameterized_query == p_query).limit(1).run()
+    from toolbox.toolbox.doctype.mariadb_query.mariadb_query import (
+        PERCENTILE_FIELDS,
+        get_time_percentiles,
+        merge_parameter_samples,
+        merge_time_histogram,
+    )
 
-    rowcount = getattr(frappe.db._cursor, "rowcount", _USE_FALLBACK_PROPERTY)
-    if rowcount is not _USE_FALLBACK_PROPERTY:
-        return rowcount > 0
-    return frappe.db.sql("SELECT ROW_COUNT()", pluck=True)[0] > 0
+    if not queries:
+        return []
 
+    stats = stats or {}
+    mq_table = frappe.qb.DocType("MariaDB Query")
+    hashes = {get_query_digest(p_query): p_query for p_query in queries}
+    recorded = {}
+
+    # the histogram & parameter samples have to be merged in Python anyway, so fetch them along
+    # with the names
+    for row in (
+        frappe.qb.from_(mq_table)
+        .select(
+            mq_table.name,
+            mq_table.query_hash,
+            mq_table.time_histogram,
+            mq_table.parameter_samples,
+        )
+        .where(mq_table.query_hash.isin(list(hashes)))
+        .run(as_dict=True)
+    ):
+        recorded[hashes[row.query_hash]] = row
+
+    if not recorded:
+        return list(queries)
+
+    increments = []
+
+    for p_query, row in recorded.items():
+        p_stats = stats.get(p_query) or {}
+        time_histogram, percentiles = None, dict.fromkeys(PERCENTILE_FIELDS)
+
+        if histogram := p_stats.get("histogram"):
+            merged = merge_time_histogram(row.time_histogram, histogram)
+            time_histogram = frappe.as_json(merged, indent=None)
+            percentiles = get_time_percentiles(merged)
+
+        parameter_samples = None
+        if params := p_stats.get("params"):
+            merged = merge_parameter_samples(row.parameter_samples, params)
+            parameter_samples = frappe.as_json(merged, indent=None)
+
+        increments.extend(
+            (
+                row.name,
+                queries[p_query],
+                p_stats.get("time", 0),
+                p_stats.get("time_sq", 0),
+                int(p_stats.get("rows", 0)),
+                p_stats.get("min_time"),
+                p_stats.get("max_time"),
+                time_histogram,
+                parameter_samples,
+                *percentiles.values(),
+            )
+        )
 
-def _explain_and_record_query(p_query: str, p_occurrence: int) -> "MariaDBQuery | None":
-    """Run EXPLAIN on a query sample and create a MariaDB Query record.
+    row_placeholder = ", ".join(["%s"] * len(INCREMENT_FIELDS))
+    first_row = ", ".join(f"%s AS `{fieldname}`" for fieldname in INCREMENT_FIELDS)
+    derived_table = " UNION ALL ".join(
+        [f"SELECT {first_row}"] + [f"SELECT {row_placeholder}"] * (len(recorded) - 1)
+    )
+    percentiles_set = ", ".join(
+        f"mq.`{fieldname}` = COALESCE(inc.`{fieldname}`, mq.`{fieldname}`)"
+        for fieldname in PERCENTILE_FIELDS
+    )
 
-    Returns the query record, or None if the query cannot be explained.
-    """
-    query = Query(p_query).get_sample()
+    # NULL min / max / histogram / samples means no stats were recorded for that query - keep what's
+    # stored
+    frappe.db.sql(
+        f"""
+        UPDATE `tabMariaDB Query` mq
+        JOIN ({derived_table}) inc ON inc.`name` = mq.`name`
+        SET mq.`occurrence` = mq.`occurrence` + inc.`occurrence`,
+            mq.`total_time` = mq.`total_time` + inc.`total_time`,
+            mq.`total_time_squared` = mq.`total_time_squared` + inc.`total_time_squared`,
+            mq.`total_rows` = mq.`total_rows` + inc.`total_rows`,
+            mq.`min_time` = CASE
+                WHEN inc.`min_time` IS NULL THEN mq.`min_time`
+                WHEN mq.`min_time` = 0 OR mq.`min_time` > inc.`min_time` THEN inc.`min_time`
+                ELSE mq.`min_time` END,
+            mq.`max_time` = GREATEST(mq.`max_time`, COALESCE(inc.`max_time`, 0)),
+            mq.`time_histogram` = COALESCE(inc.`time_histogram`, mq.`time_histogram`),
+            mq.`parameter_samples` = COALESCE(inc.`parameter_samples`, mq.`parameter_samples`),
+            {percentiles_set},
+            mq.`modified` = %s
+        """,
+        (*increments, now()),
+    )
+
+    return [p_query for p_query in queries if p_query not in recorded]
 
+
+def _explain_query(query: str) -> list[dict] | None:
     try:
-        explain_data = frappe.db.sql(f"EXPLAIN EXTENDED {query}", as_dict=True)
+        return frappe.db.sql(f"EXPLAIN EXTENDED {query}", as_dict=True)
     except Exception:
         frappe.logger("toolbox").exception(f"EXPLAIN EXTENDED failed: {query}")
         return None
 
+
+def explain_queries(queries: list[str], concurrency: int = 1) -> list[list[dict] | None]:
+    """Run EXPLAIN EXTENDED for each query, over up to `concurrency` database connections.
+
+    Each worker thread opens its own connection to the current site, so the load on the database
+    server is capped by `concurrency`. Results are returned in the order of `queries`.
+    """
+    concurrency = min(concurrency, len(queries))
+
+    if concurrency <= 1:
+        return [_explain_query(query) for query in queries]
+
+    site, sites_path = frappe.local.site, frappe.local.sites_path
+    connections = []
+
+    def connect():
+        frappe.init(site=site, sites_path=sites_path)
+        frappe.connect()
+        # frappe.db is a thread-local proxy - closing it later would close the caller's connection
+        connections.append(frappe.local.db)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, initializer=connect) as pool:
+            return list(pool.map(_explain_query, queries))
+    finally:
+        for db in connections:
+            db.close()
+
+
+def _record_explained_query(
+    p_query: str,
+    query: str,
+    explain_data: list[dict] | None,
+    p_occurrence: int,
+    p_stats: dict[str, float] | None = None,
+) -> "MariaDBQuery | None":
     if not explain_data:
         frappe.logger("toolbox").warning(f"Cannot explain query: {query}")
         return None
 
     # Note: Desk doesn't like Queries with whitespaces in long text for show title in links for forms
-    query_record = record_query(
-        format_sql(query, strip_whitespace=True, keyword_case="upper"),
-        p_query=p_query,
-    )
+    query_record = record_query(query, p_query=p_query)
     query_record.occurrence += p_occurrence
+    query_record.apply_stats(p_stats)
     for explain in explain_data:
         query_record.apply_explain(explain)
     query_record.set_new_name()
@@ -204,27 +488,59 @@ def _explain_and_record_query(p_query: str, p_occurrence: int) -> "MariaDBQuery
     return query_record
 
 
-def process_sql_metadata_chunk(queries: dict[str, int]):
-    mq_table = frappe.qb.DocType("MariaDB Query")
+def _explain_and_record_query(
+    p_query: str, p_occurrence: int, p_stats: dict[str, float] | None = None
+) -> "MariaDBQuery | None":
+    """Run EXPLAIN on a query sample and create a MariaDB Query record.
+
+    Returns the query record, or None if the query cannot be explained.
+    """
+    query = Query(p_query, parameter_samples=(p_stats or {}).get("params")).get_sample()
+    return _record_explained_query(p_query, query, _explain_query(query), p_occurrence, p_stats)
+
+
+def process_sql_metadata_chunk(
+    queries: dict[str, int],
+    stats: dict[str, dict[str, float]] | None = None,
+    chunk_id: str | None = None,
+):
     recorded_queries: dict[str, list] = {}
+    explainable: dict[str, int] = {}
+    stats = stats or {}
 
     for p_query, p_occurrence in queries.items():
         if isinstance(p_query, bytes):
             p_query = p_query.decode("utf-8")
 
-        if not p_query.lstrip()[:7].lower().startswith(EXPLAINABLE_QUERIES):
-            continue
+        if p_query.lstrip()[:7].lower().startswith(EXPLAINABLE_QUERIES):
+            explainable[p_query] = p_occurrence
 
-        if _increment_query_count(mq_table, p_query, p_occurrence):
-            continue
+    new_queries = [
+        (
+            p_query,
+            Query(p_query, parameter_samples=stats.get(p_query, {}).get("params")).get_sample(),
+            explainable[p_query],
+        )
+        for p_query in _increment_query_counts(explainable, stats)
+    ]
 
-        query_record = _explain_and_record_query(p_query, p_occurrence)
-        if not query_record:
-            continue
+    # EXPLAINs are read-only & independent of each other, records are built on this connection
+    explained = explain_queries(
+        [query for _, query, _ in new_queries],
+        concurrency=cint(toolbox.get_settings("explain_concurrency")) or 1,
+    )
 
-        for df in query_record.meta.get_table_fields():
-            recorded_queries.setdefault(df.options, []).extend(query_record.get(df.fieldname))
-        recorded_queries.setdefault(query_record.doctype, []).append(query_record)
+    with table_id_cache() if new_queries else nullcontext():
+        for (p_query, query, p_occurrence), explain_data in zip(new_queries, explained):
+            query_record = _record_explained_query(
+                p_query, query, explain_data, p_occurrence, stats.get(p_query)
+            )
+            if not query_record:
+                continue
+
+            for df in query_record.meta.get_table_fields():
+                recorded_queries.setdefault(df.options, []).extend(query_record.get(df.fieldname))
+            recorded_queries.setdefault(query_record.doctype, []).append(query_record)
 
     for dt, records in recorded_queries.items():
         bulk_insert(doctype=dt, documents=records, ignore_duplicates=True)
@@ -234,11 +550,25 @@ def process_sql_metadata_chunk(queries: dict[str, int]):
         doctype="SQL Record Summary",
         total_sql_count=sum(queries.values()),
         unique_sql_count=len(queries),
+        chunk_id=chunk_id,
     )
     summary.db_insert()
     return summary
 
 
+def save_parse_caches(queries: list["Query"]) -> None:
+    for query in queries:
+        if query.name and query.parse_cache_updated:
+            frappe.db.set_value(
+                "MariaDB Query",
+                query.name,
+                "parse_cache",
+                json.dumps(query.parse_cache),
+                update_modified=False,
+            )
+            query.parse_cache_updated = False
+
+
 @lru_cache(maxsize=None)
 def get_table_name(table_id: str) -> str | None:
     # Note: Use this util only via CLI / single threaded
@@ -252,18 +582,45 @@ def get_table_id(table_name: str):
 
 
 class Query:
-    def __init__(self, sql: str, occurrence: int = 1, table: "Table" = None) -> None:
+    def __init__(
+        self,
+        sql: str,
+        occurrence: int = 1,
+        table: "Table" = None,
+        name: str | None = None,
+        parse_cache: str | dict | None = None,
+        total_time: float = 0.0,
+        rows_examined: float = 0.0,
+        rows_filtered: float = 0.0,
+        parameterized_sql: str | None = None,
+        parameter_samples: str | list | None = None,
+    ) -> None:
         self.sql = sql.strip()
         self.occurrence = occurrence
         self.table = table
+        # recorded latency (ms) & rows of `table` the query's plan examines / keeps per execution
+        self.total_time = total_time
+        self.rows_examined = rows_examined
+        self.rows_filtered = rows_filtered
+        # MariaDB Query record the query was loaded from & its stored parse_cache
+        self.name = name
+        if isinstance(parse_cache, str):
+            parse_cache = json.loads(parse_cache)
+        self.parse_cache = {} if parse_cache is None else parse_cache
+        self.parse_cache_updated = False
+        # recorded parameter values & the placeholders they fill in, if `sql` is already a sample
+        self.parameterized_sql = parameterized_sql
+        if isinstance(parameter_samples, str):
+            parameter_samples = json.loads(parameter_samples)
+        self.parameter_samples = parameter_samples or []
 
     def __repr__(self) -> str:
         sub = f", table={self.table}" if self.table else ""
         dotted = "..." if len(self.sql) > 11 else ""
         return f"Query({self.sql[:10]}{dotted}{sub})"
 
-    # Note: We're essentially parsing the same query multiple times
-    # TODO: Avoid this, pass the parsed query to sql-metadata instead (or similar)
+    # Note: The sample, columns & where clause comparisons are all derived from this token stream,
+    # so each query is tokenized & grouped only once
     @property
     def parsed(self) -> "Statement":
         if not hasattr(self, "_parsed"):
@@ -272,21 +629,468 @@ class Query:
 
     @property
     def d_parsed(self):
+        # Note: sql-metadata re-parses the query, prefer Query.columns & Query.tables
         if not hasattr(self, "_d_parsed"):
             self._d_parsed = Parser(self.sql)
         return self._d_parsed
 
+    @property
+    def query_type(self) -> str:
+        return self.parsed.get_type()
+
+    @property
+    def tables(self) -> dict[str, str]:
+        """Tables referenced in the FROM & JOIN clauses, keyed by their alias (or name)"""
+        if not hasattr(self, "_tables"):
+            self._tables = get_statement_tables(self.parsed)
+        return self._tables
+
+    @property
+    def columns(self) -> dict[str, list[str]]:
+        """Columns referenced in the SELECT & ORDER BY clauses, qualified by table name if specified"""
+        if not hasattr(self, "_columns"):
+            self._columns = get_statement_columns(self.parsed, self.tables)
+        return self._columns
+
     def get_sample(self) -> str:
-        ret = self.sql
+        # fingerprinted queries may mix positional and named placeholders; recorded parameter values
+        # fill them in for SELECTs only, as samples are run through ANALYZE
+        if not hasattr(self, "_sample"):
+            statement, placeholder = self.parsed, "1"
+            if self.parameter_samples and self.query_type == "SELECT":
+                if self.parameterized_sql:
+                    statement = parse(self.parameterized_sql)[0]
+                placeholder = get_sample_placeholder(self.parameter_samples[0])
+            self._sample = format_statement(statement, placeholder=placeholder)
+        return self._sample
+
+    def get_cached_index_candidates(self, table: str) -> list["IndexCandidate"] | None:
+        """Index candidates for `table` from the parse cache, None if they need to be generated"""
+        if self.parse_cache.get("version") != PARSER_VERSION:
+            return None
+        if (cached := self.parse_cache["tables"].get(table)) is None:
+            return None
+
+        index_candidates = []
+        for candidate in cached:
+            index_candidate = IndexCandidate(
+                query=self, type=IndexCandidateType[candidate["type"]], ctx=candidate["ctx"]
+            )
+            index_candidate.extend(candidate["columns"])
+            index_candidates.append(index_candidate)
+        return index_candidates
+
+    def cache_index_candidates(self, table: str, index_candidates: list["IndexCandidate"]):
+        cached = []
+        for ic in index_candidates:
+            if ic and ic not in cached:
+                cached.append(ic)
+
+        self.set_parse_cache_entries(
+            table, [{"type": ic.type.name, "columns": list(ic), "ctx": ic.ctx} for ic in cached]
+        )
+
+    def set_parse_cache_entries(self, table: str, entries: list[dict]):
+        # updated in place, the cache may be shared by the Query objects of each table it reads
+        if self.parse_cache.get("version") != PARSER_VERSION:
+            self.parse_cache.clear()
+            self.parse_cache.update(version=PARSER_VERSION, tables={})
+
+        self.parse_cache["tables"][table] = entries
+        self.parse_cache_updated = True
 
-        if "%s" in self.sql:
-            ret = ret.replace("%s", "1")
 
+def format_statement(
+    statement: "Statement", placeholder: str | Callable[[str], str] | None = None
+) -> str:
+    """Render a parsed statement as `format_sql(..., strip_whitespace=True, keyword_case="upper")`
+    would, without tokenizing the query again. Placeholders are substituted if `placeholder` is set,
+    by the value it returns for each placeholder in order if it's a callable.
+    """
+    return "\n".join(
+        line.rstrip()
+        for line in split_unquoted_newlines(_format_token_list(statement, placeholder, depth=0))
+    )
+
+
+def get_sample_placeholder(params: list | dict) -> Callable[[str], str]:
+    """Render placeholders with recorded parameter values - `%s` positionally, `%(name)s` by name -
+    falling back to 1 for placeholders without a value or with a hashed one.
+    """
+    positional = iter(params if isinstance(params, list) else ())
+    named = params if isinstance(params, dict) else {}
+
+    def placeholder(token: str) -> str:
+        value = next(positional, 1) if token == "%s" else named.get(token[2:-2], 1)
+        return escape_sample_value(value)
+
+    return placeholder
+
+
+def escape_sample_value(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, dict):
+        # hashed value, see toolbox.sql_recorder.get_parameter_sample
+        return "1"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, list):
+        return f"({', '.join(escape_sample_value(v) for v in value) or 'NULL'})"
+    return frappe.db.escape(str(value), percent=False)
+
+
+def _format_token_list(
+    tlist, placeholder: str | Callable[[str], str] | None, depth: int, strip_tail: bool = False
+) -> str:
+    tokens = tlist.tokens
+
+    if isinstance(tlist, IdentifierList):
+        # whitespace before commas is dropped
+        tokens = [
+            token
+            for token, next_token in zip(tokens, tokens[1:] + [None])
+            if not (token.is_whitespace and next_token and next_token.match(Punctuation, ","))
+        ]
+    elif isinstance(tlist, Parenthesis):
+        start, end = 1, len(tokens) - 2
+        while start < end and tokens[start].is_whitespace:
+            start += 1
+        while end >= start and tokens[end].is_whitespace:
+            end -= 1
+        tokens = [tokens[0], *tokens[start : end + 1], tokens[-1]]
+
+    if strip_tail or (depth == 0 and tokens and tokens[-1].is_whitespace):
+        end = len(tokens)
+        while end and tokens[end - 1].is_whitespace:
+            end -= 1
+            if not strip_tail:
+                break
+        tokens = tokens[:end]
+
+    strip_last_group = isinstance(tlist, Parenthesis) and len(tokens) > 2 and tokens[-2].is_group
+    formatted = []
+    last_was_ws = False
+
+    for idx, token in enumerate(tokens):
+        if token.is_group:
+            last_group = strip_last_group and idx == len(tokens) - 2
+            formatted.append(_format_token_list(token, placeholder, depth + 1, last_group))
+        elif token.is_whitespace:
+            formatted.append("" if last_was_ws or not idx else " ")
+        elif token.ttype in Keyword:
+            formatted.append(token.value.upper())
+        elif placeholder and token.ttype in Name.Placeholder and token.value.startswith("%"):
+            formatted.append(placeholder(token.value) if callable(placeholder) else placeholder)
         else:
-            for k, v in ((p, "1") for p in PARAMS_PATTERN.findall(self.sql)):
-                ret = ret.replace(k, v)
+            formatted.append(token.value)
+        last_was_ws = token.is_whitespace
+
+    return "".join(formatted)
+
 
-        return format_sql(ret, strip_whitespace=True, keyword_case="upper")
+def get_statement_tables(statement: "Statement") -> dict[str, str]:
+    tables = {}
+    in_from = False
+
+    for token in statement.tokens:
+        if token.is_whitespace:
+            continue
+        if token.ttype in Keyword:
+            in_from = token.normalized == "FROM" or token.normalized.endswith("JOIN")
+            continue
+        if not in_from:
+            continue
+
+        identifiers = token.get_identifiers() if isinstance(token, IdentifierList) else [token]
+        for identifier in identifiers:
+            if isinstance(identifier, Identifier) and (table := identifier.get_real_name()):
+                tables[identifier.get_alias() or table] = table
+        in_from = False
+
+    return tables
+
+
+def get_statement_columns(
+    statement: "Statement", tables: dict[str, str] | None = None
+) -> dict[str, list[str]]:
+    columns = {}
+    aliases = {}
+    clause = None
+    tables = tables or {}
+
+    for token in statement.tokens:
+        if token.is_whitespace:
+            continue
+        if token.ttype in DML:
+            clause = "select" if token.normalized == "SELECT" else None
+            continue
+        if token.ttype in Keyword:
+            if token.normalized == "ORDER BY":
+                clause = "order_by"
+            elif clause != "select" or token.normalized != "DISTINCT":
+                clause = None
+            continue
+        if not clause:
+            continue
+
+        clause_columns = columns.setdefault(clause, [])
+        identifiers = token.get_identifiers() if isinstance(token, IdentifierList) else [token]
+
+        for identifier in identifiers:
+            found = []
+            for parent, column in _iter_columns(identifier):
+                if clause == "order_by" and not parent and column in aliases:
+                    found.extend(aliases[column])
+                    continue
+                column = f"{tables.get(parent, parent)}.{column}" if parent else column
+                found.append(column)
+
+            if clause == "select" and isinstance(identifier, Identifier):
+                if alias := identifier.get_alias():
+                    aliases[alias] = found
+            clause_columns.extend(c for c in found if c not in clause_columns)
+
+    return {clause: cols for clause, cols in columns.items() if cols}
+
+
+def _iter_columns(
+    token, nested: bool = False, item: bool = True
+) -> Iterator[tuple[str | None, str]]:
+    if token.ttype is Keyword:
+        # columns like `status` or `type` are lexed as keywords when listed or passed as arguments
+        if item and token.normalized != "DISTINCT":
+            yield None, token.value
+    elif token.ttype in Wildcard:
+        if not nested:
+            yield None, token.value
+    elif isinstance(token, Identifier):
+        first = token.token_first(skip_cm=True)
+        if first.is_group:
+            yield from _iter_columns(first, nested=True)
+        elif first.ttype in Name or first.ttype in String.Symbol:
+            yield token.get_parent_name(), token.get_real_name()
+    elif isinstance(token, Function):
+        for params in token.get_sublists():
+            if isinstance(params, Parenthesis):
+                for param in params.tokens:
+                    yield from _iter_columns(param, nested=True)
+    elif isinstance(token, IdentifierList):
+        for identifier in token.get_identifiers():
+            yield from _iter_columns(identifier, nested=nested)
+    elif token.is_group:
+        for sub_token in token.tokens:
+            yield from _iter_columns(sub_token, nested=nested, item=False)
+
+
+def iter_where_clause_items(statement: "Statement") -> Iterator[tuple[str, Any]]:
+    """Yield the WHERE clause of a parsed statement & the column lists following it as items:
+    ("operator", "AND" | "OR"), ("comparison", ([(parent, column), ...], ctx)) or
+    ("order_by", columns)
+    """
+    parsed_where = False
+
+    for clause_token in statement.tokens:
+        if parsed_where and not clause_token.ttype:
+            if isinstance(clause_token, Identifier):
+                yield "order_by", [clause_token.get_name()]
+            elif isinstance(clause_token, IdentifierList):
+                yield "order_by", [x.get_name() for x in clause_token.get_identifiers()]
+            else:
+                yield "order_by", []
+            continue
+
+        if not isinstance(clause_token, Where):
+            continue
+        parsed_where = True
+
+        for in_token in clause_token.tokens:
+            if in_token.ttype == Keyword and in_token.value.upper() in {"AND", "OR"}:
+                yield "operator", in_token.value.upper()
+
+            if not isinstance(in_token, Comparison):
+                continue
+
+            columns = [
+                (inner_token.get_parent_name(), inner_token.get_name())
+                for inner_token in in_token.tokens
+                if isinstance(inner_token, Identifier)
+            ]
+            yield "comparison", (
+                columns,
+                [t.value for t in in_token.tokens if not t.is_whitespace],
+            )
+
+
+SCAN_PATTERN = re.compile(
+    r"""
+    (?P<ws>\s+)
+    |(?P<ident>`[^`]+`(?:\.`[^`]+`)?)
+    |(?P<string>'(?:[^'\\]|\\.|'')*')
+    |(?P<quoted>"(?:[^"\\]|\\.|"")*")
+    |(?P<param>%(?:\(\w+\))?s)
+    |(?P<number>\d+(?:\.\d+)?(?![\w.]))
+    |(?P<op><=|>=|<>|!=|=|<|>)
+    |(?P<word>[A-Za-z_]\w*)
+    |(?P<punct>[(),.;*+/-])
+    """,
+    re.VERBOSE,
+)
+SCAN_VALUES = {"string", "number", "param", "ident"}
+SCAN_CLOSE = {"ORDER", "GROUP", "LIMIT", "FOR", ";"}
+
+
+def _scan_tokens(sql: str) -> list[tuple[str, str, int, int]] | None:
+    tokens = []
+    pos = 0
+    while pos < len(sql):
+        if not (match := SCAN_PATTERN.match(sql, pos)):
+            return None
+        kind = match.lastgroup
+        if kind != "ws":
+            text = match.group()
+            if kind == "word":
+                text = text.upper()
+            tokens.append((kind, text, pos, match.end()))
+        pos = match.end()
+    return tokens
+
+
+def _split_ident(ident: str) -> tuple[str | None, str]:
+    parent, _, column = ident.rpartition("`.`")
+    return (parent.strip("`") or None), column.strip("`")
+
+
+def scan_where_clause(sql: str) -> list[tuple[str, Any]] | None:
+    """Items of `iter_where_clause_items` for the subset of SQL Frappe generates, without sqlparse.
+
+    Handles backtick quoted columns compared to literals, params or other columns with AND / OR,
+    IN (...), IS [NOT] NULL & BETWEEN, followed by ORDER BY / GROUP BY columns, LIMIT & FOR UPDATE.
+    Returns None for any other construct - or if there's no WHERE clause, so sqlparse takes over.
+    """
+    if "--" in sql or "/*" in sql or "#" in sql or not (tokens := _scan_tokens(sql)):
+        return None
+    if tokens[0][1] not in {"SELECT", "UPDATE", "DELETE"}:
+        return None
+
+    # find the statement's WHERE clause, skipping subqueries
+    depth = 0
+    for idx, (kind, text, _, _) in enumerate(tokens):
+        if text == "(":
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif depth == 0 and text in {"WITH", "UNION", "HAVING"}:
+            return None
+        elif depth == 0 and text == "WHERE":
+            break
+        if depth < 0:
+            return None
+    else:
+        return None
+
+    items = []
+    end = len(tokens)
+
+    def token_at(i: int) -> tuple[str, str, int, int]:
+        return tokens[i] if i < end else ("", "", 0, 0)
+
+    def skip_parenthesis(i: int) -> int | None:
+        depth = 0
+        while i < end:
+            if tokens[i][1] == "(":
+                depth += 1
+            elif tokens[i][1] == ")":
+                depth -= 1
+                if not depth:
+                    return i + 1
+            i += 1
+        return None
+
+    # WHERE clause - a list of conditions joined by AND / OR
+    i = idx + 1
+    while True:
+        kind, text, _, _ = token_at(i)
+
+        if text == "(":
+            # parenthesized conditions aren't looked into
+            if (i := skip_parenthesis(i)) is None:
+                return None
+        elif kind != "ident":
+            return None
+        else:
+            j = i + 1
+            negated = token_at(j)[1] == "NOT"
+            j += negated
+            op_kind, op, _, op_end = token_at(j)
+
+            if op_kind == "op" or op == "LIKE":
+                value_kind, value, value_start, value_end = token_at(j + 1)
+                if value_kind not in SCAN_VALUES and value != "NULL":
+                    return None
+                columns = [_split_ident(text)]
+                if value_kind == "ident":
+                    columns.append(_split_ident(value))
+                ctx = [text, sql[tokens[i + 1][2] : op_end], sql[value_start:value_end]]
+                items.append(("comparison", (columns, ctx)))
+                i = j + 2
+            elif op == "IN":
+                if token_at(j + 1)[1] != "(" or (i := skip_parenthesis(j + 1)) is None:
+                    return None
+            elif op == "IS" and not negated:
+                j += token_at(j + 1)[1] == "NOT"
+                if token_at(j + 1)[1] != "NULL":
+                    return None
+                i = j + 2
+            elif op == "BETWEEN" and not negated:
+                low, conjunction, high = token_at(j + 1), token_at(j + 2), token_at(j + 3)
+                if conjunction[1] != "AND" or {low[0], high[0]} - {"string", "number", "param"}:
+                    return None
+                items.append(("operator", "AND"))
+                i = j + 4
+            else:
+                return None
+
+        kind, text, _, _ = token_at(i)
+        if text in {"AND", "OR"}:
+            items.append(("operator", text))
+            i += 1
+        elif i == end or text in SCAN_CLOSE:
+            break
+        else:
+            return None
+
+    # ORDER BY / GROUP BY columns, LIMIT & FOR UPDATE
+    while i < end:
+        text = tokens[i][1]
+        if text in {"ORDER", "GROUP"} and token_at(i + 1)[1] == "BY":
+            columns = []
+            i += 2
+            while token_at(i)[0] == "ident":
+                columns.append(_split_ident(tokens[i][1])[1])
+                i += 2 if token_at(i + 1)[1] in {"ASC", "DESC"} else 1
+                if token_at(i)[1] != ",":
+                    break
+                i += 1
+            if not columns or token_at(i - 1)[1] == ",":
+                return None
+            items.append(("order_by", columns))
+        elif text == "LIMIT" and token_at(i + 1)[0] in {"number", "param"}:
+            i += 2
+            if token_at(i)[1] == "OFFSET":
+                if token_at(i + 1)[0] not in {"number", "param"}:
+                    return None
+                i += 2
+        elif text == "FOR" and token_at(i + 1)[1] == "UPDATE":
+            i += 2
+        elif text == ";" and i == end - 1:
+            i += 1
+        else:
+            return None
+
+    return items
 
 
 class IndexCandidateType(Enum):
@@ -302,6 +1106,9 @@ class IndexCandidate(list):
         self.query = query
         self.type = type or IndexCandidateType.WHERE
         self.ctx = ctx
+        # estimated rows saved over the recorded period, see Table.score_index_candidates - None
+        # when it can't be estimated
+        self.score: float | None = None
 
     def __repr__(self) -> str:
         return f"IndexCandidate({self.query.table or 'unspecified'}, {super().__repr__()})"
@@ -313,9 +1120,13 @@ class IndexCandidate(list):
 
 
 class Table:
-    def __init__(self, id: str) -> None:
+    def __init__(self, id: str, name: str | None = None) -> None:
         self.id = id
-        self.name = get_table_name(self.id)
+        self.name = name or get_table_name(self.id)
+        self._row_count = None
+        self._index_length = None
+        self._column_widths = None
+        self._primary_key = []
 
     def __repr__(self) -> str:
         return f"Table({self.name}, name={self.id})"
@@ -326,6 +1137,187 @@ class Table:
     def exists(self) -> bool:
         return bool(frappe.db.sql("SHOW TABLES LIKE %s", self.name))
 
+    def get_row_count(self) -> int:
+        """Estimated number of rows in the table, as reported by INFORMATION_SCHEMA"""
+        if self._row_count is None:
+            self._load_table_status()
+        return self._row_count
+
+    def get_index_length(self) -> int:
+        """Bytes taken by the table's secondary indexes, as reported by INFORMATION_SCHEMA"""
+        if self._index_length is None:
+            self._load_table_status()
+        return self._index_length
+
+    def _load_table_status(self) -> None:
+        rows = frappe.db.sql(
+            """SELECT TABLE_ROWS, INDEX_LENGTH FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""",
+            self.name,
+        )
+        row = rows[0] if rows else (0, 0)
+        self._row_count, self._index_length = cint(row[0]), cint(row[1])
+
+    def get_column_widths(self) -> dict[str, int]:
+        """Estimated bytes a value of each column takes in an index record"""
+        if self._column_widths is None:
+            columns = frappe.db.sql(
+                """SELECT COLUMN_NAME AS name, DATA_TYPE AS data_type, COLUMN_KEY AS column_key,
+                CHARACTER_MAXIMUM_LENGTH AS max_length, NUMERIC_PRECISION AS numeric_precision,
+                DATETIME_PRECISION AS datetime_precision
+                FROM INFORMATION_SCHEMA.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""",
+                self.name,
+                as_dict=True,
+            )
+            self._column_widths = {column["name"]: get_column_width(column) for column in columns}
+            self._primary_key = [c["name"] for c in columns if c["column_key"] == "PRI"]
+        return self._column_widths
+
+    def get_primary_key(self) -> list[str]:
+        self.get_column_widths()
+        return self._primary_key
+
+    def estimate_index_size(self, ic: IndexCandidate) -> int:
+        """Estimated bytes an index on `ic` would take - a record of its columns & the primary key
+        per row of the table.
+        """
+        widths = self.get_column_widths()
+        record = sum(widths.get(column, 0) for column in {*ic, *self._primary_key})
+        return int(self.get_row_count() * (record + INDEX_RECORD_OVERHEAD) / INDEX_FILL_FACTOR)
+
+    def get_write_count(self) -> int:
+        """Recorded executions of INSERT, UPDATE & DELETE queries involving the table"""
+        rows = frappe.db.sql(
+            """SELECT SUM(occurrence) FROM `tabMariaDB Query`
+            WHERE LEFT(LTRIM(parameterized_query), 6) IN ('insert', 'update', 'delete')
+            AND name IN (
+                SELECT parent FROM `tabMariaDB Query Explain`
+                WHERE parenttype = 'MariaDB Query' AND `table` = %s
+            )""",
+            self.id,
+        )
+        return cint(rows[0][0]) if rows else 0
+
+    def weigh_write_cost(
+        self, index_candidates: list[IndexCandidate], write_cost: float
+    ) -> list[IndexCandidate]:
+        """Deduct the upkeep of each scored candidate from its score & keep those still saving rows.
+
+        Every recorded write to the table maintains each of its indexes - UPDATEs are counted as if
+        they changed the indexed columns - at the cost of reading `write_cost` rows. Candidates
+        whose benefit couldn't be estimated (a score of None) are left for the backtest to judge.
+        """
+        if not (writes := self.get_write_count()):
+            return index_candidates
+
+        weighed = []
+        for ic in index_candidates:
+            if ic.score is None:
+                weighed.append(ic)
+                continue
+            ic.score -= writes * write_cost
+            if ic.score > 0:
+                weighed.append(ic)
+        return weighed
+
+    def get_column_cardinality(self, columns: Iterable[str] = ()) -> dict[str, int]:
+        """Distinct values of the columns leading an existing index, & of `columns` - estimated
+        from engine-independent statistics (mysql.column_stats) or a sample of the table when
+        they don't lead an index.
+        """
+        from toolbox.doctypes import MariaDBIndex
+        from toolbox.toolbox.doctype.mariadb_index.mariadb_index import VALID_IDENTIFIER
+
+        cardinality = {}
+        for index in MariaDBIndex.get_indexes(self.name):
+            if index["seq_id"] == 1:
+                column = index["column_name"]
+                cardinality[column] = max(cardinality.get(column, 0), cint(index["cardinality"]))
+
+        missing = sorted(
+            {c for c in columns if c not in cardinality and VALID_IDENTIFIER.match(c or "")}
+        )
+        if missing:
+            cardinality.update(self.get_column_stats_cardinality(missing))
+        if missing := [c for c in missing if c not in cardinality]:
+            cardinality.update(self.sample_column_cardinality(missing))
+        return cardinality
+
+    def get_column_stats_cardinality(self, columns: list[str]) -> dict[str, int]:
+        """Distinct values of `columns` from their persistent statistics, if they were collected
+        with ANALYZE TABLE ... PERSISTENT FOR COLUMNS
+        """
+        table_rows = self.get_row_count()
+        try:
+            stats = frappe.db.sql(
+                """SELECT column_name, avg_frequency FROM mysql.column_stats
+                WHERE db_name = DATABASE() AND table_name = %s AND column_name IN %s""",
+                (self.name, tuple(columns)),
+            )
+        except Exception as e:
+            # reading the mysql schema needs privileges the site's user may not have
+            frappe.logger("toolbox").debug(f"Can't read column stats of {self.name}: {e}")
+            return {}
+
+        return {
+            column: max(round(table_rows / float(avg_frequency)), 1)
+            for column, avg_frequency in stats
+            if avg_frequency and float(avg_frequency) > 0 and table_rows
+        }
+
+    def sample_column_cardinality(self, columns: list[str]) -> dict[str, int]:
+        """Distinct values of `columns`, counted over CARDINALITY_SAMPLE_ROWS rows of the table.
+
+        Columns averaging 10 or more rows per value in the sample are assumed to have shown all
+        their values, the distinct values of the rest are scaled up to the table's size.
+        """
+        quoted = [f"`{column}`" for column in columns]
+        try:
+            sampled, *distinct = frappe.db.sql(
+                f"SELECT COUNT(*), {', '.join(f'COUNT(DISTINCT {c})' for c in quoted)} "
+                f"FROM (SELECT {', '.join(quoted)} FROM `{self.name}` "
+                f"LIMIT {CARDINALITY_SAMPLE_ROWS}) sample"
+            )[0]
+        except Exception as e:
+            frappe.logger("toolbox").error(f"Error while sampling columns of {self.name}: {e}")
+            return {}
+
+        table_rows = max(self.get_row_count(), sampled)
+        cardinality = {}
+        for column, values in zip(columns, distinct):
+            if not values:
+                continue
+            if sampled < CARDINALITY_SAMPLE_ROWS or values * 10 <= sampled:
+                cardinality[column] = values
+            else:
+                cardinality[column] = round(table_rows * values / sampled)
+        return cardinality
+
+    def score_index_candidates(self, index_candidates: list[IndexCandidate]) -> None:
+        """Set each candidate's score - the rows it's expected to save over the recorded period.
+
+        Per execution, a query's plan examines `rows_examined` rows of the table & keeps
+        `rows_filtered` of them (EXPLAIN rows x filtered). Through the index, it would read the
+        rows per distinct value of the candidate's most selective column (see
+        get_column_cardinality), or the rows the plan keeps if that can't be estimated. The
+        difference is scaled by occurrence.
+
+        Queries recorded without EXPLAIN rows can't be estimated & are scored None.
+        """
+        table_rows = self.get_row_count()
+        cardinality = self.get_column_cardinality({c for ic in index_candidates for c in ic})
+
+        for ic in index_candidates:
+            query = ic.query
+            if not query.rows_examined:
+                ic.score = None
+                continue
+            rows_read = query.rows_filtered
+            if table_rows and (distinct := max((cardinality.get(c, 0) for c in ic), default=0)):
+                rows_read = min(query.rows_examined, table_rows / distinct)
+            ic.score = max(query.rows_examined - rows_read, 0) * query.occurrence
+
     def find_index_candidates(
         self, queries: list[Query], qualifier: Callable | None = None
     ) -> list[IndexCandidate]:
@@ -335,73 +1327,77 @@ class Table:
             if qualifier and not qualifier(query):
                 continue
 
-            if any(isinstance(token, Where) for token in query.parsed):
-                index_generator = self.find_index_candidates_from_where_query
-            else:
-                index_generator = self.find_index_candidates_from_select_query
+            query_index_candidates = query.get_cached_index_candidates(self.name)
+
+            if query_index_candidates is None:
+                # Frappe's simple WHERE clauses are scanned directly, sqlparse handles the rest
+                if (clause_items := scan_where_clause(query.sql)) is not None:
+                    query_index_candidates = self.build_where_index_candidates(query, clause_items)
+                elif any(isinstance(token, Where) for token in query.parsed):
+                    query_index_candidates = self.find_index_candidates_from_where_query(query)
+                else:
+                    query_index_candidates = self.find_index_candidates_from_select_query(query)
+
+                if self.name:
+                    query.cache_index_candidates(self.name, query_index_candidates)
 
-            for c in index_generator(query):
+            for c in query_index_candidates:
                 if c and c not in index_candidates:
                     index_candidates.append(c)
 
         return index_candidates
 
     def find_index_candidates_from_where_query(self, query: Query) -> list[IndexCandidate]:
+        return self.build_where_index_candidates(query, iter_where_clause_items(query.parsed))
+
+    def build_where_index_candidates(
+        self, query: Query, clause_items: Iterable[tuple[str, Any]]
+    ) -> list[IndexCandidate]:
+        """Group WHERE comparisons & the ORDER BY / GROUP BY columns into index candidates.
+
+        `clause_items` are produced by `iter_where_clause_items` or `scan_where_clause`.
+        """
         query_index_candidate = []
         ic_operator = "AND"
-        parsed_where = False
 
-        for clause_token in query.parsed.tokens:
+        for kind, value in clause_items:
             # check order by clause for index candidates
-            if parsed_where and not clause_token.ttype:
+            if kind == "order_by":
                 ic = IndexCandidate(query=query, type=IndexCandidateType.ORDER_BY)
-                if isinstance(clause_token, Identifier):
-                    ic.append(clause_token.get_name())
-                elif isinstance(clause_token, IdentifierList):
-                    ic.extend([x.get_name() for x in clause_token.get_identifiers()])
+                ic.extend(value)
                 query_index_candidate.append(ic)
                 continue
 
-            # check only the where clause
-            if not isinstance(clause_token, Where):
-                continue
-            parsed_where = True
-
             # we may want to check type of operators for finding appropriate index types at this stage
-            for in_token in clause_token.tokens:
-                if in_token.ttype == Keyword and in_token.value.upper() in {"AND", "OR"}:
-                    ic_operator = in_token.value.upper()
-
-                if not isinstance(in_token, Comparison):
-                    continue
+            if kind == "operator":
+                ic_operator = value
+                continue
 
-                if ic_operator == "OR":
-                    index_candidate = IndexCandidate(query=query, type=IndexCandidateType.WHERE)
-                else:
-                    index_candidate = (
-                        query_index_candidate[-1]
-                        if query_index_candidate
-                        else IndexCandidate(query=query, type=IndexCandidateType.WHERE)
-                    )
+            if ic_operator == "OR":
+                index_candidate = IndexCandidate(query=query, type=IndexCandidateType.WHERE)
+            else:
+                index_candidate = (
+                    query_index_candidate[-1]
+                    if query_index_candidate
+                    else IndexCandidate(query=query, type=IndexCandidateType.WHERE)
+                )
 
-                # Store comparison context for qualifying ICs later
-                index_candidate.ctx = [t for t in in_token.tokens if not t.is_whitespace]
+            # Store comparison context for qualifying ICs later
+            columns, index_candidate.ctx = value
 
-                for inner_token in in_token.tokens:
-                    if not isinstance(inner_token, Identifier):
-                        continue
-                    if inner_token.get_parent_name() in {None, self.name}:
-                        index_candidate.append(inner_token.get_name())
+            for parent, column in columns:
+                if parent in {None, self.name}:
+                    index_candidate.append(column)
 
-                if index_candidate not in query_index_candidate:
-                    query_index_candidate.append(index_candidate)
+            if index_candidate not in query_index_candidate:
+                query_index_candidate.append(index_candidate)
 
         return query_index_candidate
 
     def find_index_candidates_from_select_query(self, query: Query) -> list[IndexCandidate]:
         query_index_candidates = []
 
-        if query.d_parsed.query_type != QueryType.SELECT:
+        if query.query_type != "SELECT":
             return query_index_candidates
 
         ic = {
@@ -409,8 +1405,8 @@ class Table:
             "order_by": IndexCandidate(query=query, type=IndexCandidateType.ORDER_BY),
         }
 
-        for type in {"select", "order_by"}:
-            for column in (query.d_parsed.columns_dict or {}).get(type, []):
+        for type in ("select", "order_by"):
+            for column in query.columns.get(type, []):
                 q_index_candidate = ic[type]
 
                 if "." in column:
@@ -473,6 +1469,25 @@ class Table:
         return required_indexes
 
 
+def get_column_width(column: dict) -> int:
+    """Estimated bytes a value of `column` takes, from its INFORMATION_SCHEMA.COLUMNS row.
+
+    Strings are assumed to hold single byte characters & fill half their maximum length.
+    """
+    data_type = column["data_type"]
+
+    if data_type == "decimal":
+        return cint(column["numeric_precision"]) // 2 + 1
+    if data_type in ("datetime", "time", "timestamp"):
+        return COLUMN_TYPE_WIDTHS[data_type] + (cint(column["datetime_precision"]) + 1) // 2
+    if data_type in COLUMN_TYPE_WIDTHS:
+        return COLUMN_TYPE_WIDTHS[data_type]
+    if max_length := cint(column["max_length"]):
+        # length prefix & half the characters, index records hold at most 3072 bytes
+        return min(max_length // 2 + 2, 3072)
+    return 8
+
+
 def get_analyzed_result(sql: str, verbose: bool = False):
     try:
         return frappe.db.sql(f"ANALYZE {sql}", as_dict=True, debug=verbose)
@@ -481,25 +1496,139 @@ def get_analyzed_result(sql: str, verbose: bool = False):
         return [{"r_filtered": -1, "r_rows": "0.00", "Extra": "Using where"}]
 
 
+def get_analyzed_run(sql: str, verbose: bool = False) -> dict | None:
+    """Time taken & rows read by one execution of `sql`, from ANALYZE FORMAT=JSON"""
+    try:
+        result = frappe.db.sql(f"ANALYZE FORMAT=JSON {sql}", debug=verbose)
+        analyzed = json.loads(result[0][0])
+    except Exception as e:
+        frappe.logger("toolbox").error(f"Error while analyzing {sql}: {e}")
+        return None
+
+    def get_rows_read(node) -> float:
+        if isinstance(node, list):
+            return sum(get_rows_read(x) for x in node)
+        if not isinstance(node, dict):
+            return 0.0
+        rows_read = sum(get_rows_read(x) for x in node.values())
+        if "table_name" in node:
+            rows_read += float(node.get("r_loops") or 0) * float(node.get("r_rows") or 0)
+        return rows_read
+
+    return {
+        "time_ms": float(analyzed.get("query_block", {}).get("r_total_time_ms") or 0),
+        "rows_read": get_rows_read(analyzed),
+    }
+
+
+def permutation_test(before: list[float], after: list[float]) -> float:
+    """One-sided p-value of the mean of `after` being lower than that of `before` by chance.
+
+    Every split of the pooled runs is tried when there are few enough of them, a fixed random
+    sample of splits otherwise.
+    """
+    pooled = before + after
+    n = len(before)
+    observed = sum(before) / n - sum(after) / len(after)
+    total = sum(pooled)
+
+    if comb(len(pooled), n) <= BENCHMARK_PERMUTATIONS:
+        splits = combinations(range(len(pooled)), n)
+    else:
+        rng = Random(0)
+        splits = (rng.sample(range(len(pooled)), n) for _ in range(BENCHMARK_PERMUTATIONS))
+
+    tried = extreme = 0
+    for split in splits:
+        split_sum = sum(pooled[i] for i in split)
+        tried += 1
+        # float tolerance, so that the observed split always counts itself
+        if split_sum / n - (total - split_sum) / len(after) >= observed - 1e-9:
+            extreme += 1
+
+    return extreme / tried
+
+
 class QueryBenchmark:
-    def __init__(self, index_candidates: list[IndexCandidate], verbose=False):
+    """Benchmarks the sample queries of index candidates before & after their indexes are built.
+
+    Each sample runs through ANALYZE once, which also warms the buffer pool, then `runs` more
+    times through ANALYZE FORMAT=JSON to collect r_total_time_ms & rows read. An index is kept
+    if it cuts the rows read by `min_improvement`, or the time by as much with a significant
+    permutation test.
+
+    ANALYZE executes the statement, so UPDATE & DELETE samples only get the single run & are
+    judged by its r_rows & r_filtered.
+    """
+
+    def __init__(
+        self,
+        index_candidates: list[IndexCandidate],
+        verbose=False,
+        runs: int = BENCHMARK_RUNS,
+        min_improvement: float = BENCHMARK_MIN_IMPROVEMENT,
+    ):
         self.index_candidates = index_candidates
         self.verbose = verbose
+        self.runs = runs
+        self.min_improvement = min_improvement
         self.before = []
         self.after = []
+        self.before_runs = []
+        self.after_runs = []
 
     def __enter__(self):
-        self.before = self.conduct_benchmark()
+        self.before, self.before_runs = self.conduct_benchmark()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.after = self.conduct_benchmark()
+        self.after, self.after_runs = self.conduct_benchmark()
+
+    def conduct_benchmark(self) -> tuple[list[list[dict]], list[list[dict]]]:
+        results, runs = [], []
+        for ic in self.index_candidates:
+            sample = ic.query.get_sample()
+            results.append(get_analyzed_result(sample, verbose=self.verbose))
+            if ic.query.query_type != "SELECT":
+                runs.append([])
+                continue
+            runs.append(
+                [
+                    run
+                    for _ in range(self.runs)
+                    if (run := get_analyzed_run(sample, verbose=self.verbose))
+                ]
+            )
+        return results, runs
+
+    def compare_runs(self, before: list[dict], after: list[dict]) -> dict:
+        """Summary & verdict of the timed runs of a query, before & after"""
+        rows_before = median(run["rows_read"] for run in before)
+        rows_after = median(run["rows_read"] for run in after)
+        time_before = fmean(run["time_ms"] for run in before)
+        time_after = fmean(run["time_ms"] for run in after)
+        p_value = permutation_test(
+            [run["time_ms"] for run in before], [run["time_ms"] for run in after]
+        )
 
-    def conduct_benchmark(self) -> list[list[dict]]:
-        return [
-            get_analyzed_result(ic.query.get_sample(), verbose=self.verbose)
-            for ic in self.index_candidates
-        ]
+        rows_improvement = (rows_before - rows_after) / rows_before if rows_before else 0.0
+        time_improvement = (time_before - time_after) / time_before if time_before else 0.0
+        min_improvement = max(self.min_improvement, 1e-9)
+        improved = rows_improvement >= min_improvement or (
+            time_improvement >= min_improvement
+            and time_before - time_after >= BENCHMARK_MIN_TIME_SAVED_MS
+            and p_value <= BENCHMARK_SIGNIFICANCE
+        )
+
+        return {
+            "improved": improved,
+            "rows_read_before": rows_before,
+            "rows_read_after": rows_after,
+            "time_before": time_before,
+            "time_after": time_after,
+            "improvement": time_improvement * 100,
+            "p_value": p_value,
+        }
 
     def compare_results(
         self, before: list[list[dict]], after: list[list[dict]]
@@ -523,6 +1652,15 @@ class QueryBenchmark:
 
     def get_unchanged_results(self):
         for q_id, context_table in enumerate(self.compare_results(self.before, self.after)):
+            before_runs = self.before_runs[q_id] if q_id < len(self.before_runs) else None
+            after_runs = self.after_runs[q_id] if q_id < len(self.after_runs) else None
+
+            # timed runs decide when they're available, single ANALYZE results otherwise
+            if before_runs and after_runs:
+                if not self.compare_runs(before_runs, after_runs)["improved"]:
+                    yield q_id, context_table[-1] if context_table else {}
+                continue
+
             changes_detected = False
 
             for row_id, context in enumerate(context_table):
@@ -549,3 +1687,219 @@ class QueryBenchmark:
 
             if not changes_detected:
                 yield q_id, context
+
+    def save_results(self, failed_index_candidates: list[IndexCandidate] = ()) -> None:
+        """Record the verdict & timed runs of every built index as a MariaDB Index Benchmark"""
+        from toolbox.toolbox.doctype.mariadb_index.mariadb_index import get_index_name
+
+        unchanged = {q_id for q_id, _ in self.get_unchanged_results()}
+
+        for q_id, ic in enumerate(self.index_candidates):
+            if ic in failed_index_candidates:
+                continue
+
+            before_runs, after_runs = self.before_runs[q_id], self.after_runs[q_id]
+            summary = (
+                self.compare_runs(before_runs, after_runs) if before_runs and after_runs else {}
+            )
+            summary.pop("improved", None)
+            table = ic.query.table
+
+            frappe.new_doc(
+                "MariaDB Index Benchmark",
+                table=table.id if table else None,
+                index_name=get_index_name(ic),
+                query=ic.query.name,
+                verdict="Dropped" if q_id in unchanged else "Kept",
+                runs=len(after_runs),
+                raw_results=frappe.as_json({"before": before_runs, "after": after_runs}),
+                **summary,
+            ).db_insert()
+
+
+class WhatIfAnalysis:
+    """Predicts whether index candidates would help their queries, without building them on the
+    live table.
+
+    A random sample of the table is copied into a shadow table & analyzed with engine-independent
+    statistics (column histograms), so the optimizer's estimates on the sample mirror the live
+    table. Each candidate is then built on the shadow table, where it's cheap, and the query's
+    EXPLAIN is compared against the plan without it. Verdicts are cached for WHAT_IF_VERDICT_TTL
+    seconds, the shadow table is only built for candidates without one.
+    """
+
+    def __init__(
+        self,
+        table: Table,
+        index_candidates: list[IndexCandidate],
+        sample_rows: int = WHAT_IF_SAMPLE_ROWS,
+        verbose=False,
+    ):
+        self.table = table
+        self.index_candidates = index_candidates
+        self.sample_rows = sample_rows
+        self.verbose = verbose
+        self.shadow_table = f"{WHAT_IF_TABLE_PREFIX}{frappe.generate_hash(length=10)}"
+        self.verdicts = [None] * len(index_candidates)
+
+    def __enter__(self):
+        from toolbox.toolbox.doctype.mariadb_index.mariadb_index import _validate_identifier
+
+        self.verdicts = [
+            frappe.cache.get_value(self.get_verdict_key(ic)) for ic in self.index_candidates
+        ]
+        if not self.needs_shadow_table():
+            return self
+
+        _validate_identifier(self.table.name, "table name")
+        columns = sorted({col for ic in self.index_candidates for col in ic})
+        for col in columns:
+            _validate_identifier(col, "column name")
+
+        table_rows = self.table.get_row_count()
+        fraction = min(1.0, self.sample_rows / table_rows) if table_rows else 1.0
+
+        frappe.db.sql_ddl(
+            f"CREATE TABLE `{self.shadow_table}` LIKE `{self.table.name}`", debug=self.verbose
+        )
+        try:
+            self.copy_sample(fraction)
+            frappe.db.sql(
+                f"ANALYZE TABLE `{self.shadow_table}` PERSISTENT FOR "
+                f"COLUMNS ({', '.join(f'`{col}`' for col in columns)}) INDEXES ALL",
+                debug=self.verbose,
+            )
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.needs_shadow_table():
+            frappe.db.sql_ddl(f"DROP TABLE IF EXISTS `{self.shadow_table}`", debug=self.verbose)
+
+    def needs_shadow_table(self) -> bool:
+        return any(verdict is None for verdict in self.verdicts)
+
+    def copy_sample(self, fraction: float) -> None:
+        """Copy a random `fraction` of the table's rows into the shadow table.
+
+        Rows are read in primary key ranges of WHAT_IF_COPY_BATCH_SIZE under READ COMMITTED, where
+        INSERT ... SELECT takes no locks on the rows it reads, & each range is committed on its own -
+        so writers to the live table aren't blocked & the whole table is sampled evenly.
+        """
+        from toolbox.toolbox.doctype.mariadb_index.mariadb_index import _validate_identifier
+
+        isolation = frappe.db.sql("SELECT @@SESSION.tx_isolation")[0][0]
+        frappe.db.sql("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        frappe.db.commit()
+
+        try:
+            primary_key = self.table.get_primary_key()
+            if len(primary_key) != 1:
+                self._copy_range([], [], fraction)
+                return
+
+            pk = primary_key[0]
+            _validate_identifier(pk, "column name")
+            lower = None
+
+            while True:
+                conditions, values = ([f"`{pk}` > %s"], [lower]) if lower is not None else ([], [])
+                where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+                bound = frappe.db.sql(
+                    f"SELECT `{pk}` FROM `{self.table.name}` {where} ORDER BY `{pk}` "
+                    f"LIMIT 1 OFFSET {WHAT_IF_COPY_BATCH_SIZE - 1}",
+                    values,
+                    debug=self.verbose,
+                )
+                if bound:
+                    conditions.append(f"`{pk}` <= %s")
+                    values.append(bound[0][0])
+
+                self._copy_range(conditions, values, fraction)
+                if not bound:
+                    break
+                lower = bound[0][0]
+        finally:
+            frappe.db.sql("SET SESSION tx_isolation = %s", isolation)
+            frappe.db.commit()
+
+    def _copy_range(self, conditions: list[str], values: list, fraction: float) -> None:
+        frappe.db.sql(
+            f"INSERT INTO `{self.shadow_table}` SELECT * FROM `{self.table.name}` "
+            f"WHERE {' AND '.join([*conditions, 'RAND() < %s'])}",
+            (*values, fraction),
+            debug=self.verbose,
+        )
+        frappe.db.commit()
+
+    def get_shadow_sql(self, sql: str) -> str:
+        """Point the table's references in `sql` at the shadow table"""
+        table = re.escape(self.table.name)
+        return re.sub(rf"`{table}`|\b{table}\b", f"`{self.shadow_table}`", sql)
+
+    def get_verdict_key(self, ic: IndexCandidate) -> str:
+        from toolbox.toolbox.doctype.mariadb_index.mariadb_index import get_index_name
+
+        candidate = f"{self.table.name}:{get_index_name(ic)}:{ic.query.sql}"
+        return f"{WHAT_IF_VERDICT_KEY}:{get_query_digest(candidate)}"
+
+    def explain(self, ic: IndexCandidate) -> list[dict] | None:
+        try:
+            return frappe.db.sql(
+                f"EXPLAIN {self.get_shadow_sql(ic.query.get_sample())}",
+                as_dict=True,
+                debug=self.verbose,
+            )
+        except Exception as e:
+            frappe.logger("toolbox").error(f"Error while explaining {ic.query.sql}: {e}")
+
+    def is_helpful(self, ic: IndexCandidate) -> bool:
+        """Whether the optimizer picks the candidate on the shadow table & reads fewer rows, or
+        skips a filesort. Candidates that can't be evaluated are kept for the backtest to judge,
+        without caching a verdict.
+        """
+        from toolbox.doctypes import MariaDBIndex
+        from toolbox.toolbox.doctype.mariadb_index.mariadb_index import get_index_name
+
+        before = self.explain(ic)
+        if before is None or MariaDBIndex.create(
+            self.shadow_table, [ic], verbose=self.verbose, throttle=False
+        ):
+            return True
+
+        try:
+            after = self.explain(ic)
+        finally:
+            MariaDBIndex.drop(self.shadow_table, [ic], verbose=self.verbose)
+
+        if after is None:
+            return True
+
+        index_name = get_index_name(ic)
+        helpful = any(row.get("key") == index_name for row in after) and (
+            get_explained_rows(before) > get_explained_rows(after)
+            or (has_filesort(before) and not has_filesort(after))
+        )
+        frappe.cache.set_value(
+            self.get_verdict_key(ic), int(helpful), expires_in_sec=WHAT_IF_VERDICT_TTL
+        )
+        return helpful
+
+    def get_helpful_index_candidates(self) -> list[IndexCandidate]:
+        return [
+            ic
+            for ic, verdict in zip(self.index_candidates, self.verdicts)
+            if (self.is_helpful(ic) if verdict is None else cint(verdict))
+        ]
+
+
+def get_explained_rows(explain: list[dict]) -> float:
+    """Rows the plan is estimated to keep, summed over the tables it reads"""
+    return sum(cint(row.get("rows")) * float(row.get("filtered") or 100) / 100 for row in explain)
+
+
+def has_filesort(explain: list[dict]) -> bool:
+    return any("filesort" in (row.get("Extra") or "") for row in explain)